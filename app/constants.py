@@ -1,9 +1,99 @@
 DYNAMO_DB_TABLE_NAME = "url-shortener-test"
+# sparse gsi over the owner mappings: ListedBy (S) / CreatedAt (N)
+OWNER_CREATED_INDEX = "OwnerCreatedAt"
 JWT_SECRET = "asdfasdfasdf"
 HASHID_SALT = "asdfadsfawefawe"
+SHORT_CODE_MIN_LENGTH = 7
 JWT_ALGORITHM = "HS256"
 
 PRO_RATE_LIMIT = 1000
 STD_RATE_LIMIT = 5
 
+RATE_LIMIT_LEASE_SIZE = 50
+RATE_LIMIT_LEASE_MIN_RATE = 100
+RATE_LIMIT_MAX_OVERSHOOT = 0
 
+URL_CACHE_TTL = 600
+
+L1_CACHE_MAX_BYTES = 8 * 1024 * 1024
+L1_CACHE_TTL = 60
+L1_CACHE_STATS_INTERVAL = 1000
+
+NEGATIVE_CACHE_TTL = 30
+NEGATIVE_CACHE_MARKER = "\x00missing"
+
+BLOOM_FILTER_KEY = "{shortcodes}:bloom"
+BLOOM_FILTER_BITS = 1 << 27
+BLOOM_FILTER_HASHES = 7
+
+METRICS_BATCH_SIZE = 10
+METRICS_BATCH_MAX_AGE = 0.0
+METRICS_BUFFER_MAX_PENDING = 1000
+METRICS_FLUSH_TIMEOUT = 2.0
+# concurrent dynamodb writes per consumer batch
+METRICS_WRITE_WORKERS = 16
+# a day's metrics are written in one transaction, retried when it lost a
+# conflict with another consumer writing the same url
+METRICS_TRANSACTION_ATTEMPTS = 3
+METRICS_TRANSACTION_BACKOFF = 0.05
+# referrers kept per metrics bucket, the rest are folded into "(other)";
+# countries are few enough to keep them all (0 turns the cap off)
+METRICS_TOP_REFERRERS = 50
+METRICS_TOP_COUNTRIES = 0
+# unique visitor sketches on day and month items: 2^11 registers, ~2.3% error
+VISITOR_SKETCH_PRECISION = 11
+VISITOR_MERGE_ATTEMPTS = 5
+# redis metrics mode: hour hashes are marked dirty in one of these sets, picked
+# by url, until the flush job drains them; each set is its own slot
+METRICS_DIRTY_SHARDS = 16
+# a claim of a drained hash older than this belongs to a flush that died and
+# is taken over
+METRICS_COUNTER_CLAIM_TTL = 300
+METRICS_COUNTER_FLUSH_BATCH = 500
+METRICS_COUNTER_FLUSH_MAX_KEYS = 20_000
+# a flush stops draining when the invocation has less time than this left
+METRICS_COUNTER_FLUSH_RESERVE_MS = 10_000
+
+URL_LOCK_TTL_MS = 2000
+URL_LOCK_WAIT = 0.2
+URL_LOCK_POLL_INTERVAL = 0.02
+# behind the l1 cache a container reads a hot key from redis about once per
+# L1_CACHE_TTL, so the early refresh window is stretched well past one db read
+URL_XFETCH_BETA = 100.0
+URL_LOAD_ESTIMATE = 0.02
+
+HOT_KEY_SKETCH_WIDTH = 2048
+HOT_KEY_SKETCH_DEPTH = 4
+HOT_KEY_TOP_K = 32
+HOT_KEY_FLUSH_INTERVAL = 10.0
+HOT_KEY_WINDOW = 60
+HOT_KEY_WINDOW_TTL = 3600
+# fleet wide hits per window before a code counts as hot
+HOT_KEY_THRESHOLD = 1000
+HOT_URL_CACHE_TTL = 3600
+HOT_KEY_REPORT_WINDOWS = 60
+HOT_KEY_REPORT_SIZE = 50
+
+COUNTER_BLOCK_SIZE = 1000
+# values left in the block when the next one is fetched in the background
+COUNTER_REFILL_AT = 200
+
+BULK_CREATE_MAX_URLS = 10000
+BATCH_WRITE_WORKERS = 8
+BATCH_WRITE_MAX_ATTEMPTS = 5
+BATCH_WRITE_BACKOFF = 0.05
+BLOOM_FILTER_ADD_CHUNK = 1000
+
+IMPORT_BATCH_SIZE = 500
+IMPORT_WORKERS = 4
+IMPORT_MAX_IN_FLIGHT = 8
+IMPORT_REPORT_INTERVAL = 10.0
+
+URL_LIST_PAGE_SIZE = 50
+URL_LIST_MAX_PAGE_SIZE = 100
+URL_LIST_CACHE_TTL = 300
+BACKFILL_BATCH_SIZE = 500
+
+LOG_LEVEL = "INFO"
+# 1 in N hot path debug records is emitted
+LOG_HOT_PATH_SAMPLE = 100
@@ -0,0 +1,11 @@
+import datetime
+
+from pydantic import BaseModel, Field
+
+from app.models.metrics import MetricsGranularity
+
+class MetricsRangeRequest(BaseModel):
+    start_date: datetime.date = Field(default_factory=datetime.date.today, alias="startDate")
+    end_date: datetime.date = Field(default_factory=datetime.date.today, alias="endDate")
+    # left out, the range is read with the fewest month and day items that cover it
+    granularity: MetricsGranularity | None = None
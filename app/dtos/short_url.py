@@ -1,4 +1,25 @@
-from pydantic import BaseModel
+from typing import Literal
+
+from pydantic import BaseModel, Field
+
+from app.constants import BULK_CREATE_MAX_URLS, URL_LIST_PAGE_SIZE, URL_LIST_MAX_PAGE_SIZE
+from app.models.subscriptions import Subscription
 
 class CreateShortURLRequest(BaseModel):
-    url: str
\ No newline at end of file
+    url: str
+    # return the caller's existing short url for the same destination instead of a new one
+    dedupe: bool = False
+
+class CreateShortURLsRequest(BaseModel):
+    urls: list[str] = Field(min_length=1, max_length=BULK_CREATE_MAX_URLS)
+
+class ListShortURLsRequest(BaseModel):
+    limit: int = Field(default=URL_LIST_PAGE_SIZE, ge=1, le=URL_LIST_MAX_PAGE_SIZE)
+    cursor: str | None = None
+    order: Literal["newest", "oldest"] = "newest"
+
+class ImportLinkRecord(BaseModel):
+    url: str = Field(min_length=1)
+    owner_id: str = Field(min_length=1)
+    subscription: Subscription = Subscription.STANDARD
+    created_at: int | None = None
@@ -1,5 +1,4 @@
 from pydantic import ValidationError
-import traceback
 import json
 from typing import Callable
 from functools import wraps
@@ -8,6 +7,10 @@ from enum import Enum
 from aws_lambda_typing.responses import APIGatewayProxyResponseV2
 from aws_lambda_typing import events, context
 
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
 
 class ErrorCodes(str,Enum):
     #user errors
@@ -21,6 +24,7 @@ class ErrorCodes(str,Enum):
     #shorturl errors
     SHORTURL_NOT_FOUND = 2001
     TOO_MANY_REQUESTS = 2002
+    INVALID_CURSOR = 2003
 
     #miscellaneous errors
     INTERNAL_SERVER_ERROR = 3001
@@ -56,8 +60,8 @@ def exception_boundary(func: Callable[[events.APIGatewayProxyEventV1, context.Co
                     "code": ErrorCodes.VALIDATION_ERROR,
                 })
             )
-        except Exception as e:
-            traceback.print_exc()
+        except Exception:
+            logger.exception("unhandled error")
             return APIGatewayProxyResponseV2(
                 statusCode= 500,
                 body= json.dumps({
@@ -1,28 +1,40 @@
 from app.errors.web_errors import ErrorCodes
 from app.errors.web_errors import WebException
 import json
+import os
 
 from app.repository.short_url_repo import ShortURLRepository
-import datetime
 from aws_lambda_typing.responses.api_gateway_proxy import APIGatewayProxyResponseV1
 from app.dtos.auth import JwtDTO
+from app.dtos.metrics import MetricsRangeRequest
 from app.models.user import User
 from app.utils.auth_decorator import requires_auth
 from app.errors.web_errors import exception_boundary
 from app.service.metrics import MetricsService
-import traceback
 import boto3
+from botocore.config import Config
+from redis import Redis
 from aws_lambda_typing import events, context
 
+from app.constants import METRICS_WRITE_WORKERS
 from app.repository.metrics_repo import MetricsRepository
+from app.service.metrics_counters import MetricsCounters
+from app.utils.logger import get_logger
 
-db = boto3.resource('dynamodb')
+logger = get_logger(__name__)
+
+metrics_write_workers = int(os.environ.get('METRICS_WRITE_WORKERS', METRICS_WRITE_WORKERS))
+
+# one pooled connection per writer thread, botocore keeps 10 by default
+db = boto3.resource('dynamodb', config=Config(max_pool_connections=max(metrics_write_workers, 10)))
 sqs_client = boto3.client('sqs')
+redis_client = Redis(host=os.environ.get('REDIS_ENDPOINT', "localhost"), port=6379, db=0, ssl=True, decode_responses=True)
 
-metrics_repo = MetricsRepository(db)
+metrics_repo = MetricsRepository(db, workers=metrics_write_workers)
 url_repo = ShortURLRepository(db)
 
-metrics_service = MetricsService(sqs_client, metrics_repo, url_repo)
+# the counters are only drained here, redirects count into them when METRICS_MODE is redis
+metrics_service = MetricsService(sqs_client, metrics_repo, url_repo, MetricsCounters(redis_client))
 
 def process_metrics(event: events.SQSEvent, ctx: context.Context ):
     try:
@@ -36,9 +48,13 @@ def process_metrics(event: events.SQSEvent, ctx: context.Context ):
                 for fe in failed_events
             ]
         }
-    except Exception as e:
-        print(e)
-        traceback.print_exc()
+    except Exception:
+        logger.exception("failed to process metrics batch")
+
+def flush_metrics(event: events.EventBridgeEvent, ctx: context.Context):
+    result = metrics_service.flush_counters(ctx.get_remaining_time_in_millis)
+    logger.info("metrics counters flushed", **result)
+    return result
 
 @exception_boundary
 @requires_auth
@@ -61,15 +77,16 @@ def get_url_metrics(event: events.APIGatewayProxyEventV1, ctx: context.Context,
             error_code=ErrorCodes.SHORTURL_NOT_FOUND
         )
 
-    start_date = datetime.date.today().strftime("%Y-%m-%d")
-    end_date = datetime.date.today().strftime("%Y-%m-%d")
-
-    if queries:
-        start_date = queries['startDate']
-        end_date = queries['endDate']
+    req = MetricsRangeRequest(**(queries or {}))
 
-    print(user.id)
-    metrics = metrics_service.get_metrics_by_url(url=url, user_id=user.id, start_day=start_date, end_day=end_date)
+    logger.debug("metrics requested", user_id=user.id, short_url=url)
+    metrics = metrics_service.get_metrics_by_url(
+        url=url,
+        user_id=user.id,
+        start_day=req.start_date.isoformat(),
+        end_day=req.end_date.isoformat(),
+        granularity=req.granularity,
+    )
 
     return APIGatewayProxyResponseV1(
         statusCode=200,
@@ -79,4 +96,45 @@ def get_url_metrics(event: events.APIGatewayProxyEventV1, ctx: context.Context,
                 for metric in metrics
             ]
         ),
-    )
\ No newline at end of file
+    )
+
+@exception_boundary
+@requires_auth
+def get_url_visitors(event: events.APIGatewayProxyEventV1, ctx: context.Context, user: JwtDTO )-> APIGatewayProxyResponseV1:
+    queries = event.get('queryStringParameters')
+
+    path_params = event.get('pathParameters')
+    if path_params is None:
+        raise WebException(
+            status_code=404,
+            message="Url not found",
+            error_code=ErrorCodes.SHORTURL_NOT_FOUND
+        )
+
+    url = path_params.get('short_url')
+    if url is None:
+        raise WebException(
+            status_code=404,
+            message="Url not found",
+            error_code=ErrorCodes.SHORTURL_NOT_FOUND
+        )
+
+    req = MetricsRangeRequest(**(queries or {}))
+
+    logger.debug("unique visitors requested", user_id=user.id, short_url=url)
+    unique_visitors = metrics_service.get_unique_visitors_by_url(
+        url=url,
+        user_id=user.id,
+        start_day=req.start_date.isoformat(),
+        end_day=req.end_date.isoformat(),
+    )
+
+    return APIGatewayProxyResponseV1(
+        statusCode=200,
+        body=json.dumps({
+            "short_url": url,
+            "start_date": req.start_date.isoformat(),
+            "end_date": req.end_date.isoformat(),
+            "unique_visitors": unique_visitors,
+        }),
+    )
@@ -1,22 +1,31 @@
 from app.repository.metrics_repo import MetricsRepository
 from app.service.metrics import MetricsService
+from app.service.metrics_counters import MetricsCounters
 from app.service.subscription_service import SubscriptionService
 from app.service.rate_limiter import RateLimitingService
+from app.service.code_filter import ShortCodeFilter
+from app.service.hot_keys import HotKeyTracker
+from app.service.counter_allocator import CounterAllocator
 from app.errors.web_errors import exception_boundary
 import json
 import os
 
 from app.dtos.auth import JwtDTO
-from app.dtos.short_url import CreateShortURLRequest
+from app.dtos.short_url import CreateShortURLRequest, CreateShortURLsRequest, ListShortURLsRequest
 from aws_lambda_typing.responses import APIGatewayProxyResponseV2
 
 from app.utils.auth_decorator import requires_auth
+from app.utils.local_cache import LocalCache
 from app.repository.short_url_repo import ShortURLRepository
 import boto3
 from redis import Redis
 from aws_lambda_typing import events, context
 
 from app.service.url_service import ShortURLService
+from app.constants import L1_CACHE_MAX_BYTES, L1_CACHE_TTL, RATE_LIMIT_LEASE_SIZE, LOG_HOT_PATH_SAMPLE
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
 
 redis_endpoint = os.environ.get('REDIS_ENDPOINT',"localhost")
 
@@ -27,9 +36,23 @@ sqs_client = boto3.client('sqs')
 url_repo = ShortURLRepository(db)
 metrics_repository = MetricsRepository(db)
 
-rate_limiter = RateLimitingService(redis_client)
-url_service = ShortURLService(url_repo, redis_client)
-metrics_service = MetricsService(sqs_client, metrics_repository, url_repo)
+url_cache = LocalCache(max_bytes=L1_CACHE_MAX_BYTES, ttl=L1_CACHE_TTL)
+code_filter = ShortCodeFilter(redis_client)
+hot_keys = HotKeyTracker(redis_client)
+counter_allocator = CounterAllocator(url_repo)
+
+url_service = ShortURLService(url_repo, redis_client, url_cache, code_filter, hot_keys, counter_allocator)
+rate_limiter = RateLimitingService(
+    redis_client,
+    url_service.accept_cached_url,
+    lease_size=RATE_LIMIT_LEASE_SIZE if os.environ.get('RATE_LIMIT_MODE') == "lease" else 0,
+)
+metrics_service = MetricsService(
+    sqs_client,
+    metrics_repository,
+    url_repo,
+    MetricsCounters(redis_client) if os.environ.get('METRICS_MODE') == "redis" else None,
+)
 
 @exception_boundary
 @requires_auth
@@ -38,7 +61,7 @@ def create_shorturl_handler(event:events.APIGatewayProxyEventV1, ctx: context.Co
 
     req = CreateShortURLRequest(**json.loads(body))
 
-    shorturl = url_service.create_short_url(req.url, user.id, user.subscription)
+    shorturl = url_service.create_short_url(req.url, user.id, user.subscription, req.dedupe)
 
     return APIGatewayProxyResponseV2(
         statusCode=201,
@@ -47,17 +70,37 @@ def create_shorturl_handler(event:events.APIGatewayProxyEventV1, ctx: context.Co
         })
     )
 
+@exception_boundary
+@requires_auth
+def create_shorturls_batch_handler(event: events.APIGatewayProxyEventV1, ctx: context.Context, user: JwtDTO) -> APIGatewayProxyResponseV2:
+    body = event['body']
+
+    req = CreateShortURLsRequest(**json.loads(body))
+
+    results = url_service.create_short_urls(req.urls, user.id, user.subscription)
+
+    return APIGatewayProxyResponseV2(
+        statusCode=207 if any("error" in result for result in results) else 201,
+        body=json.dumps({
+            'results': results
+        })
+    )
+
 @exception_boundary
 @rate_limiter.rate_limit
 @metrics_service.track_metrics
 def get_url_handler(event:events.APIGatewayProxyEventV1, ctx: context.Context):
     path_params = event['pathParameters']
 
-    print(event.get("headers"))
+    logger.debug("redirect headers", headers=event.get("headers"), sample=LOG_HOT_PATH_SAMPLE)
     short_url = path_params.get('short_url', None)
 
+    hot_keys.record(short_url)
     url = url_service.get_original_url(short_url)
 
+    return redirect_response(url)
+
+def redirect_response(url: str) -> APIGatewayProxyResponseV2:
     return APIGatewayProxyResponseV2(
         statusCode=302,
         headers={'Location': f"https://{url}" if not url.startswith("http") else url}
@@ -66,8 +109,24 @@ def get_url_handler(event:events.APIGatewayProxyEventV1, ctx: context.Context):
 @exception_boundary
 @requires_auth
 def get_user_short_urls(event: events.APIGatewayProxyEventV1, ctx: context.Context, user: JwtDTO)->APIGatewayProxyResponseV2:
-    urls = url_service.get_urls_by_user(user.id)
+    req = ListShortURLsRequest(**(event.get('queryStringParameters') or {}))
+
+    page = url_service.get_urls_by_user(user.id, req.limit, req.cursor, req.order == "newest")
     return APIGatewayProxyResponseV2(
         statusCode=200,
-        body=json.dumps(urls)
-    )
\ No newline at end of file
+        body=json.dumps(page)
+    )
+
+def rebuild_code_filter(event: events.EventBridgeEvent, ctx: context.Context):
+    added = code_filter.rebuild(url_repo.scan_short_urls())
+    logger.info("short code filter rebuilt", codes=added)
+    return {
+        "codes": added
+    }
+
+def hot_links_report(event: events.EventBridgeEvent, ctx: context.Context):
+    report = hot_keys.report()
+    logger.info("hot links", hot_links=report)
+    return {
+        "hotLinks": report
+    }
@@ -0,0 +1,21 @@
+import asyncio
+
+from redis.asyncio import Redis as AsyncRedis
+from aws_lambda_typing import events, context
+from aws_lambda_typing.responses import APIGatewayProxyResponseV2
+
+from app.errors.web_errors import exception_boundary
+from app.lambdas.url_shortener import redis_endpoint, url_service, metrics_service, redirect_response
+from app.service.async_redirect import AsyncRedirectService
+
+# one loop per container so pooled redis connections survive between invocations
+loop = asyncio.new_event_loop()
+
+async_redis_client = AsyncRedis(host=redis_endpoint, port=6379, db=0, ssl=True, decode_responses=True)
+redirect_service = AsyncRedirectService(async_redis_client, url_service, metrics_service)
+
+@exception_boundary
+def get_url_handler(event: events.APIGatewayProxyEventV1, ctx: context.Context) -> APIGatewayProxyResponseV2:
+    url = loop.run_until_complete(redirect_service.resolve(event))
+
+    return redirect_response(url)
@@ -2,6 +2,7 @@ from decimal import Decimal
 from datetime import date
 from pydantic import ConfigDict, Field
 from enum import Enum
+from typing import Annotated, TypedDict
 
 from pydantic import BaseModel
 
@@ -11,6 +12,14 @@ class DeviceType(str, Enum):
     SMART_TV = "smart_tv"
     TABLET = "tablet"
 
+# capped breakdowns keep the hits of their dropped keys under this key
+OTHER_BUCKET = "(other)"
+
+class MetricsGranularity(str, Enum):
+    HOUR = "hour"
+    DAY = "day"
+    MONTH = "month"
+
 class AccessMetricsSQSMessage(BaseModel):
     url: str
     ip: str
@@ -23,11 +32,19 @@ class AccessMetricsSQSMessage(BaseModel):
 
 class DailyAccessMetrics(BaseModel):
     short_url: str = Field(alias="ShortURL")
+    # the bucket's period: YYYY-MM-DDTHH for hours, YYYY-MM-DD for days, YYYY-MM for months
     day: str = Field(alias="Day")
+    granularity: MetricsGranularity = Field(alias="Granularity", default=MetricsGranularity.DAY)
     total_hits: int = Field(alias="TotalHits")
     by_country: dict = Field(alias="ByCountry")
     by_device_type: dict = Field(alias="ByDeviceType")
     by_referrer: dict = Field(alias="ByReferrer")
+    # how far a capped breakdown's counts may fall short of the real ones
+    country_error: int = Field(alias="CountryError", default=0)
+    referrer_error: int = Field(alias="ReferrerError", default=0)
+    # estimated from the hyperloglog sketch of hashed ip + user agent, day and month buckets only
+    unique_visitors: int = Field(alias="UniqueVisitors", default=0)
+    visitors: bytes | None = Field(exclude=True, default=None)
     message_ids: list[str] = Field(exclude=True, default=[])
     
     model_config = ConfigDict(
@@ -35,3 +52,17 @@ class DailyAccessMetrics(BaseModel):
             Decimal: int
         }
     )
+
+class AccessMetricsRecord(TypedDict):
+    """
+    the fields of an AccessMetricsSQSMessage body the metrics consumer reads,
+    validated as plain dicts in one pass over a batch
+    """
+    url: str
+    ip: str
+    user_agent: str
+    # bounded so every accepted timestamp has a day label
+    timestamp: Annotated[int, Field(ge=0, lt=253402300800)]
+    referrer: str | None
+    country: str
+    device: DeviceType
@@ -1,97 +1,513 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from enum import Enum
+from functools import lru_cache
 from typing import cast
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
-from app.models.metrics import DailyAccessMetrics
-from app.constants import DYNAMO_DB_TABLE_NAME
-from mypy_boto3_dynamodb.service_resource import DynamoDBServiceResource
+from app.models.metrics import DailyAccessMetrics, MetricsGranularity, OTHER_BUCKET
+from app.constants import DYNAMO_DB_TABLE_NAME, METRICS_WRITE_WORKERS, METRICS_TOP_COUNTRIES, METRICS_TOP_REFERRERS, \
+    VISITOR_MERGE_ATTEMPTS, METRICS_TRANSACTION_ATTEMPTS, METRICS_TRANSACTION_BACKOFF
+from app.utils.logger import get_logger
+from app.utils.sketch import HyperLogLog, misra_gries_trim
+from mypy_boto3_dynamodb.service_resource import DynamoDBServiceResource, Table
+
+logger = get_logger(__name__)
+
+# each country, device and referrer count is its own top level number on the
+# day item, e.g. "C#IN", so a single ADD both creates and increments it
+_COUNT_PREFIXES = {"c": "C#", "d": "D#", "r": "R#"}
+_COUNT_ATTRIBUTES = {"C#": "ByCountry", "D#": "ByDeviceType", "R#": "ByReferrer"}
+# undercount bound of the capped breakdowns, see misra_gries_trim
+_ERROR_ATTRIBUTES = {"C#": "E#C", "R#": "E#R"}
+
+# SHORTURL#<code> / HOUR#YYYY-MM-DDTHH, DAY#YYYY-MM-DD or MONTH#YYYY-MM
+_SORT_KEY_PREFIXES = {
+    MetricsGranularity.HOUR: "HOUR#",
+    MetricsGranularity.DAY: "DAY#",
+    MetricsGranularity.MONTH: "MONTH#",
+}
+_GRANULARITIES = {prefix[:-1]: granularity for granularity, prefix in _SORT_KEY_PREFIXES.items()}
+_ONE_DAY = timedelta(days=1)
+# the day month rollups started being written, see _mark_rollups
+_ROLLUPS_KEY = {"PK": "METRICS", "SK": "ROLLUPS"}
+_VISITOR_MERGE_EXPRESSION = "SET Visitors = :visitors, VisitorsVersion = :next, UniqueVisitors = :count"
+_VISITORS_PROJECTION = "Visitors, VisitorsVersion"
+# a cancelled transaction wrote nothing, these reasons are worth another attempt
+_RETRIED_CANCELLATIONS = {"None", "TransactionConflict", "ThrottlingError", "ProvisionedThroughputExceeded"}
+
+
+def _conflicted(e: Exception) -> bool:
+    if not isinstance(e, ClientError) or e.response['Error']['Code'] != "TransactionCanceledException":
+        return False
+    return all(reason.get("Code") in _RETRIED_CANCELLATIONS for reason in e.response.get("CancellationReasons", []))
+
+
+def _next_month(day: date) -> date:
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def _month_runs(months: list[date]) -> list[tuple[date, date]]:
+    """
+    :return: (first, last) day ranges covering the given months, consecutive months merged
+    """
+    runs: list[tuple[date, date]] = []
+    for month in months:
+        if runs and runs[-1][1] + _ONE_DAY == month:
+            runs[-1] = (runs[-1][0], _next_month(month) - _ONE_DAY)
+        else:
+            runs.append((month, _next_month(month) - _ONE_DAY))
+
+    return runs
+
+
+def _attribute_key(name) -> str:
+    if name is None:
+        return "none"
+    return name.value if isinstance(name, Enum) else name
+
+
+@lru_cache(maxsize=1024)
+def _upsert_expression(countries: int, devices: int, referrers: int, errors: int) -> str:
+    """
+    the update expression only depends on how many counters a metric carries,
+    the names and values are bound through #cN/:cN placeholders
+    """
+    adds = ["TotalHits :total_hits"]
+    for prefix, count in (("c", countries), ("d", devices), ("r", referrers), ("e", errors)):
+        adds.extend(f"#{prefix}{i} :{prefix}{i}" for i in range(count))
+
+    return "SET #url = :url, #day = :day ADD " + ", ".join(adds)
+
+
 class MetricsRepository:
-    def __init__(self, db: DynamoDBServiceResource):
+    def __init__(self, db: DynamoDBServiceResource, workers: int = METRICS_WRITE_WORKERS,
+                 top_countries: int = METRICS_TOP_COUNTRIES, top_referrers: int = METRICS_TOP_REFERRERS):
+        """
+        :param workers: metrics written to dynamodb at the same time by save_metrics
+        :param top_countries: countries kept on a metrics item, 0 keeps all of them
+        :param top_referrers: referrers kept on a metrics item, 0 keeps all of them
+        """
         self.db = db
         self.table = db.Table(DYNAMO_DB_TABLE_NAME)
+        self.workers = max(workers, 1)
+        self._caps = {prefix: k for prefix, k in (("C#", top_countries), ("R#", top_referrers)) if k > 0}
+        # kept across invocations so warm containers reuse the threads and their tables
+        self._executor: ThreadPoolExecutor | None = None
+        self._local = threading.local()
+        self._rollups_marked = False
+        self._rollups_since: date | None = None
+
+    def save_metrics(self, groups: list[list[DailyAccessMetrics]]) -> list[str]:
+        """
+        writes each group of metrics in one transaction, so a message counted
+        in several metrics of a group is counted in all of them or in none and
+        redelivering it cannot count it twice
+
+        a url's groups are written one after another, up to `workers` urls at
+        the same time, so the groups of a batch do not conflict with each other
+        :return: message ids of the groups that could not be written
+        """
+        if groups and not self._rollups_marked:
+            try:
+                self._mark_rollups()
+            except Exception as e:
+                logger.warning("failed to mark rollups", error=str(e))
+                return list(dict.fromkeys(
+                    message_id for group in groups for metric in group for message_id in metric.message_ids
+                ))
+
+        by_url: dict[str, list[list[DailyAccessMetrics]]] = {}
+        for group in groups:
+            if group:
+                by_url.setdefault(group[0].short_url, []).append(group)
+        runs = list(by_url.values())
+
+        if self.workers == 1 or len(runs) <= 1:
+            results = map(self._save_groups, runs)
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="metrics-write")
+            results = self._executor.map(self._save_groups, runs)
 
-    def save_metrics(self, metrics: list[DailyAccessMetrics]):
         failed_messages: list[str] = []
-        for metric in metrics:
+        for failed in results:
+            failed_messages.extend(failed)
+
+        return failed_messages
+
+    def _mark_rollups(self):
+        """
+        records the day month rollups started, before this container writes
+        any; the first writer sets it, so month items are only trusted for
+        months that began after it
+        """
+        try:
+            self.table.put_item(
+                Item={**_ROLLUPS_KEY, "Since": datetime.now(tz=timezone.utc).date().isoformat()},
+                ConditionExpression="attribute_not_exists(PK)",
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != "ConditionalCheckFailedException":
+                raise
+        self._rollups_marked = True
+
+    def _thread_table(self) -> Table:
+        # boto3 resources are not thread safe, each writer thread gets its own
+        if threading.current_thread() is threading.main_thread():
+            return self.table
+
+        table = getattr(self._local, "table", None)
+        if table is None:
+            table = self._local.table = self.db.Table(DYNAMO_DB_TABLE_NAME)
+        return table
+
+    def _save_groups(self, groups: list[list[DailyAccessMetrics]]) -> list[str]:
+        failed: list[str] = []
+        for group in groups:
+            failed.extend(self._save_group(group))
+        return failed
+
+    def _save_group(self, group: list[DailyAccessMetrics]) -> list[str]:
+        try:
+            if len(group) == 1:
+                self._write_metric(self._thread_table(), group[0])
+            else:
+                self._write_group(self._thread_table(), group)
+        except Exception as e:
+            logger.warning("failed to save metrics", short_url=group[0].short_url, day=group[0].day, error=str(e))
+            return list(dict.fromkeys(message_id for metric in group for message_id in metric.message_ids))
+
+        return []
+
+    def _write_metric(self, table: Table, metric: DailyAccessMetrics):
+        update = self._upsert(metric)
+        # the item comes back so capped breakdowns and the stored visitor
+        # sketch can be checked without a read
+        returns_item = bool(self._caps) or metric.visitors is not None
+        res = table.update_item(**update, ReturnValues="ALL_NEW" if returns_item else "NONE")
+        self._settle(table, update["Key"], metric, res.get("Attributes", {}))
+
+    def _write_group(self, table: Table, group: list[DailyAccessMetrics]):
+        updates = [self._upsert(metric) for metric in group]
+        transact_items = [{"Update": {"TableName": DYNAMO_DB_TABLE_NAME, **update}} for update in updates]
+        for attempt in range(METRICS_TRANSACTION_ATTEMPTS):
+            if attempt:
+                time.sleep(METRICS_TRANSACTION_BACKOFF * 2 ** (attempt - 1))
             try:
-                self.table.put_item(
-                    Item={
-                        "PK": f"SHORTURL#{metric.short_url}",
-                        "SK": f"DAY#{metric.day}",
-                        **metric.model_dump(by_alias=True),
-                    },
-                    ConditionExpression="attribute_not_exists(PK) and  attribute_not_exists(SK)",
-                )
+                self.db.meta.client.transact_write_items(TransactItems=transact_items)
+                break
+            except Exception as e:
+                if attempt + 1 == METRICS_TRANSACTION_ATTEMPTS or not _conflicted(e):
+                    raise
+
+        # a transaction hands no items back, the ones to settle are read again:
+        # day and month items for their visitors, and items this write may
+        # have taken past a cap. projections cannot select the C#/R# names,
+        # so only a read for the visitors alone is narrowed
+        for metric, update in zip(group, updates):
+            compact = bool(self._caps) and (metric.visitors is not None or self._fills_cap(metric))
+            if not compact and metric.visitors is None:
                 continue
-            except ClientError as e:
-                if e.response['Error']['Code'] != "ConditionalCheckFailedException":
-                    failed_messages.extend(metric.message_ids)
-                    continue
-
-            update_parts: list[str] = []
-            expr_names: dict[str, str] = {}
-            expr_values: dict[str, int | dict] = {
-                ":zero": 0,
-            }
+            read = {} if compact else {"ProjectionExpression": _VISITORS_PROJECTION}
+            try:
+                item = table.get_item(Key=update["Key"], ConsistentRead=True, **read).get("Item", {})
+            except Exception as e:
+                # the counts are already written, failing here would count them twice
+                logger.warning("failed to read back metrics", key=update["Key"]["SK"], error=str(e))
+                continue
+            self._settle(table, update["Key"], metric, item, compact)
 
-            # Total hits
-            update_parts.append(
-                "TotalHits = if_not_exists(TotalHits, :zero) + :total_hits"
-            )
-            expr_values[":total_hits"] = metric.total_hits
-
-            # ByCountry
-            for i, (country, count) in enumerate(metric.by_country.items()):
-                key = f"#c{i}"
-                val = f":c{i}"
-                update_parts.append(
-                    f"ByCountry.{key} = if_not_exists(ByCountry.{key}, :zero) + {val}"
-                )
-                expr_names[key] = country
-                expr_values[val] = count
-
-            # ByDeviceType
-            for i, (device, count) in enumerate(metric.by_device_type.items()):
-                key = f"#d{i}"
-                val = f":d{i}"
-                update_parts.append(
-                    f"ByDeviceType.{key} = if_not_exists(ByDeviceType.{key}, :zero) + {val}"
-                )
-                expr_names[key] = device
-                expr_values[val] = count
-
-            # ByReferrer
-            for i, (ref, count) in enumerate(metric.by_referrer.items()):
-                key = f"#r{i}"
-                val = f":r{i}"
-                update_parts.append(
-                    f"ByReferrer.{key} = if_not_exists(ByReferrer.{key}, :zero) + {val}"
+    def _fills_cap(self, metric: DailyAccessMetrics) -> bool:
+        """
+        :return: whether the metric brings k or more keys of a capped
+            breakdown; a stored breakdown is trimmed back to k keys, so one
+            with fewer keys of its own rarely takes it past twice the cap
+        """
+        for prefix, k in self._caps.items():
+            counts = metric.by_country if prefix == "C#" else metric.by_referrer
+            if len(counts) - (OTHER_BUCKET in counts) >= k:
+                return True
+        return False
+
+    def _settle(self, table: Table, key: dict, metric: DailyAccessMetrics, item: dict, compact: bool = True):
+        """
+        compacts the written item and merges the metric's visitors into it
+        """
+        if self._caps and compact:
+            self._compact(table, key, item)
+        if metric.visitors is not None:
+            self._merge_visitors(table, key, HyperLogLog.from_bytes(metric.visitors), item)
+
+    @staticmethod
+    def _upsert(metric: DailyAccessMetrics) -> dict:
+        """
+        :return: Key and update expression adding the metric's counts to its item
+        """
+        countries = list(metric.by_country.items())
+        devices = list(metric.by_device_type.items())
+        referrers = list(metric.by_referrer.items())
+        errors = [
+            (name, error)
+            for name, error in (("E#C", metric.country_error), ("E#R", metric.referrer_error))
+            if error
+        ]
+
+        expr_names = {"#url": "ShortURL", "#day": "Day"}
+        expr_values: dict[str, str | int] = {
+            ":url": metric.short_url,
+            ":day": metric.day,
+            ":total_hits": metric.total_hits,
+        }
+        for prefix, counts in (("c", countries), ("d", devices), ("r", referrers)):
+            attribute_prefix = _COUNT_PREFIXES[prefix]
+            for i, (name, count) in enumerate(counts):
+                expr_names[f"#{prefix}{i}"] = attribute_prefix + _attribute_key(name)
+                expr_values[f":{prefix}{i}"] = count
+        for i, (name, error) in enumerate(errors):
+            expr_names[f"#e{i}"] = name
+            expr_values[f":e{i}"] = error
+
+        return {
+            "Key": {
+                "PK": f"SHORTURL#{metric.short_url}",
+                "SK": f"{_SORT_KEY_PREFIXES[metric.granularity]}{metric.day}",
+            },
+            "UpdateExpression": _upsert_expression(len(countries), len(devices), len(referrers), len(errors)),
+            "ExpressionAttributeNames": expr_names,
+            "ExpressionAttributeValues": expr_values,
+        }
+
+    def _merge_visitors(self, table: Table, key: dict, sketch: HyperLogLog, item: dict):
+        """
+        merges the batch's visitor sketch into the one stored on the item
+
+        the sketch is written back conditioned on the VisitorsVersion that was
+        read, a writer that lost the race reads the item again and retries.
+        merging is idempotent, so a retried batch does not inflate the count
+        """
+        for _ in range(VISITOR_MERGE_ATTEMPTS):
+            version = int(item.get("VisitorsVersion", 0))
+            stored = item.get("Visitors")
+            merged = sketch
+            if stored is not None:
+                try:
+                    merged = HyperLogLog.from_bytes(bytes(stored))
+                except ValueError as e:
+                    logger.warning("replacing unreadable visitor sketch", key=key["SK"], error=str(e))
+                else:
+                    if not merged.merge(sketch):
+                        return
+
+            condition = "VisitorsVersion = :version" if version else "attribute_not_exists(VisitorsVersion)"
+            expr_values = {":visitors": merged.to_bytes(), ":next": version + 1, ":count": merged.count()}
+            if version:
+                expr_values[":version"] = version
+            try:
+                table.update_item(
+                    Key=key,
+                    UpdateExpression=_VISITOR_MERGE_EXPRESSION,
+                    ConditionExpression=condition,
+                    ExpressionAttributeValues=expr_values,
                 )
-                expr_names[key] = ref
-                expr_values[val] = count
-
-            self.table.update_item(
-                Key={
-                    "PK": f"SHORTURL#{metric.short_url}",
-                    "SK": f"DAY#{metric.day}",
-                },
-                UpdateExpression="SET " + ", ".join(update_parts),
-                ExpressionAttributeNames=expr_names,
-                ExpressionAttributeValues=expr_values,
-            )
+                return
+            except Exception as e:
+                # the counts are already written, failing here would count them twice
+                raced = isinstance(e, ClientError) and e.response['Error']['Code'] == "ConditionalCheckFailedException"
+                if not raced:
+                    logger.warning("failed to merge visitors", key=key["SK"], error=str(e))
+                    return
 
-        return failed_messages
+            item = table.get_item(
+                Key=key,
+                ProjectionExpression=_VISITORS_PROJECTION,
+                ConsistentRead=True,
+            ).get("Item", {})
+
+        logger.warning("gave up merging visitors", key=key["SK"], attempts=VISITOR_MERGE_ATTEMPTS)
+
+    def _compact(self, table: Table, key: dict, item: dict):
+        """
+        trims a capped breakdown on the stored item back to its top k once it
+        holds twice that many keys, so the item stays around a fixed size
+
+        the dropped attributes must still hold the counts that were read; if
+        another write moved them the trim is left to a later write
+        """
+        for prefix, k in self._caps.items():
+            other_name = prefix + OTHER_BUCKET
+            counts = {
+                name: int(count)
+                for name, count in item.items()
+                if name.startswith(prefix) and name != other_name
+            }
+            if len(counts) <= 2 * k:
+                continue
+
+            kept, removed, threshold = misra_gries_trim(counts, k)
+            expr_names = {"#other": other_name, "#error": _ERROR_ATTRIBUTES[prefix]}
+            expr_values = {":removed": removed, ":threshold": threshold, ":decrement": -threshold}
+            removes: list[str] = []
+            conditions: list[str] = []
+            adds = ["#other :removed", "#error :threshold"]
+            for i, name in enumerate(name for name in counts if name not in kept):
+                expr_names[f"#x{i}"] = name
+                expr_values[f":x{i}"] = counts[name]
+                removes.append(f"#x{i}")
+                conditions.append(f"#x{i} = :x{i}")
+            for i, name in enumerate(kept):
+                expr_names[f"#k{i}"] = name
+                adds.append(f"#k{i} :decrement")
 
-    def get_url_metrics(self, start_day: str, end_day: str, url: str) -> list[DailyAccessMetrics]:
-        metrics_query = self.table.query(
-            KeyConditionExpression=Key("PK").eq(f"SHORTURL#{url}") & Key("SK").between(f"DAY#{start_day}", f"DAY#{end_day}"),
-        ).get("Items", [])
+            try:
+                table.update_item(
+                    Key=key,
+                    UpdateExpression=f"REMOVE {', '.join(removes)} ADD {', '.join(adds)}",
+                    ConditionExpression=" AND ".join(conditions),
+                    ExpressionAttributeNames=expr_names,
+                    ExpressionAttributeValues=expr_values,
+                )
+            except Exception as e:
+                # the counts are already written, failing here would count them twice
+                raced = isinstance(e, ClientError) and e.response['Error']['Code'] == "ConditionalCheckFailedException"
+                if not raced:
+                    logger.warning("failed to compact metrics", key=key["SK"], error=str(e))
 
-        if len(metrics_query) == 0:
+    def get_url_metrics(self, start_day: str, end_day: str, url: str,
+                        granularity: MetricsGranularity | None = None) -> list[DailyAccessMetrics]:
+        """
+        :param granularity: bucket size to read, by default the range is
+            covered with as few items as plan_ranges can
+        """
+        if granularity is MetricsGranularity.HOUR:
+            return self._query_range(url, f"HOUR#{start_day}T00", f"HOUR#{end_day}T23")
+        if granularity is MetricsGranularity.DAY:
+            return self._query_range(url, f"DAY#{start_day}", f"DAY#{end_day}")
+        if granularity is MetricsGranularity.MONTH:
+            return self._query_range(url, f"MONTH#{start_day[:7]}", f"MONTH#{end_day[:7]}")
+
+        start, end = date.fromisoformat(start_day), date.fromisoformat(end_day)
+        if start > end:
             return []
 
+        months, days = self.plan_ranges(start, end)
+        metrics: list[DailyAccessMetrics] = []
+        if months:
+            # the month the rollups started in only has part of its hits on
+            # its item, and consumers still running without rollups may write
+            # days alone for a little while after the marker
+            since = self._rollups_started()
+            covered = [month for month in months if since is not None and month > since + _ONE_DAY]
+            days.extend(_month_runs([month for month in months if month not in covered]))
+            if covered:
+                metrics.extend(self._query_range(url, f"MONTH#{covered[0]:%Y-%m}", f"MONTH#{covered[-1]:%Y-%m}"))
+
+        for first, last in days:
+            metrics.extend(self._query_range(url, f"DAY#{first}", f"DAY#{last}"))
+
+        # a month label sorts before the days inside it and after the ones before it
+        return sorted(metrics, key=lambda metric: metric.day)
+
+    def get_unique_visitors(self, start_day: str, end_day: str, url: str) -> int:
+        """
+        unions the visitor sketches of the month and day items covering the
+        range, so a visitor seen on several days is counted once
+        """
+        sketches: list[HyperLogLog] = []
+        for metric in self.get_url_metrics(start_day=start_day, end_day=end_day, url=url):
+            if metric.visitors is None:
+                continue
+            try:
+                sketches.append(HyperLogLog.from_bytes(metric.visitors))
+            except ValueError as e:
+                logger.warning("skipping unreadable visitor sketch", short_url=url, day=metric.day, error=str(e))
+
+        merged = HyperLogLog.union(sketches)
+        return merged.count() if merged is not None else 0
+
+    def _rollups_started(self) -> date | None:
+        """
+        :return: the day month rollups started, None before any was written
+        """
+        if self._rollups_since is None:
+            item = self.table.get_item(Key=_ROLLUPS_KEY).get("Item")
+            if item is not None:
+                self._rollups_since = date.fromisoformat(str(item["Since"]))
+        return self._rollups_since
+
+    @staticmethod
+    def plan_ranges(start: date, end: date) -> tuple[list[date], list[tuple[date, date]]]:
+        """
+        splits [start, end] into the calendar months it fully covers and the
+        days left over at its edges
+        :return: first days of the covered months, (first, last) day ranges
+        """
+        month = start if start.day == 1 else _next_month(start)
+        months: list[date] = []
+        while _next_month(month) - _ONE_DAY <= end:
+            months.append(month)
+            month = _next_month(month)
+
+        if not months:
+            return [], [(start, end)]
+
+        days: list[tuple[date, date]] = []
+        if start < months[0]:
+            days.append((start, months[0] - _ONE_DAY))
+        after = _next_month(months[-1])
+        if after <= end:
+            days.append((after, end))
+
+        return months, days
+
+    def _query_range(self, url: str, first_sort_key: str, last_sort_key: str) -> list[DailyAccessMetrics]:
+        query_kwargs = {
+            "KeyConditionExpression": Key("PK").eq(f"SHORTURL#{url}") & Key("SK").between(first_sort_key, last_sort_key),
+        }
+
+        items: list[dict] = []
+        while True:
+            res = self.table.query(**query_kwargs)
+            items.extend(res.get("Items", []))
+            last_key = res.get("LastEvaluatedKey")
+            if not last_key:
+                break
+            query_kwargs["ExclusiveStartKey"] = last_key
+
         return [
-            DailyAccessMetrics(
-                **cast(dict, metric)
-            )
-            for metric in metrics_query
-        ]
\ No newline at end of file
+            self._metric_from_item(cast(dict, metric))
+            for metric in items
+        ]
+
+    @staticmethod
+    def _metric_from_item(item: dict) -> DailyAccessMetrics:
+        """
+        folds the flat C#/D#/R# counters into the by_* maps, adding the maps
+        that day items written before the flat layout still carry
+        """
+        maps: dict[str, dict[str, int]] = {}
+        for prefix, attribute in _COUNT_ATTRIBUTES.items():
+            maps[prefix] = {name: int(count) for name, count in item.get(attribute, {}).items()}
+
+        for name, count in item.items():
+            prefix = name[:2]
+            if prefix in maps:
+                key = name[2:]
+                maps[prefix][key] = maps[prefix].get(key, 0) + int(count)
+
+        return DailyAccessMetrics(
+            ShortURL=item["ShortURL"],
+            Day=item["Day"],
+            Granularity=_GRANULARITIES.get(item.get("SK", "").partition("#")[0], MetricsGranularity.DAY),
+            TotalHits=item.get("TotalHits", 0),
+            ByCountry=maps["C#"],
+            ByDeviceType=maps["D#"],
+            ByReferrer=maps["R#"],
+            CountryError=item.get("E#C", 0),
+            ReferrerError=item.get("E#R", 0),
+            UniqueVisitors=item.get("UniqueVisitors", 0),
+            # boto3 hands binary attributes back wrapped in Binary
+            visitors=bytes(item["Visitors"]) if "Visitors" in item else None,
+        )
\ No newline at end of file
@@ -1,13 +1,23 @@
-from typing import List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List
 
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
 from mypy_boto3_dynamodb.service_resource import DynamoDBServiceResource
 from mypy_boto3_dynamodb.type_defs import TransactWriteItemTypeDef, PutItemInputTypeDef
 
-from app.constants import DYNAMO_DB_TABLE_NAME
+from app.constants import DYNAMO_DB_TABLE_NAME, BATCH_WRITE_WORKERS, BATCH_WRITE_MAX_ATTEMPTS, BATCH_WRITE_BACKOFF, \
+    OWNER_CREATED_INDEX
 from app.errors.web_errors import WebException, ErrorCodes
 from app.models import short_url
 from app.models.short_url import ShortUrl
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# batch write errors worth another attempt, anything else fails the same way again
+_THROTTLING_ERRORS = {"ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded"}
 
 
 class ShortURLRepository:
@@ -32,25 +42,99 @@ class ShortURLRepository:
 
         return url_item["URL"]
 
-    def get_urls_by_user_id(self, user_id: str) -> List[str]:
-        url_items = self.table.query(
-            KeyConditionExpression=Key("PK").eq(f"USER#{user_id}")&Key("SK").begins_with("SHORTURL")
-        ).get("Items")
+    def get_urls_by_user_id(self, user_id: str, limit: int, start_key: dict | None = None,
+                            newest_first: bool = True) -> tuple[List[ShortUrl], dict | None]:
+        """
+        reads one page of the user's short urls in creation order from the
+        owner mappings, which carry the listing attributes
+        :return: the short urls and the key to continue from, None on the last page
+        """
+        query_kwargs = {
+            "IndexName": OWNER_CREATED_INDEX,
+            "KeyConditionExpression": Key("ListedBy").eq(user_id),
+            "ProjectionExpression": "#id, #url, #short_url, #owner_id, #created_at",
+            "ExpressionAttributeNames": {
+                "#id": "ID",
+                "#url": "URL",
+                "#short_url": "ShortURL",
+                "#owner_id": "OwnerID",
+                "#created_at": "CreatedAt",
+            },
+            "ScanIndexForward": not newest_first,
+            "Limit": limit,
+        }
+        if start_key is not None:
+            query_kwargs["ExclusiveStartKey"] = start_key
+
+        page = self.table.query(**query_kwargs)
+        url_items = page.get("Items", [])
 
         return [
-            str(item['SK']).split('#')[-1]
+            ShortUrl(**item)
             for item in url_items
-        ]
+        ], page.get("LastEvaluatedKey")
+
+    def owns_url(self, user_id: str, short_url: str) -> bool:
+        item = self.table.get_item(
+            Key={
+                "PK": f"USER#{user_id}",
+                "SK": f"SHORTURL#{short_url}",
+            },
+            ProjectionExpression="PK",
+        ).get("Item")
+
+        return item is not None
+
+    def scan_short_urls(self) -> Iterator[str]:
+        """
+        yields every issued short code, page by page
+        """
+        for item in self._scan_details(ProjectionExpression="ShortURL"):
+            yield str(item["ShortURL"])
 
-    def add_url(self, short_url: ShortUrl):
+    def scan_url_details(self) -> Iterator[ShortUrl]:
+        """
+        yields every short url with its details, page by page
+        """
+        for item in self._scan_details():
+            yield ShortUrl(**item)
+
+    def _scan_details(self, **scan_kwargs) -> Iterator[dict]:
+        scan_kwargs["FilterExpression"] = Attr("PK").begins_with("SHORTURL#") & Attr("SK").eq("DETAILS")
+
+        while True:
+            page = self.table.scan(**scan_kwargs)
+            yield from page.get("Items", [])
+
+            last_key = page.get("LastEvaluatedKey")
+            if last_key is None:
+                return
+            scan_kwargs["ExclusiveStartKey"] = last_key
+
+    def get_short_url_by_hash(self, user_id: str, url_hash: str, consistent: bool = False) -> str | None:
+        """
+        :return: the user's short code for the destination with this hash, if any
+        """
+        item = self.table.get_item(
+            Key={
+                "PK": f"USER#{user_id}",
+                "SK": f"URLHASH#{url_hash}",
+            },
+            ProjectionExpression="ShortURL",
+            ConsistentRead=consistent,
+        ).get("Item")
+
+        return None if item is None else str(item["ShortURL"])
+
+    def add_url(self, short_url: ShortUrl, url_hash: str | None = None):
+        """
+        :param url_hash: also indexes the url under the owner by this hash, the
+            transaction is cancelled when the owner already has it indexed
+        """
         put_short_url: TransactWriteItemTypeDef = {
             "Put": PutItemInputTypeDef(
                 TableName=DYNAMO_DB_TABLE_NAME,
-                Item={
-                    "PK": f"SHORTURL#{short_url.short_url}",
-                    "SK": f"DETAILS",
-                    **short_url.model_dump(by_alias=True)
-                },
+                Item=self._details_item(short_url),
                 ConditionExpression="attribute_not_exists(PK) and attribute_not_exists(SK)"
             )
         }
@@ -58,22 +142,143 @@ class ShortURLRepository:
         put_owner_mapping: TransactWriteItemTypeDef = {
             "Put": PutItemInputTypeDef(
                 TableName=DYNAMO_DB_TABLE_NAME,
-                Item={
-                    "PK": f"USER#{short_url.owner_id}",
-                    "SK": f"SHORTURL#{short_url.short_url}",
-                },
+                Item=self._owner_item(short_url),
                 ConditionExpression="attribute_not_exists(PK) and attribute_not_exists(SK)"
             ),
         }
 
+        transact_items = [put_short_url, put_owner_mapping]
+        if url_hash is not None:
+            transact_items.append({
+                "Put": PutItemInputTypeDef(
+                    TableName=DYNAMO_DB_TABLE_NAME,
+                    Item={
+                        "PK": f"USER#{short_url.owner_id}",
+                        "SK": f"URLHASH#{url_hash}",
+                        "ShortURL": short_url.short_url,
+                    },
+                    ConditionExpression="attribute_not_exists(PK) and attribute_not_exists(SK)"
+                ),
+            })
+
         self.db.meta.client.transact_write_items(
-            TransactItems=[put_short_url, put_owner_mapping],
+            TransactItems=transact_items,
         )
 
+    def add_urls(self, short_urls: list[ShortUrl]) -> set[str]:
+        """
+        writes many short urls with parallel BatchWriteItem calls, retrying
+        unprocessed items with backoff
+
+        unlike add_url the writes are unconditional, the codes come from
+        reserved counter ranges so they cannot already exist
+        :return: short codes whose items could not all be written, the ones
+            of them that were are deleted again
+        """
+        # a url's two items stay in the same request, 12 urls fill the 25 item limit
+        return self._batch_put(short_urls, 12, lambda short_url: (self._details_item(short_url),
+                                                                   self._owner_item(short_url)))
+
+    def put_owner_mappings(self, short_urls: list[ShortUrl]) -> set[str]:
+        """
+        (re)writes the owner mappings of existing short urls with their listing attributes
+        :return: short codes whose mapping could not be written
+        """
+        return self._batch_put(short_urls, 25, lambda short_url: (self._owner_item(short_url),))
+
+    def _batch_put(self, short_urls: list[ShortUrl], per_request: int,
+                   items_of: Callable[[ShortUrl], tuple[dict, ...]]) -> set[str]:
+        chunks = [short_urls[i:i + per_request] for i in range(0, len(short_urls), per_request)]
+        if not chunks:
+            return set()
+
+        with ThreadPoolExecutor(max_workers=min(BATCH_WRITE_WORKERS, len(chunks))) as executor:
+            failed = set()
+            for chunk_failed in executor.map(lambda chunk: self._write_chunk(chunk, items_of), chunks):
+                failed |= chunk_failed
+
+        return failed
+
+    def _write_chunk(self, short_urls: list[ShortUrl], items_of: Callable[[ShortUrl], tuple[dict, ...]]) -> set[str]:
+        """
+        the items of a url that were written while others of it were not are
+        deleted again, so a failed url is not left with a details item and
+        no owner mapping or the other way around
+        """
+        requests = [
+            {"PutRequest": {"Item": item}}
+            for short_url in short_urls
+            for item in items_of(short_url)
+        ]
+
+        unprocessed = self._batch_write(requests)
+        if not unprocessed:
+            return set()
+
+        failed = {str(request["PutRequest"]["Item"]["ShortURL"]) for request in unprocessed}
+        pending = {(request["PutRequest"]["Item"]["PK"], request["PutRequest"]["Item"]["SK"]) for request in unprocessed}
+        written = [
+            {"DeleteRequest": {"Key": {"PK": item["PK"], "SK": item["SK"]}}}
+            for short_url in short_urls
+            if short_url.short_url in failed
+            for item in items_of(short_url)
+            if (item["PK"], item["SK"]) not in pending
+        ]
+        if written and self._batch_write(written):
+            logger.warning("failed to remove half written short urls", short_urls=sorted(failed))
+
+        return failed
+
+    def _batch_write(self, requests: list[dict]) -> list[dict]:
+        """
+        :return: the requests still unprocessed after all attempts
+        """
+        for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(BATCH_WRITE_BACKOFF * 2 ** (attempt - 1))
+            try:
+                res = self.db.meta.client.batch_write_item(RequestItems={DYNAMO_DB_TABLE_NAME: requests})
+            except Exception as e:
+                logger.warning("batch write failed", items=len(requests), error=str(e))
+                if isinstance(e, ClientError) and e.response['Error']['Code'] in _THROTTLING_ERRORS:
+                    continue
+                break
+
+            requests = res.get("UnprocessedItems", {}).get(DYNAMO_DB_TABLE_NAME, [])
+            if not requests:
+                return []
+
+        return requests
+
+    @staticmethod
+    def _details_item(short_url: ShortUrl) -> dict:
+        return {
+            "PK": f"SHORTURL#{short_url.short_url}",
+            "SK": f"DETAILS",
+            **short_url.model_dump(by_alias=True)
+        }
+
+    @staticmethod
+    def _owner_item(short_url: ShortUrl) -> dict:
+        # ListedBy keys the sparse OWNER_CREATED_INDEX, details items lack it
+        return {
+            "PK": f"USER#{short_url.owner_id}",
+            "SK": f"SHORTURL#{short_url.short_url}",
+            "ListedBy": short_url.owner_id,
+            **short_url.model_dump(by_alias=True)
+        }
+
     def get_counter(self) -> int:
         """
         increments dynamo counter by 1 and returns it
         """
+        return self.get_counter_range(1)[0]
+
+    def get_counter_range(self, size: int) -> range:
+        """
+        reserves the next `size` counter values with a single increment
+        :return: the reserved values
+        """
         res = self.table.update_item(
             Key={
                 "PK": "SHORTURL",
@@ -81,10 +286,10 @@ class ShortURLRepository:
             },
             UpdateExpression="SET CurrentCount = CurrentCount + :inc",
             ExpressionAttributeValues={
-                ":inc": 1,
+                ":inc": size,
             },
             ReturnValues='UPDATED_NEW',
         )
 
-        count = res.get('Attributes').get('CurrentCount')
-        return count
\ No newline at end of file
+        count = int(res.get('Attributes').get('CurrentCount'))
+        return range(count - size + 1, count + 1)
@@ -0,0 +1,36 @@
+"""
+copies the listing attributes of every short url onto its owner mapping so
+it shows up in the OwnerCreatedAt index; safe to rerun
+
+    python -m app.scripts.backfill_owner_mappings
+"""
+import json
+from itertools import islice
+
+import boto3
+
+from app.constants import BACKFILL_BATCH_SIZE
+from app.repository.short_url_repo import ShortURLRepository
+
+
+def backfill(url_repo: ShortURLRepository, batch_size: int = BACKFILL_BATCH_SIZE) -> dict:
+    details = url_repo.scan_url_details()
+    state = {"written": 0, "failed": []}
+
+    while batch := list(islice(details, batch_size)):
+        failed = url_repo.put_owner_mappings(batch)
+        state["written"] += len(batch) - len(failed)
+        state["failed"].extend(sorted(failed))
+        print(json.dumps({"backfill": {"written": state["written"], "failed": len(state["failed"])}}))
+
+    return state
+
+
+def main():
+    state = backfill(ShortURLRepository(boto3.resource('dynamodb')))
+    if state["failed"]:
+        print(f"failed to backfill: {' '.join(state['failed'])}")
+
+
+if __name__ == "__main__":
+    main()
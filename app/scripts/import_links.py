@@ -0,0 +1,67 @@
+"""
+bulk imports links from a .csv (with a header row) or .jsonl file
+
+    python -m app.scripts.import_links links.jsonl --checkpoint links.ckpt --results links.out.jsonl
+
+records need a url and an owner_id (or --owner); subscription (std/pro) and
+created_at (epoch seconds) are optional. rerunning with the same checkpoint
+resumes after the last imported batch. set REDIS_ENDPOINT so the imported
+codes are added to the short code filter, otherwise rebuild it afterwards
+"""
+import argparse
+import os
+
+import boto3
+from redis import Redis
+
+from app.constants import IMPORT_BATCH_SIZE, IMPORT_WORKERS, IMPORT_MAX_IN_FLIGHT
+from app.models.subscriptions import Subscription
+from app.repository.short_url_repo import ShortURLRepository
+from app.service.code_filter import ShortCodeFilter
+from app.service.link_importer import LinkImporter, read_records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bulk import links into the url shortener")
+    parser.add_argument("path", help=".csv or .jsonl file to import")
+    parser.add_argument("--owner", help="owner id for records without one")
+    parser.add_argument("--subscription", default=Subscription.STANDARD.value,
+                        choices=[subscription.value for subscription in Subscription],
+                        help="subscription for records without one")
+    parser.add_argument("--checkpoint", help="progress file, an existing one is resumed")
+    parser.add_argument("--results", help="jsonl file receiving each record's short url or error")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=IMPORT_WORKERS)
+    parser.add_argument("--max-in-flight", type=int, default=IMPORT_MAX_IN_FLIGHT)
+    args = parser.parse_args()
+
+    url_repo = ShortURLRepository(boto3.resource('dynamodb'))
+
+    code_filter = None
+    redis_endpoint = os.environ.get('REDIS_ENDPOINT')
+    if redis_endpoint:
+        code_filter = ShortCodeFilter(Redis(host=redis_endpoint, port=6379, db=0, ssl=True, decode_responses=True))
+    else:
+        print("REDIS_ENDPOINT is not set, rebuild the short code filter once the import is done")
+
+    importer = LinkImporter(
+        url_repo,
+        code_filter,
+        default_owner=args.owner,
+        default_subscription=Subscription(args.subscription),
+        batch_size=args.batch_size,
+        workers=args.workers,
+        max_in_flight=args.max_in_flight,
+        checkpoint_path=args.checkpoint,
+    )
+
+    results = open(args.results, "a", encoding="utf-8") if args.results else None
+    try:
+        importer.run(read_records(args.path), results)
+    finally:
+        if results is not None:
+            results.close()
+
+
+if __name__ == "__main__":
+    main()
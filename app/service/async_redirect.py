@@ -0,0 +1,89 @@
+import asyncio
+
+from aws_lambda_typing import events
+from redis.asyncio import Redis as AsyncRedis
+
+from app.constants import NEGATIVE_CACHE_MARKER, METRICS_FLUSH_TIMEOUT
+from app.service.metrics import MetricsService
+from app.service.rate_limiter import RateLimitingService, REDIRECT_SCRIPT
+from app.service.url_service import ShortURLService
+from app.utils.cache_keys import rate_limit_key, url_cache_key
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class AsyncRedirectService:
+    """
+    asyncio version of the redirect pipeline behind rate_limit, track_metrics
+    and get_original_url
+
+    redis is awaited directly, blocking calls run on the default executor;
+    the metrics publish overlaps with the lookup. cache misses go through the
+    url service's stampede protected load so both handlers share its
+    single flight and redis lock
+    """
+
+    def __init__(self, redis_client: AsyncRedis, url_service: ShortURLService, metrics_service: MetricsService):
+        self.redis_client = redis_client
+        self.url_service = url_service
+        self.metrics_service = metrics_service
+        self._redirect_script = redis_client.register_script(REDIRECT_SCRIPT)
+
+    async def resolve(self, event: events.APIGatewayProxyEventV1) -> str:
+        """
+        :return: the original url for the event's short code
+        """
+        short_url = RateLimitingService.short_url_from_event(event)
+        rate = RateLimitingService.limit_for(short_url)
+        key = rate_limit_key(short_url, RateLimitingService.current_window())
+
+        count, cached_url, ttl_ms = await self._redirect_script(keys=[key, url_cache_key(short_url)], args=[60])
+        if int(count) > rate:
+            raise RateLimitingService.too_many_requests()
+
+        # counted before the lookup, like the sync handler
+        if self.url_service.hot_keys is not None:
+            self.url_service.hot_keys.record(short_url)
+
+        background = [asyncio.create_task(self._publish_metrics(event))]
+        try:
+            return await self._lookup(short_url, cached_url, int(ttl_ms))
+        finally:
+            await asyncio.gather(*background, return_exceptions=True)
+
+    async def _lookup(self, short_url: str, cached_url: str | None, ttl_ms: int) -> str:
+        url_service = self.url_service
+        if cached_url:
+            if cached_url == NEGATIVE_CACHE_MARKER or not url_service.should_refresh_early(ttl_ms):
+                url_service.cache_locally(short_url, cached_url)
+                return url_service.found_or_raise(cached_url)
+
+            return url_service.found_or_raise(await asyncio.to_thread(url_service.load_url, short_url, cached_url))
+
+        local_cache = url_service.local_cache
+        if local_cache is not None:
+            local_url = local_cache.get(short_url)
+            if local_url is not None:
+                return url_service.found_or_raise(local_url)
+
+        code_filter = url_service.code_filter
+        if code_filter is not None and not await asyncio.to_thread(code_filter.might_contain, short_url):
+            url_service.found_or_raise(NEGATIVE_CACHE_MARKER)
+
+        return url_service.found_or_raise(await asyncio.to_thread(url_service.load_url, short_url))
+
+    async def _publish_metrics(self, event: events.APIGatewayProxyEventV1):
+        if self.metrics_service.counters is not None:
+            await asyncio.to_thread(self.metrics_service.count_hit, event)
+            return
+
+        buffer = self.metrics_service.metrics_buffer
+        try:
+            buffer.add(self.metrics_service.build_message(event))
+        except Exception as e:
+            logger.warning("failed to build metrics", error=str(e))
+            return
+
+        if not await asyncio.to_thread(buffer.flush, METRICS_FLUSH_TIMEOUT):
+            logger.warning("metrics flush timed out", **buffer.stats())
@@ -0,0 +1,91 @@
+import hashlib
+from typing import Iterable
+
+from redis import Redis
+
+from app.constants import BLOOM_FILTER_BITS, BLOOM_FILTER_HASHES, BLOOM_FILTER_KEY, BLOOM_FILTER_ADD_CHUNK
+
+# only sets bits while the bitmap exists, so an evicted filter stays absent
+# (and therefore disabled) until the next rebuild instead of coming back partial
+ADD_CODE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+for i = 1, #ARGV do
+    redis.call('SETBIT', KEYS[1], ARGV[i], 1)
+end
+return 1
+"""
+
+
+class ShortCodeFilter:
+    """
+    bloom filter of issued short codes stored as a redis bitmap
+
+    the bit right after the filter marks it as ready; until a rebuild has
+    completed every lookup answers "might exist" so no valid code is rejected.
+    deleting the key switches the filter off again until the next rebuild
+    """
+
+    def __init__(self, client: Redis, num_bits: int = BLOOM_FILTER_BITS, num_hashes: int = BLOOM_FILTER_HASHES,
+                 key: str = BLOOM_FILTER_KEY):
+        self.redis_client = client
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.key = key
+        self.ready_bit = num_bits
+        self._add_script = client.register_script(ADD_CODE_SCRIPT)
+
+    def positions(self, short_url: str) -> list[int]:
+        digest = hashlib.blake2b(short_url.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def might_contain(self, short_url: str) -> bool:
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.getbit(self.key, self.ready_bit)
+        for pos in self.positions(short_url):
+            pipe.getbit(self.key, pos)
+        ready, *bits = pipe.execute()
+
+        if not ready:
+            return True
+
+        return all(bits)
+
+    def add(self, short_url: str):
+        self._add_script(keys=[self.key], args=self.positions(short_url))
+
+    def add_many(self, short_urls: list[str]):
+        for start in range(0, len(short_urls), BLOOM_FILTER_ADD_CHUNK):
+            positions = [pos for short_url in short_urls[start:start + BLOOM_FILTER_ADD_CHUNK]
+                         for pos in self.positions(short_url)]
+            self._add_script(keys=[self.key], args=positions)
+
+    def rebuild(self, short_urls: Iterable[str]) -> int:
+        """
+        ors every issued code into the filter and marks it ready
+        :param short_urls: all codes currently in the table
+        :return: number of codes added
+        """
+        # create the bitmap up front (without touching the ready bit) so codes
+        # created while the table is being scanned are recorded by add()
+        self.redis_client.setbit(self.key, self.ready_bit + 1, 0)
+
+        bitmap = bytearray((self.ready_bit + 2 + 7) // 8)
+        count = 0
+        for short_url in short_urls:
+            for pos in self.positions(short_url):
+                bitmap[pos >> 3] |= 0x80 >> (pos & 7)
+            count += 1
+
+        rebuild_key = f"{self.key}:rebuild"
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.set(rebuild_key, bytes(bitmap))
+        pipe.bitop("OR", self.key, self.key, rebuild_key)
+        pipe.delete(rebuild_key)
+        pipe.setbit(self.key, self.ready_bit, 1)
+        pipe.execute()
+
+        return count
@@ -0,0 +1,63 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from app.constants import COUNTER_BLOCK_SIZE, COUNTER_REFILL_AT
+from app.repository.short_url_repo import ShortURLRepository
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class CounterAllocator:
+    """
+    hands out short url counter values from blocks reserved in dynamodb
+
+    every block comes from one atomic increment of the shared counter so no
+    value is ever handed out twice; values left in a block when the container
+    goes away are simply never used. the next block is fetched in the
+    background once the current one runs low
+    """
+
+    def __init__(self, url_repo: ShortURLRepository, block_size: int = COUNTER_BLOCK_SIZE,
+                 refill_at: int = COUNTER_REFILL_AT):
+        self.url_repo = url_repo
+        self.block_size = block_size
+        self.refill_at = refill_at
+        self._lock = threading.Lock()
+        self._block = range(0)
+        self._position = 0
+        self._prefetch: Future[range] | None = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="counter-refill")
+
+    def next(self) -> int:
+        return self.take(1)[0]
+
+    def take(self, count: int) -> list[int]:
+        """
+        :return: `count` unused counter values, ascending
+        """
+        with self._lock:
+            if self._position == len(self._block):
+                self._block = self._next_block()
+                self._position = 0
+
+            taken = list(self._block[self._position:self._position + count])
+            self._position += len(taken)
+            if len(taken) < count:
+                # larger than what is left, reserve the rest as its own range
+                taken.extend(self.url_repo.get_counter_range(count - len(taken)))
+
+            if len(self._block) - self._position <= self.refill_at and self._prefetch is None:
+                self._prefetch = self._executor.submit(self.url_repo.get_counter_range, self.block_size)
+
+            return taken
+
+    def _next_block(self) -> range:
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch is not None:
+            try:
+                return prefetch.result()
+            except Exception as e:
+                logger.warning("counter prefetch failed, reserving synchronously", error=str(e))
+
+        return self.url_repo.get_counter_range(self.block_size)
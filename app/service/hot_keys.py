@@ -0,0 +1,79 @@
+import time
+
+from redis import Redis
+
+from app.constants import HOT_KEY_SKETCH_WIDTH, HOT_KEY_SKETCH_DEPTH, HOT_KEY_TOP_K, HOT_KEY_FLUSH_INTERVAL, \
+    HOT_KEY_WINDOW, HOT_KEY_WINDOW_TTL, HOT_KEY_THRESHOLD, HOT_KEY_REPORT_WINDOWS, HOT_KEY_REPORT_SIZE
+from app.utils.cache_keys import hot_keys_key
+from app.utils.sketch import HotKeySketch
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class HotKeyTracker:
+    """
+    counts redirects per code in a container local sketch and periodically
+    merges the local top-k into a per window sorted set in redis; codes whose
+    fleet wide count crosses the threshold are reported back as hot
+    """
+
+    def __init__(self, client: Redis, width: int = HOT_KEY_SKETCH_WIDTH, depth: int = HOT_KEY_SKETCH_DEPTH,
+                 k: int = HOT_KEY_TOP_K, flush_interval: float = HOT_KEY_FLUSH_INTERVAL,
+                 threshold: int = HOT_KEY_THRESHOLD):
+        self.redis_client = client
+        self.sketch = HotKeySketch(width, depth, k)
+        self.flush_interval = flush_interval
+        self.threshold = threshold
+        self.hot_codes: frozenset[str] = frozenset()
+        self._last_flush = time.monotonic()
+
+    def record(self, short_url: str):
+        self.sketch.add(short_url)
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def is_hot(self, short_url: str) -> bool:
+        return short_url in self.hot_codes
+
+    def flush(self):
+        """
+        adds the local top-k counts to the current window and refreshes the
+        set of hot codes; the sketch starts over afterwards
+        """
+        self._last_flush = time.monotonic()
+        top_keys = self.sketch.top_keys()
+        self.sketch.clear()
+
+        window_start = self.current_window()
+        key = hot_keys_key(window_start)
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for short_url, count in top_keys:
+                pipe.zincrby(key, count, short_url)
+            pipe.expire(key, HOT_KEY_WINDOW_TTL)
+            # the previous window keeps codes hot while the new one fills up
+            pipe.zrangebyscore(hot_keys_key(window_start - HOT_KEY_WINDOW), self.threshold, "+inf")
+            pipe.zrangebyscore(key, self.threshold, "+inf")
+            *_, previous_hot, current_hot = pipe.execute()
+        except Exception as e:
+            logger.warning("failed to merge hot keys", error=str(e))
+            return
+
+        self.hot_codes = frozenset(previous_hot) | frozenset(current_hot)
+
+    def report(self, windows: int = HOT_KEY_REPORT_WINDOWS, size: int = HOT_KEY_REPORT_SIZE) -> list[dict]:
+        """
+        :return: the hottest codes over the last `windows` windows, highest first
+        """
+        current = self.current_window()
+        keys = [hot_keys_key(current - i * HOT_KEY_WINDOW) for i in range(windows)]
+        totals = self.redis_client.zunion(keys, withscores=True)
+        totals.sort(key=lambda item: item[1], reverse=True)
+
+        return [{"shortUrl": short_url, "hits": int(hits)} for short_url, hits in totals[:size]]
+
+    @staticmethod
+    def current_window() -> int:
+        now = int(time.time())
+        return now - now % HOT_KEY_WINDOW
@@ -0,0 +1,193 @@
+import csv
+import datetime
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator, TextIO
+from uuid import uuid4
+
+from app.constants import IMPORT_BATCH_SIZE, IMPORT_WORKERS, IMPORT_MAX_IN_FLIGHT, IMPORT_REPORT_INTERVAL
+from app.dtos.short_url import ImportLinkRecord
+from app.models.short_url import ShortUrl
+from app.models.subscriptions import Subscription
+from app.repository.short_url_repo import ShortURLRepository
+from app.service.code_filter import ShortCodeFilter
+from app.utils.short_code import short_code_codec
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def read_records(path: str) -> Iterator[tuple[int, dict | str]]:
+    """
+    streams (position, record) pairs from a .csv file with a header row or a
+    .jsonl file; jsonl lines are handed over unparsed so a malformed line only
+    fails its own record
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            for position, row in enumerate(csv.DictReader(f), start=1):
+                yield position, {k: v for k, v in row.items() if v not in (None, "")}
+        else:
+            position = 0
+            for line in f:
+                if line.strip():
+                    position += 1
+                    yield position, line
+
+
+class _Batch:
+    def __init__(self, last_position: int):
+        self.last_position = last_position
+        self.short_urls: list[tuple[int, ShortUrl]] = []
+        self.invalid: list[tuple[int, str]] = []
+        self.future: Future[set[str]] | None = None
+
+
+class LinkImporter:
+    """
+    imports a stream of links in counter range sized batches
+
+    batches are written by a bounded pool and at most max_in_flight of them
+    are pending at a time, so memory stays flat however large the input is.
+    progress is checkpointed after each batch in input order; a resumed import
+    restarts after the last checkpointed record, so links of batches that were
+    in flight when it stopped may be imported twice (under new codes)
+    """
+
+    def __init__(self, url_repo: ShortURLRepository, code_filter: ShortCodeFilter | None = None,
+                 default_owner: str | None = None, default_subscription: Subscription = Subscription.STANDARD,
+                 batch_size: int = IMPORT_BATCH_SIZE, workers: int = IMPORT_WORKERS,
+                 max_in_flight: int = IMPORT_MAX_IN_FLIGHT, checkpoint_path: str | None = None,
+                 report_interval: float = IMPORT_REPORT_INTERVAL):
+        self.url_repo = url_repo
+        self.code_filter = code_filter
+        self.default_owner = default_owner
+        self.default_subscription = default_subscription
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.checkpoint_path = checkpoint_path
+        self.report_interval = report_interval
+
+    def run(self, records: Iterable[tuple[int, dict | str]], results: TextIO | None = None) -> dict:
+        """
+        :param records: (position, record) pairs as produced by read_records
+        :param results: receives one json line per record with its short url or error
+        :return: the final checkpoint state
+        """
+        state = self.load_checkpoint()
+        started = time.monotonic()
+        start_count = state["imported"] + state["failed"]
+        last_report = started
+        pending = (record for record in records if record[0] > state["position"])
+
+        in_flight: deque[_Batch] = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while chunk := list(islice(pending, self.batch_size)):
+                # backpressure: the reader waits for the oldest batch once enough are pending
+                while len(in_flight) >= self.max_in_flight:
+                    self._complete(in_flight.popleft(), state, results)
+
+                in_flight.append(self._submit(executor, chunk))
+
+                if time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    self._report(state, start_count, started)
+
+            while in_flight:
+                self._complete(in_flight.popleft(), state, results)
+
+        self._report(state, start_count, started)
+        return state
+
+    def _submit(self, executor: ThreadPoolExecutor, chunk: list[tuple[int, dict | str]]) -> _Batch:
+        batch = _Batch(chunk[-1][0])
+        valid: list[tuple[int, ImportLinkRecord]] = []
+        for position, raw in chunk:
+            try:
+                valid.append((position, self._parse(raw)))
+            except ValueError as e:
+                batch.invalid.append((position, str(e)))
+
+        if not valid:
+            return batch
+
+        now = int(datetime.datetime.now(tz=datetime.timezone.utc).timestamp())
+        counts = self.url_repo.get_counter_range(len(valid))
+        for (position, record), count in zip(valid, counts):
+            batch.short_urls.append((position, ShortUrl(
+                ShortURL=short_code_codec.encode(short_code_codec.compose(record.subscription.to_number(), count)),
+                ID=str(uuid4()),
+                URL=record.url,
+                CreatedAt=record.created_at if record.created_at is not None else now,
+                OwnerID=record.owner_id,
+            )))
+
+        if self.code_filter is not None:
+            self.code_filter.add_many([short_url.short_url for _, short_url in batch.short_urls])
+
+        batch.future = executor.submit(self.url_repo.add_urls, [short_url for _, short_url in batch.short_urls])
+        return batch
+
+    def _parse(self, raw: dict | str) -> ImportLinkRecord:
+        data = json.loads(raw) if isinstance(raw, str) else raw
+        if not isinstance(data, dict):
+            raise ValueError("record is not an object")
+
+        defaults = {"subscription": self.default_subscription}
+        if self.default_owner is not None:
+            defaults["owner_id"] = self.default_owner
+
+        return ImportLinkRecord(**{**defaults, **data})
+
+    def _complete(self, batch: _Batch, state: dict, results: TextIO | None):
+        failed: set[str] = set()
+        if batch.future is not None:
+            try:
+                failed = batch.future.result()
+            except Exception as e:
+                logger.error("import batch failed", last_position=batch.last_position, error=str(e))
+                failed = {short_url.short_url for _, short_url in batch.short_urls}
+
+        lines = [{"position": position, "error": error} for position, error in batch.invalid]
+        for position, short_url in batch.short_urls:
+            if short_url.short_url in failed:
+                lines.append({"position": position, "url": short_url.url, "error": "failed to store short url"})
+            else:
+                lines.append({"position": position, "url": short_url.url, "shortUrl": short_url.short_url})
+
+        if results is not None:
+            results.writelines(json.dumps(line) + "\n" for line in sorted(lines, key=lambda line: line["position"]))
+            results.flush()
+
+        state["position"] = batch.last_position
+        state["failed"] += len(batch.invalid) + len(failed)
+        state["imported"] += len(batch.short_urls) - len(failed)
+        self.save_checkpoint(state)
+
+    def load_checkpoint(self) -> dict:
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return {"position": 0, "imported": 0, "failed": 0}
+
+        with open(self.checkpoint_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_checkpoint(self, state: dict):
+        if self.checkpoint_path is None:
+            return
+
+        # written aside and renamed so a crash never leaves a torn checkpoint
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    @staticmethod
+    def _report(state: dict, start_count: int, started: float):
+        done = state["imported"] + state["failed"] - start_count
+        elapsed = max(time.monotonic() - started, 1e-9)
+        logger.info("import progress", **state, elapsed=round(elapsed, 1), items_per_sec=round(done / elapsed, 1))
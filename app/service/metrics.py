@@ -3,9 +3,8 @@ from app.errors.web_errors import WebException
 from app.repository.short_url_repo import ShortURLRepository
 import datetime
 from app.models.metrics import DailyAccessMetrics
-from app.models.metrics import DeviceType
-import datetime
-from typing import cast
+from app.models.metrics import DeviceType, MetricsGranularity
+from typing import Callable, cast
 from app.models.metrics import AccessMetricsSQSMessage
 import json
 import os
@@ -15,130 +14,189 @@ from functools import wraps
 
 from mypy_boto3_sqs.client import SQSClient
 
+from app.constants import METRICS_BATCH_SIZE, METRICS_BATCH_MAX_AGE, METRICS_BUFFER_MAX_PENDING, \
+    METRICS_FLUSH_TIMEOUT, LOG_HOT_PATH_SAMPLE, METRICS_COUNTER_FLUSH_BATCH, METRICS_COUNTER_FLUSH_MAX_KEYS, \
+    METRICS_COUNTER_FLUSH_RESERVE_MS
 from app.repository.metrics_repo import MetricsRepository
+from app.service.metrics_aggregator import MetricsAggregator
+from app.service.metrics_counters import MetricsCounters
+from app.utils.batch_buffer import BatchBuffer
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
 
 
 class MetricsService:
-    def __init__(self, sqs_client: SQSClient, metrics_repo: MetricsRepository, url_repo: ShortURLRepository):
+    def __init__(self, sqs_client: SQSClient, metrics_repo: MetricsRepository, url_repo: ShortURLRepository,
+                 counters: MetricsCounters | None = None):
+        """
+        :param counters: when given, track_metrics counts hits in redis for
+            flush_counters to write instead of sending them through sqs
+        """
         self.sqs_client = sqs_client
         self.metrics_repo = metrics_repo
         self.url_repo = url_repo
+        self.counters = counters
+        self.metrics_buffer = BatchBuffer(
+            self.send_batch,
+            max_batch=METRICS_BATCH_SIZE,
+            max_age=METRICS_BATCH_MAX_AGE,
+            max_pending=METRICS_BUFFER_MAX_PENDING,
+        )
+        self.period_labels: dict[int, tuple[str, str, str]] = {}
 
     def track_metrics(self,func):
         @wraps(func)
         def wrapper(*args, **kwargs):
+            event = cast(events.APIGatewayProxyEventV1, kwargs.get("event", args[0]))
+
+            if self.counters is not None:
+                # one pipelined round trip (the sketch script is called by its
+                # sha), nothing is left to flush afterwards
+                self.count_hit(event)
+                return func(*args, **kwargs)
+
+            # queued before the handler runs so the send overlaps with it
+            try:
+                self.metrics_buffer.add(self.build_message(event))
+            except Exception as e:
+                logger.warning("failed to build metrics", error=str(e))
 
             try:
                 return func(*args, **kwargs)
             except:
                 raise
             finally:
-                event = cast(events.APIGatewayProxyEventV1, kwargs.get("event", args[0]))
-
-                print(event.get('headers'))
-                referrer = event.get('headers',{}).get('referrer',"none")
-                ip = event['requestContext']['identity']['sourceIp']
-                headers = event.get('headers')
-                user_agent = headers.get("User-Agent", "default")
-                country = headers.get("CloudFront-Viewer-Country", "unknown")
-                device = DeviceType.DESKTOP
-
-                if headers.get("CloudFront-Is-Mobile-Viewer"):
-                    device = DeviceType.MOBILE
-                elif headers.get("CloudFront-Is-SmartTV-Viewer"):
-                    device = DeviceType.SMART_TV
-                elif headers.get("CloudFront-Is-Tablet-Viewer") :
-                    device = DeviceType.TABLET
-                else:
-                    device = DeviceType.DESKTOP
-
-
-                url = cast(dict[str,str],event.get("pathParameters",{})).get("short_url","")
-
-                try:
-                    self.sqs_client.send_message(
-                        QueueUrl=os.environ["QUEUE_URL"],
-                        MessageBody=json.dumps(
-                            AccessMetricsSQSMessage(
-                                url=url,
-                                referrer=referrer,
-                                user_agent=user_agent,
-                                ip=ip,
-                                timestamp=int(datetime.datetime.now(tz=datetime.timezone.utc).timestamp()),
-                                country=country,
-                                device=device,
-                            ).model_dump()
-                        )
-                    )
-                except Exception as e:
-                    print(f"failed to send metrics: {e}")
+                if not self.metrics_buffer.flush(METRICS_FLUSH_TIMEOUT):
+                    logger.warning("metrics flush timed out", **self.metrics_buffer.stats())
         return wrapper
 
-    def process_event(self, event: events.SQSEvent)-> list[str]:
-        records = event.get('Records')
+    def count_hit(self, event: events.APIGatewayProxyEventV1):
+        try:
+            self.counters.record(self.build_record(event))
+        except Exception as e:
+            logger.warning("failed to count metrics", error=str(e))
+
+    def build_message(self, event: events.APIGatewayProxyEventV1) -> str:
+        return json.dumps(self.build_record(event).model_dump())
+
+    def build_record(self, event: events.APIGatewayProxyEventV1) -> AccessMetricsSQSMessage:
+        logger.debug("metrics event headers", headers=event.get('headers'), sample=LOG_HOT_PATH_SAMPLE)
+        referrer = event.get('headers',{}).get('referrer',"none")
+        ip = event['requestContext']['identity']['sourceIp']
+        headers = event.get('headers')
+        user_agent = headers.get("User-Agent", "default")
+        country = headers.get("CloudFront-Viewer-Country", "unknown")
+        device = DeviceType.DESKTOP
+
+        if headers.get("CloudFront-Is-Mobile-Viewer"):
+            device = DeviceType.MOBILE
+        elif headers.get("CloudFront-Is-SmartTV-Viewer"):
+            device = DeviceType.SMART_TV
+        elif headers.get("CloudFront-Is-Tablet-Viewer") :
+            device = DeviceType.TABLET
+        else:
+            device = DeviceType.DESKTOP
+
+
+        url = cast(dict[str,str],event.get("pathParameters",{})).get("short_url","")
+
+        return AccessMetricsSQSMessage(
+            url=url,
+            referrer=referrer,
+            user_agent=user_agent,
+            ip=ip,
+            timestamp=int(datetime.datetime.now(tz=datetime.timezone.utc).timestamp()),
+            country=country,
+            device=device,
+        )
+
+    def send_batch(self, bodies: list[str]) -> int:
+        """
+        sends up to 10 message bodies with one SendMessageBatch call
+        :return: number of messages sqs did not accept
+        """
+        res = self.sqs_client.send_message_batch(
+            QueueUrl=os.environ["QUEUE_URL"],
+            Entries=[
+                {
+                    "Id": str(i),
+                    "MessageBody": body,
+                }
+                for i, body in enumerate(bodies)
+            ],
+        )
+
+        failed = res.get("Failed", [])
+        for f in failed:
+            logger.warning("failed to send metrics", code=f.get('Code'), message=f.get('Message'))
+
+        return len(failed)
 
-        messages = [
-            AccessMetricsSQSMessage(
-                message_id=r['messageId'],
-                **json.loads(r.get('body',""))
+    def process_event(self, event: events.SQSEvent)-> list[str]:
+        aggregator = MetricsAggregator(self.period_labels)
+        malformed = aggregator.add_records(event.get('Records'))
+        if malformed:
+            logger.warning("malformed metrics records", count=len(malformed), message_ids=malformed)
+
+        # a message's hour, day and month buckets are written together, it
+        # fails with them and is counted again only if none were written
+        failed = self.metrics_repo.save_metrics(aggregator.groups())
+        return malformed + failed
+
+    def flush_counters(self, remaining_millis: Callable[[], int] | None = None,
+                       max_keys: int = METRICS_COUNTER_FLUSH_MAX_KEYS,
+                       batch_size: int = METRICS_COUNTER_FLUSH_BATCH) -> dict[str, int]:
+        """
+        drains dirty redis hour hashes in batches and writes them, with their
+        day and month rollups, through save_metrics; the hashes of metrics
+        that could not be written are released for the next flush
+        :param remaining_millis: time left in the invocation, e.g. the
+            context's get_remaining_time_in_millis; no batch is started with
+            less than METRICS_COUNTER_FLUSH_RESERVE_MS left
+        :return: hashes written and released
+        """
+        flushed = released = 0
+        while flushed + released < max_keys:
+            if remaining_millis is not None and remaining_millis() < METRICS_COUNTER_FLUSH_RESERVE_MS:
+                break
+
+            drained = self.counters.drain(min(batch_size, max_keys - flushed - released))
+            if not drained:
+                break
+
+            aggregator = MetricsAggregator(self.period_labels)
+            for member, url, hour, fields in drained:
+                if fields:
+                    aggregator.add_counts(member, url, hour, *self.counters.counts_of(fields))
+
+            # a hash is released only when none of its hour, day and month metrics were written
+            failed = set(self.metrics_repo.save_metrics(aggregator.groups()))
+            self.counters.finish(d for d in drained if d[0] not in failed)
+            if failed:
+                self.counters.release(d for d in drained if d[0] in failed)
+            released += len(failed)
+            flushed += len(drained) - len(failed)
+
+        return {"flushed": flushed, "released": released}
+
+    def get_metrics_by_url(self, url: str, user_id:str, start_day:str, end_day:str,
+                           granularity: MetricsGranularity | None = None) -> list[DailyAccessMetrics]:
+        if not self.url_repo.owns_url(user_id, url):
+            raise WebException(
+                status_code=403,
+                message="Url does not belong to user",
+                error_code=ErrorCodes.FORBIDDEN
             )
-            for r in records
-        ]
-
-        daily_metrics:dict[tuple[str,str],DailyAccessMetrics] = {}
-
-        for message in messages:
-            url = message.url
-            day = datetime.datetime.fromtimestamp(message.timestamp, tz= datetime.timezone.utc).strftime('%Y-%m-%d')
-
-            existing_metric = daily_metrics.get((url, day))
-
-            if existing_metric:
-                existing_metric.total_hits += 1
-                existing_metric.message_ids.append(message.message_id)
-                if message.country in existing_metric.by_country:
-                    existing_metric.by_country[message.country] += 1
-                else:
-                    existing_metric.by_country[message.country] = 1
-
-                if message.device in existing_metric.by_device_type:
-                    existing_metric.by_device_type[message.device] += 1
-                else:
-                    existing_metric.by_device_type[message.device] = 1
-
-                if message.referrer in existing_metric.by_referrer:
-                    existing_metric.by_referrer[message.referrer] += 1
-                else:
-                    existing_metric.by_referrer[message.referrer] = 1
-            else:
-                daily_metrics[(url,day)]  = DailyAccessMetrics(
-                    ShortURL=url,
-                    Day=day,
-                    ByCountry={
-                        message.country: 1
-                    },
-                    TotalHits=1,
-                    ByReferrer={
-                        message.referrer: 1
-                    },
-                    ByDeviceType={
-                        message.device: 1
-                    },
-                    message_ids=[message.message_id]
-                )
-
-
-        daily_metrics_list = list(daily_metrics.values())
-
-        return self.metrics_repo.save_metrics(daily_metrics_list)
-
-    def get_metrics_by_url(self, url: str, user_id:str, start_day:str, end_day:str) -> list[DailyAccessMetrics]:
-        user_urls = self.url_repo.get_urls_by_user_id(user_id)
-        if url not in user_urls:
+
+        return self.metrics_repo.get_url_metrics(url=url, start_day=start_day, end_day=end_day, granularity=granularity)
+
+    def get_unique_visitors_by_url(self, url: str, user_id: str, start_day: str, end_day: str) -> int:
+        if not self.url_repo.owns_url(user_id, url):
             raise WebException(
                 status_code=403,
                 message="Url does not belong to user",
                 error_code=ErrorCodes.FORBIDDEN
             )
 
-        return self.metrics_repo.get_url_metrics(url=url, start_day=start_day, end_day=end_day)
\ No newline at end of file
+        return self.metrics_repo.get_unique_visitors(url=url, start_day=start_day, end_day=end_day)
\ No newline at end of file
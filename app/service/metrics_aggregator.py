@@ -0,0 +1,307 @@
+import datetime
+import sys
+from typing import Iterable
+
+from aws_lambda_typing.events.sqs import SQSMessage
+from pydantic import TypeAdapter, ValidationError
+
+from app.constants import METRICS_TOP_COUNTRIES, METRICS_TOP_REFERRERS, VISITOR_SKETCH_PRECISION
+from app.models.metrics import AccessMetricsRecord, DailyAccessMetrics, DeviceType, MetricsGranularity, OTHER_BUCKET
+from app.utils.sketch import HyperLogLog, misra_gries_trim
+
+_SECONDS_PER_HOUR = 3600
+# labels kept across batches; a warm consumer only ever sees a few days of hours
+_MAX_PERIOD_LABELS = 4096
+
+_batch_adapter = TypeAdapter(list[AccessMetricsRecord])
+_record_adapter = TypeAdapter(AccessMetricsRecord)
+
+# bucket slots
+_TOTAL, _COUNTRIES, _DEVICES_SEEN, _REFERRERS, _MESSAGE_IDS, _COUNTRY_ERROR, _REFERRER_ERROR, _VISITORS = range(8)
+_ERROR_SLOTS = {_COUNTRIES: _COUNTRY_ERROR, _REFERRERS: _REFERRER_ERROR}
+
+_new_model = object.__new__
+_set_state = object.__setattr__
+_METRICS_FIELDS = frozenset(DailyAccessMetrics.model_fields)
+
+
+class MetricsAggregator:
+    """
+    folds access metric messages into per (short url, hour) counts without
+    building a pydantic model per message, and rolls those up into the day
+    and month buckets of the same urls
+
+    a batch is validated from its raw json in one pass, then each record is
+    reduced to a (url, hour, country, device, referrer) tuple of interned
+    strings and counted into plain dicts; the period labels are computed
+    once per utc hour and reused for every timestamp inside it.
+    DailyAccessMetrics are only built by groups()
+
+    referrer (and optionally country) counts are capped per bucket with
+    misra_gries_trim, the trimmed hits are kept under OTHER_BUCKET. visitors
+    are kept as the non zero registers of a HyperLogLog sketch per bucket,
+    raised as records come in and merged into the day and month buckets,
+    which are the only ones a full sketch is built for
+    """
+
+    def __init__(self, period_labels: dict[int, tuple[str, str, str]] | None = None,
+                 top_countries: int = METRICS_TOP_COUNTRIES, top_referrers: int = METRICS_TOP_REFERRERS,
+                 visitor_precision: int = VISITOR_SKETCH_PRECISION):
+        """
+        :param period_labels: hour number -> (hour, day, month) label cache,
+            shared between aggregators so a warm consumer does not format the
+            same hour again
+        :param top_countries: countries kept per bucket, 0 keeps all of them
+        :param top_referrers: referrers kept per bucket, 0 keeps all of them
+        :param visitor_precision: register bits of the visitor sketches
+        """
+        self.period_labels = period_labels if period_labels is not None else {}
+        self.visitor_precision = visitor_precision
+        self._caps = {slot: k for slot, k in ((_COUNTRIES, top_countries), (_REFERRERS, top_referrers)) if k > 0}
+        self._buckets: dict[tuple[str, int], list] = {}
+        # (ip, user agent) -> the (index, rank) of its visitor sketch register
+        self._visitor_registers: dict[tuple[str, str], tuple[int, int]] = {}
+
+    def add_records(self, records: list[SQSMessage]) -> list[str]:
+        """
+        validates the bodies of a whole batch with one pass over their joined
+        json and counts them
+
+        a batch that fails validation is checked record by record so only the
+        malformed ones are left out
+        :return: message ids of the records that could not be read
+        """
+        if not records:
+            return []
+
+        bodies = [r.get('body', "") for r in records]
+        # the joined array only lines up with the records when every body is
+        # one object: a body like "1,2" could make up for an empty one
+        if not all(body[:1] == "{" and body[-1:] == "}" for body in bodies):
+            return self._add_one_by_one(records, bodies)
+
+        try:
+            messages = _batch_adapter.validate_json("[" + ",".join(bodies) + "]")
+        except ValidationError:
+            messages = None
+
+        # "{...},{...}" is still two values, the count tells it apart
+        if messages is None or len(messages) != len(records):
+            return self._add_one_by_one(records, bodies)
+
+        add = self.add
+        for r, message in zip(records, messages):
+            add(r['messageId'], message)
+
+        return []
+
+    def add(self, message_id: str, message: AccessMetricsRecord):
+        url, hour, country, device, referrer = self.parse(message)
+
+        bucket = self._buckets.get((url, hour))
+        if bucket is None:
+            bucket = self._buckets[(url, hour)] = [0, {}, {}, {}, [], 0, 0, {}]
+
+        bucket[_TOTAL] += 1
+        countries, devices, referrers = bucket[_COUNTRIES], bucket[_DEVICES_SEEN], bucket[_REFERRERS]
+        countries[country] = countries.get(country, 0) + 1
+        devices[device] = devices.get(device, 0) + 1
+        referrers[referrer] = referrers.get(referrer, 0) + 1
+        bucket[_MESSAGE_IDS].append(message_id)
+        # the same visitor usually shows up more than once in a batch
+        visitor = (message['ip'], message['user_agent'])
+        register = self._visitor_registers.get(visitor)
+        if register is None:
+            register = self._visitor_registers[visitor] = HyperLogLog.register_of(
+                self.visitor_precision, HyperLogLog.hash(f"{visitor[0]}\x00{visitor[1]}"))
+        index, rank = register
+        visitors = bucket[_VISITORS]
+        if rank > visitors.get(index, 0):
+            visitors[index] = rank
+
+        # trimmed lazily, at twice the cap, so a trim runs at most every k new keys
+        for slot, k in self._caps.items():
+            if len(bucket[slot]) > 2 * k:
+                self._cap(bucket, slot, k)
+
+    def add_counts(self, message_id: str, url: str, hour: int, total: int, countries: dict[str, int],
+                   devices: dict[DeviceType, int], referrers: dict[str | None, int], visitors: Iterable[int]):
+        """
+        adds hits that were already counted elsewhere, e.g. in redis
+
+        :param visitors: visitor hashes, or one hash per register of a sketch
+            (see HyperLogLog.hash_of_register)
+        """
+        bucket = self._buckets.get((url, hour))
+        if bucket is None:
+            bucket = self._buckets[(url, hour)] = [0, {}, {}, {}, [], 0, 0, {}]
+
+        bucket[_TOTAL] += total
+        for slot, counts in ((_COUNTRIES, countries), (_DEVICES_SEEN, devices), (_REFERRERS, referrers)):
+            into = bucket[slot]
+            for name, count in counts.items():
+                into[name] = into.get(name, 0) + count
+        bucket[_MESSAGE_IDS].append(message_id)
+        registers = bucket[_VISITORS]
+        for value_hash in visitors:
+            index, rank = HyperLogLog.register_of(self.visitor_precision, value_hash)
+            if rank > registers.get(index, 0):
+                registers[index] = rank
+
+        for slot, k in self._caps.items():
+            if len(bucket[slot]) > 2 * k:
+                self._cap(bucket, slot, k)
+
+    def _cap(self, bucket: list, slot: int, k: int):
+        counts = bucket[slot]
+        if len(counts) <= k:
+            return
+        other = counts.pop(OTHER_BUCKET, 0)
+        kept, removed, error = misra_gries_trim(counts, k)
+        if other + removed:
+            kept[OTHER_BUCKET] = other + removed
+
+        bucket[slot] = kept
+        bucket[_ERROR_SLOTS[slot]] += error
+
+    @staticmethod
+    def parse(message: AccessMetricsRecord) -> tuple[str, int, str, DeviceType, str | None]:
+        referrer = message["referrer"]
+        return (
+            sys.intern(message["url"]),
+            message["timestamp"] // _SECONDS_PER_HOUR,
+            sys.intern(message["country"]),
+            message["device"],
+            sys.intern(referrer) if referrer is not None else None,
+        )
+
+    def _add_one_by_one(self, records: list[SQSMessage], bodies: list[str]) -> list[str]:
+        malformed: list[str] = []
+        for r, body in zip(records, bodies):
+            try:
+                message = _record_adapter.validate_json(body)
+            except ValidationError:
+                malformed.append(r['messageId'])
+                continue
+            self.add(r['messageId'], message)
+
+        return malformed
+
+    def labels_of(self, hour: int) -> tuple[str, str, str]:
+        """
+        :return: the YYYY-MM-DDTHH, YYYY-MM-DD and YYYY-MM labels of an hour number
+        """
+        labels = self.period_labels.get(hour)
+        if labels is None:
+            if len(self.period_labels) >= _MAX_PERIOD_LABELS:
+                self.period_labels.clear()
+            hour_label = datetime.datetime.fromtimestamp(hour * _SECONDS_PER_HOUR, tz=datetime.timezone.utc) \
+                .strftime('%Y-%m-%dT%H')
+            labels = self.period_labels[hour] = (
+                sys.intern(hour_label),
+                sys.intern(hour_label[:10]),
+                sys.intern(hour_label[:7]),
+            )
+
+        return labels
+
+    def groups(self) -> list[list[DailyAccessMetrics]]:
+        """
+        :return: per short url and day, the day's hour buckets followed by
+            their day rollup and the day's share of the month rollup; every
+            bucket of a message is in one group, which the repository writes
+            in one transaction. a message id is listed on every bucket it was
+            counted in
+        """
+        days: dict[tuple[str, str], tuple[list[DailyAccessMetrics], list[list]]] = {}
+        for (url, hour), bucket in self._buckets.items():
+            hour_label, day_label, _ = self.labels_of(hour)
+            for slot, k in self._caps.items():
+                self._cap(bucket, slot, k)
+            metric = _metrics_of(url, MetricsGranularity.HOUR, hour_label, bucket)
+
+            day = days.get((url, day_label))
+            if day is None:
+                days[(url, day_label)] = ([metric], [bucket])
+            else:
+                day[0].append(metric)
+                day[1].append(bucket)
+
+        groups: list[list[DailyAccessMetrics]] = []
+        for (url, day_label), (hours, buckets) in days.items():
+            # a day seen in a single hour shares that hour's counts
+            rollup = buckets[0] if len(buckets) == 1 else self._rollup(buckets)
+
+            # the batch's estimate; the repository stores the merged one
+            registers = rollup[_VISITORS]
+            unique_visitors = HyperLogLog.count_of_registers(self.visitor_precision, registers)
+            visitors = HyperLogLog.bytes_of_registers(self.visitor_precision, registers)
+            day = _metrics_of(url, MetricsGranularity.DAY, day_label, rollup, unique_visitors, visitors)
+            # a month is added to once per day rather than summed over the
+            # batch, so the groups of a batch never write the same items
+            month = _metrics_of(url, MetricsGranularity.MONTH, day_label[:7], rollup, unique_visitors, visitors)
+            groups.append([*hours, day, month])
+
+        return groups
+
+    def _rollup(self, buckets: list[list]) -> list:
+        first = buckets[0]
+        rollup = [
+            first[_TOTAL],
+            dict(first[_COUNTRIES]),
+            dict(first[_DEVICES_SEEN]),
+            dict(first[_REFERRERS]),
+            list(first[_MESSAGE_IDS]),
+            first[_COUNTRY_ERROR],
+            first[_REFERRER_ERROR],
+            dict(first[_VISITORS]),
+        ]
+        registers = rollup[_VISITORS]
+        for bucket in buckets[1:]:
+            rollup[_TOTAL] += bucket[_TOTAL]
+            rollup[_COUNTRY_ERROR] += bucket[_COUNTRY_ERROR]
+            rollup[_REFERRER_ERROR] += bucket[_REFERRER_ERROR]
+            for slot in (_COUNTRIES, _DEVICES_SEEN, _REFERRERS):
+                counts = rollup[slot]
+                for name, count in bucket[slot].items():
+                    counts[name] = counts.get(name, 0) + count
+            rollup[_MESSAGE_IDS].extend(bucket[_MESSAGE_IDS])
+            for index, rank in bucket[_VISITORS].items():
+                if rank > registers.get(index, 0):
+                    registers[index] = rank
+
+        for slot, k in self._caps.items():
+            self._cap(rollup, slot, k)
+        return rollup
+
+    def results(self) -> list[DailyAccessMetrics]:
+        """
+        :return: the metrics of every group, see groups()
+        """
+        return [metric for group in self.groups() for metric in group]
+
+
+def _metrics_of(url: str, granularity: MetricsGranularity, label: str, bucket: list,
+                unique_visitors: int = 0, visitors: bytes | None = None) -> DailyAccessMetrics:
+    # what model_construct does without its per field alias and default
+    # lookups, which cost more than aggregating a small batch; every field
+    # is set, so the result equals the model_construct one
+    metric = _new_model(DailyAccessMetrics)
+    _set_state(metric, "__dict__", {
+        "short_url": url,
+        "day": label,
+        "granularity": granularity,
+        "total_hits": bucket[_TOTAL],
+        "by_country": bucket[_COUNTRIES],
+        "by_device_type": bucket[_DEVICES_SEEN],
+        "by_referrer": bucket[_REFERRERS],
+        "country_error": bucket[_COUNTRY_ERROR],
+        "referrer_error": bucket[_REFERRER_ERROR],
+        "unique_visitors": unique_visitors,
+        "visitors": visitors,
+        "message_ids": bucket[_MESSAGE_IDS],
+    })
+    _set_state(metric, "__pydantic_fields_set__", set(_METRICS_FIELDS))
+    _set_state(metric, "__pydantic_extra__", None)
+    _set_state(metric, "__pydantic_private__", None)
+    return metric
@@ -0,0 +1,241 @@
+import time
+import zlib
+from typing import Iterable
+
+from redis import Redis
+from redis.exceptions import NoScriptError, RedisError
+
+from app.constants import METRICS_DIRTY_SHARDS, METRICS_COUNTER_CLAIM_TTL, VISITOR_SKETCH_PRECISION
+from app.models.metrics import AccessMetricsSQSMessage, DeviceType
+from app.utils.cache_keys import metrics_counters_key, metrics_processing_key, metrics_dirty_key, \
+    metrics_claims_key
+from app.utils.sketch import HyperLogLog
+
+_SECONDS_PER_HOUR = 3600
+
+# raises visitor sketch registers kept as V#<index> hash fields; ARGV holds
+# field, rank pairs
+REGISTER_MAX_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    local rank = tonumber(ARGV[i + 1])
+    if rank > tonumber(redis.call('HGET', KEYS[1], ARGV[i]) or '0') then
+        redis.call('HSET', KEYS[1], ARGV[i], rank)
+    end
+end
+"""
+
+# KEYS[1] dirty set, KEYS[2] claims zset of the same shard; ARGV count, claim time and the
+# claim time before which a claim is taken over. members another flush still
+# holds are left dirty
+CLAIM_SCRIPT = """
+local claimed = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[3], 'LIMIT', 0, ARGV[1])
+for _, member in ipairs(claimed) do
+    redis.call('ZADD', KEYS[2], ARGV[2], member)
+end
+local wanted = tonumber(ARGV[1]) - #claimed
+if wanted > 0 then
+    local busy = {}
+    for _, member in ipairs(redis.call('SPOP', KEYS[1], wanted)) do
+        if redis.call('ZSCORE', KEYS[2], member) then
+            table.insert(busy, member)
+        else
+            redis.call('ZADD', KEYS[2], ARGV[2], member)
+            table.insert(claimed, member)
+        end
+    end
+    if #busy > 0 then
+        redis.call('SADD', KEYS[1], unpack(busy))
+    end
+end
+return claimed
+"""
+
+# KEYS[1] hour hash, KEYS[2] its processing hash. the hash is renamed to the
+# processing one, or added into it when a failed or dead flush left it behind
+TAKE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    if redis.call('EXISTS', KEYS[2]) == 0 then
+        redis.call('RENAME', KEYS[1], KEYS[2])
+    else
+        local fields = redis.call('HGETALL', KEYS[1])
+        for i = 1, #fields, 2 do
+            local name, value = fields[i], tonumber(fields[i + 1])
+            if string.sub(name, 1, 2) == 'V#' then
+                if value > tonumber(redis.call('HGET', KEYS[2], name) or '0') then
+                    redis.call('HSET', KEYS[2], name, value)
+                end
+            else
+                redis.call('HINCRBY', KEYS[2], name, value)
+            end
+        end
+        redis.call('DEL', KEYS[1])
+    end
+end
+return redis.call('HGETALL', KEYS[2])
+"""
+
+# (dirty set member, short url, hour number, hash fields)
+DrainedCounters = tuple[str, str, int, dict[str, int]]
+
+
+class MetricsCounters:
+    """
+    pre aggregates redirects in redis instead of sending a message per hit
+
+    a hit is one pipelined round trip: HINCRBY of the total, country, device
+    and referrer fields of its (short url, utc hour) hash, a max update of the
+    visitor sketch register it lands in, and an SADD marking the hash dirty
+    in its url's shard, so the marks of busy urls do not all land on one slot.
+
+    drain() claims dirty hashes and moves each one to a processing hash, so
+    a hit counted while its hash is drained lands in a fresh hash that is
+    marked dirty again. the processing hash is only deleted by finish(),
+    once its counts are written; a claim that is neither finished nor
+    released in time is taken over by a later drain
+    """
+
+    def __init__(self, client: Redis, precision: int = VISITOR_SKETCH_PRECISION,
+                 claim_ttl: int = METRICS_COUNTER_CLAIM_TTL, shards: int = METRICS_DIRTY_SHARDS):
+        """
+        :param claim_ttl: seconds after which a drained hash that was not
+            finished is drained again
+        :param shards: dirty sets the hashes are marked in
+        """
+        self.redis_client = client
+        self.precision = precision
+        self.claim_ttl = claim_ttl
+        self.shards = max(shards, 1)
+        # drain() goes through the shards in turn, starting where the last one stopped
+        self._next_shard = 0
+        self._register_script = client.register_script(REGISTER_MAX_SCRIPT)
+        try:
+            # record() calls it by sha, which skips the SCRIPT EXISTS a
+            # pipeline sends before running scripts queued on it
+            client.script_load(REGISTER_MAX_SCRIPT)
+        except RedisError:
+            pass  # loaded by the first record() it fails
+        self._claim_script = client.register_script(CLAIM_SCRIPT)
+        self._take_script = client.register_script(TAKE_SCRIPT)
+
+    def record(self, message: AccessMetricsSQSMessage):
+        hour = message.timestamp // _SECONDS_PER_HOUR
+        key = metrics_counters_key(message.url, hour)
+        index, rank = HyperLogLog.register_of(self.precision, HyperLogLog.hash(f"{message.ip}\x00{message.user_agent}"))
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hincrby(key, "TotalHits", 1)
+        pipe.hincrby(key, f"C#{message.country}", 1)
+        pipe.hincrby(key, f"D#{message.device.value}", 1)
+        pipe.hincrby(key, f"R#{message.referrer if message.referrer is not None else 'none'}", 1)
+        pipe.evalsha(self._register_script.sha, 1, key, f"V#{index}", rank)
+        pipe.sadd(metrics_dirty_key(self.shard_of(message.url)), f"{hour}:{message.url}")
+        try:
+            pipe.execute()
+        except NoScriptError:
+            # the script cache was flushed; the rest of the pipeline went
+            # through, so only the register update is sent again
+            self._register_script.sha = self.redis_client.script_load(REGISTER_MAX_SCRIPT)
+            self.redis_client.evalsha(self._register_script.sha, 1, key, f"V#{index}", rank)
+
+    def shard_of(self, url: str) -> int:
+        return zlib.crc32(url.encode()) % self.shards
+
+    def drain(self, count: int) -> list[DrainedCounters]:
+        """
+        claims up to `count` dirty hashes, or ones whose claim ran out, going
+        through the shards in turn, and moves them to their processing
+        hashes; a hash that was drained before its mark was claimed comes
+        back with no fields
+        """
+        now = time.time()
+        members: list[str] = []
+        first = self._next_shard
+        for i in range(self.shards):
+            if len(members) >= count:
+                break
+            shard = (first + i) % self.shards
+            members.extend(self._claim_script(
+                keys=[metrics_dirty_key(shard), metrics_claims_key(shard)],
+                args=[count - len(members), now, now - self.claim_ttl],
+            ))
+            self._next_shard = (shard + 1) % self.shards
+        if not members:
+            return []
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        popped: list[tuple[str, str, int]] = []
+        for member in members:
+            hour, _, url = member.partition(":")
+            popped.append((member, url, int(hour)))
+            self._take_script(
+                keys=[metrics_counters_key(url, int(hour)), metrics_processing_key(url, int(hour))],
+                client=pipe,
+            )
+
+        return [
+            (member, url, hour, {name: int(value) for name, value in zip(fields[::2], fields[1::2])})
+            for (member, url, hour), fields in zip(popped, pipe.execute())
+        ]
+
+    def finish(self, drained: Iterable[DrainedCounters]):
+        """
+        deletes the processing hashes of written counts, then their claims
+        """
+        drained = list(drained)
+        if not drained:
+            return
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for _, url, hour, _ in drained:
+            pipe.delete(metrics_processing_key(url, hour))
+        pipe.execute()
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for shard, members in self._by_shard(drained).items():
+            pipe.zrem(metrics_claims_key(shard), *members)
+        pipe.execute()
+
+    def release(self, drained: Iterable[DrainedCounters]):
+        """
+        gives up the claims of counts that could not be written; their
+        processing hashes are kept and drained again with the next flush
+        """
+        by_shard = self._by_shard(drained)
+        if not by_shard:
+            return
+
+        # marked dirty before the claim goes, so a flush dying in between
+        # leaves the hash claimed rather than forgotten
+        pipe = self.redis_client.pipeline(transaction=False)
+        for shard, members in by_shard.items():
+            pipe.sadd(metrics_dirty_key(shard), *members)
+            pipe.zrem(metrics_claims_key(shard), *members)
+        pipe.execute()
+
+    def _by_shard(self, drained: Iterable[DrainedCounters]) -> dict[int, list[str]]:
+        by_shard: dict[int, list[str]] = {}
+        for member, url, _, _ in drained:
+            by_shard.setdefault(self.shard_of(url), []).append(member)
+        return by_shard
+
+    def counts_of(self, fields: dict[str, int]) -> tuple[int, dict[str, int], dict[DeviceType, int], dict[str, int], list[int]]:
+        """
+        :return: total, country, device and referrer counts of a drained hash
+            and one hash per visitor sketch register it holds
+        """
+        countries: dict[str, int] = {}
+        devices: dict[DeviceType, int] = {}
+        referrers: dict[str, int] = {}
+        visitors: list[int] = []
+        for name, value in fields.items():
+            prefix, key = name[:2], name[2:]
+            if prefix == "C#":
+                countries[key] = value
+            elif prefix == "D#":
+                devices[DeviceType(key)] = value
+            elif prefix == "R#":
+                referrers[key] = value
+            elif prefix == "V#":
+                visitors.append(HyperLogLog.hash_of_register(self.precision, int(key), value))
+
+        return fields.get("TotalHits", 0), countries, devices, referrers, visitors
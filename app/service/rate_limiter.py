@@ -1,20 +1,70 @@
-from typing import cast
+from typing import Callable, cast
 from app.errors.web_errors import ErrorCodes
 from app.errors.web_errors import WebException
 import datetime
 from functools import wraps
 
-import hashids
 from redis import Redis
 from aws_lambda_typing import events, context, responses
 
-from app.constants import HASHID_SALT, STD_RATE_LIMIT, PRO_RATE_LIMIT
+from app.constants import STD_RATE_LIMIT, PRO_RATE_LIMIT, RATE_LIMIT_LEASE_MIN_RATE, RATE_LIMIT_MAX_OVERSHOOT, \
+    LOG_HOT_PATH_SAMPLE
 from app.models.subscriptions import Subscription
+from app.utils.cache_keys import rate_limit_key, url_cache_key
+from app.utils.short_code import short_code_codec
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# counts the hit, arms the window expiry and reads the cached url (and how long
+# it has left) in a single round trip; both keys share the short code hash tag
+# so this is cluster safe
+REDIRECT_SCRIPT = """
+local count = redis.call('INCR', KEYS[1])
+if count == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return {count, redis.call('GET', KEYS[2]), redis.call('PTTL', KEYS[2])}
+"""
+
+# hands out up to ARGV[2] tokens of the window's budget (ARGV[3]) in one go,
+# a grant of 0 means the budget for this window is spent
+LEASE_SCRIPT = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+local grant = math.min(tonumber(ARGV[2]), tonumber(ARGV[3]) - used)
+if grant > 0 then
+    if redis.call('INCRBY', KEYS[1], grant) == grant then
+        redis.call('EXPIRE', KEYS[1], ARGV[1])
+    end
+else
+    grant = 0
+end
+return {grant, redis.call('GET', KEYS[2]), redis.call('PTTL', KEYS[2])}
+"""
+
+_EXHAUSTED = -1
 
 
 class RateLimitingService:
-    def __init__(self, client: Redis):
+    def __init__(self, client: Redis, on_cached_url: Callable[[str, str, int], None] | None = None, lease_size: int = 0,
+                 max_overshoot: int = RATE_LIMIT_MAX_OVERSHOOT, lease_min_rate: int = RATE_LIMIT_LEASE_MIN_RATE):
+        """
+        :param client: redis client
+        :param on_cached_url: receives (short_url, url, ttl in ms) whenever the rate limit check finds the url cached
+        :param lease_size: tokens a container leases at once for links limited to at least lease_min_rate
+            per window, 0 checks every hit against redis
+        :param max_overshoot: hits per window the leases may hand out on top of the limit
+        :param lease_min_rate: smallest per window limit that is served from leases
+        """
         self.redis_client = client
+        self.on_cached_url = on_cached_url
+        self.lease_size = lease_size
+        self.max_overshoot = max_overshoot
+        self.lease_min_rate = lease_min_rate
+        self._redirect_script = client.register_script(REDIRECT_SCRIPT)
+        self._lease_script = client.register_script(LEASE_SCRIPT)
+        self._leases: dict[str, int] = {}
+        self._lease_window = 0
 
     def check_access(self, short_url: str):
         """
@@ -30,57 +80,112 @@ class RateLimitingService:
         #     )
 
         # trimmed_short_url = short_url[3:]
-        decoded_short_url = hashids.Hashids(salt=HASHID_SALT, min_length=7).decode(short_url)
-        if len(decoded_short_url) == 0:
+        rate = self.limit_for(short_url)
+        window_start = self.current_window()
+        if self.lease_size and rate >= self.lease_min_rate:
+            return self._spend_lease(short_url, window_start, rate)
+
+        key = rate_limit_key(short_url, window_start)
+        updated_val, cached_url, ttl_ms = self._redirect_script(keys=[key, url_cache_key(short_url)], args=[60])
+
+        val = int(updated_val)
+        self._hand_over(short_url, cached_url, ttl_ms)
+
+        logger.debug("rate limit checked", short_url=short_url, count=val, rate=rate, sample=LOG_HOT_PATH_SAMPLE)
+        return val <= rate
+
+    def _spend_lease(self, short_url: str, window_start: int, rate: int) -> bool:
+        """
+        spends a locally leased token, going back to redis only once the lease
+        is used up; leases never outlive the window they were taken in
+        """
+        if window_start != self._lease_window:
+            self._leases.clear()
+            self._lease_window = window_start
+
+        remaining = self._leases.get(short_url, 0)
+        if remaining == _EXHAUSTED:
+            return False
+
+        if remaining == 0:
+            granted, cached_url, ttl_ms = self._lease_script(
+                keys=[rate_limit_key(short_url, window_start), url_cache_key(short_url)],
+                args=[60, self.lease_size, rate + self.max_overshoot],
+            )
+            self._hand_over(short_url, cached_url, ttl_ms)
+
+            remaining = int(granted)
+            if remaining == 0:
+                self._leases[short_url] = _EXHAUSTED
+                return False
+
+        self._leases[short_url] = remaining - 1
+        return True
+
+    def _hand_over(self, short_url: str, cached_url: str | None, ttl_ms: int):
+        if cached_url and self.on_cached_url is not None:
+            self.on_cached_url(short_url, cached_url, int(ttl_ms))
+
+    @staticmethod
+    def limit_for(short_url: str) -> int:
+        """
+        :return: hits allowed per window for the code's subscription tier
+        """
+        decoded_short_url = short_code_codec.decode(short_url)
+        if decoded_short_url is None:
             raise WebException(
                 status_code=404,
                 message="Invalid short url code",
                 error_code=ErrorCodes.SHORTURL_NOT_FOUND
             )
 
-        rate = STD_RATE_LIMIT if str(decoded_short_url[0]).startswith(
-            str(Subscription.STANDARD.to_number())) else PRO_RATE_LIMIT
+        return STD_RATE_LIMIT if short_code_codec.tier_of(decoded_short_url) == Subscription.STANDARD.to_number() \
+            else PRO_RATE_LIMIT
 
+    @staticmethod
+    def current_window() -> int:
         current_time = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
-        window_start = current_time - (current_time % 60)
-        key = f"rl:{short_url}:{window_start}"
-        updated_val = str(self.redis_client.incr(key))
+        return current_time - (current_time % 60)
 
-        val = int(updated_val)
-        if val == 1:
-            self.redis_client.expire(key, 60)
+    @staticmethod
+    def short_url_from_event(event: events.APIGatewayProxyEventV1) -> str:
+        url = event['pathParameters']
 
-        print(f"val: {val} rate: {rate}")
-        return val <= rate
+        if url is None:
+            raise WebException(
+                status_code=404,
+                message="Invalid short url code",
+                error_code=ErrorCodes.SHORTURL_NOT_FOUND
+            )
+
+        url = url.get('short_url')
+
+        if not url:
+            raise WebException(
+                status_code=404,
+                message="Not Found",
+                error_code=ErrorCodes.SHORTURL_NOT_FOUND
+            )
+
+        return url
+
+    @staticmethod
+    def too_many_requests() -> WebException:
+        return WebException(
+            status_code=429,
+            message="Too Many Requests, Please try again later",
+            error_code=ErrorCodes.TOO_MANY_REQUESTS
+        )
 
     def rate_limit(self, func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             event: events.APIGatewayProxyEventV1 = cast(events.APIGatewayProxyEventV1, kwargs.get("event", args[0]))
-            url = event['pathParameters']
-
-            if url is None:
-                raise WebException(
-                    status_code=404,
-                    message="Invalid short url code",
-                    error_code=ErrorCodes.SHORTURL_NOT_FOUND
-                )
-
-            url = url.get('short_url')
-
-            if not url:
-                raise WebException(
-                    status_code=404,
-                    message="Not Found",
-                    error_code=ErrorCodes.SHORTURL_NOT_FOUND
-                )
+            url = self.short_url_from_event(event)
+
             if self.check_access(url):
                 return func(*args, **kwargs)
             else:
-                raise WebException(
-                    status_code=429,
-                    message="Too Many Requests, Please try again later",
-                    error_code=ErrorCodes.TOO_MANY_REQUESTS
-                )
+                raise self.too_many_requests()
 
         return wrapper
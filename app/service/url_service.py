@@ -1,30 +1,79 @@
 import datetime
+import json
+import math
+import random
+import time
+from decimal import Decimal
 from uuid import uuid4
 
-import hashids
+from botocore.exceptions import ClientError
 from redis import Redis
 
-from app.constants import HASHID_SALT
+from app.constants import URL_CACHE_TTL, L1_CACHE_STATS_INTERVAL, NEGATIVE_CACHE_TTL, \
+    NEGATIVE_CACHE_MARKER, URL_LOCK_TTL_MS, URL_LOCK_WAIT, URL_LOCK_POLL_INTERVAL, URL_XFETCH_BETA, URL_LOAD_ESTIMATE, \
+    HOT_URL_CACHE_TTL, URL_LIST_PAGE_SIZE, URL_LIST_CACHE_TTL
+from app.errors.web_errors import WebException, ErrorCodes
 from app.models.short_url import ShortUrl
 from app.models.subscriptions import Subscription
 from app.repository.short_url_repo import ShortURLRepository
+from app.service.code_filter import ShortCodeFilter
+from app.service.counter_allocator import CounterAllocator
+from app.service.hot_keys import HotKeyTracker
+from app.utils.cache_keys import url_cache_key, url_lock_key, user_urls_key
+from app.utils.cursor import encode_cursor, decode_cursor
+from app.utils.local_cache import LocalCache
+from app.utils.short_code import short_code_codec
+from app.utils.single_flight import SingleFlight
 from app.utils.timer import log_performance
+from app.utils.url_hash import url_hash as hash_url
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# only the holder of the lock may release it, an expired lock may already
+# belong to another container
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_MAX_PENDING_REFRESHES = 1024
 
 
 class ShortURLService:
-    def __init__(self, url_repo: ShortURLRepository, redis_client: Redis):
+    def __init__(self, url_repo: ShortURLRepository, redis_client: Redis, local_cache: LocalCache | None = None,
+                 code_filter: ShortCodeFilter | None = None, hot_keys: HotKeyTracker | None = None,
+                 counter: CounterAllocator | None = None):
         self.url_repo = url_repo
         self.redis_client = redis_client
+        self.local_cache = local_cache
+        self.code_filter = code_filter
+        self.hot_keys = hot_keys
+        self.counter = counter
+        self._lookups = 0
+        self._loads: SingleFlight[str] = SingleFlight()
+        self._release_lock = redis_client.register_script(RELEASE_LOCK_SCRIPT)
+        self._load_estimate = URL_LOAD_ESTIMATE
+        self._pending_refresh: dict[str, str] = {}
 
     @log_performance
-    def create_short_url(self, url: str, user_id: str, subscription: Subscription) -> str:
+    def create_short_url(self, url: str, user_id: str, subscription: Subscription, dedupe: bool = False) -> str:
+        """
+        :param dedupe: return the user's existing short url for the same (normalized) destination if there is one
+        """
+        url_hash = None
+        if dedupe:
+            url_hash = hash_url(url)
+            existing = self.url_repo.get_short_url_by_hash(user_id, url_hash)
+            if existing is not None:
+                return existing
+
         # shortened_url = subscription.value
-        count = self.url_repo.get_counter()
+        count = self.counter.next() if self.counter is not None else self.url_repo.get_counter()
         subscription_val = subscription.to_number()
-        shortened_url = hashids.Hashids(
-            salt=HASHID_SALT,
-            min_length=7
-        ).encode(int(f"{subscription_val}{count}"))
+        shortened_url = short_code_codec.encode(short_code_codec.compose(subscription_val, count))
 
         short_url = ShortUrl(
             ShortURL= shortened_url,
@@ -34,19 +83,292 @@ class ShortURLService:
             OwnerID=user_id,
         )
 
-        self.url_repo.add_url(short_url)
+        # recorded before the write so a failure can only cause a false positive
+        if self.code_filter is not None:
+            self.code_filter.add(shortened_url)
+
+        try:
+            self.url_repo.add_url(short_url, url_hash)
+        except ClientError as e:
+            if url_hash is None or e.response['Error']['Code'] != "TransactionCanceledException":
+                raise
+            # an identical create won the race for the hash index
+            existing = self.url_repo.get_short_url_by_hash(user_id, url_hash, consistent=True)
+            if existing is None:
+                raise
+            return existing
+
+        self._cache_created([(shortened_url, url)], user_id)
 
         return shortened_url
 
+    @log_performance
+    def create_short_urls(self, urls: list[str], user_id: str, subscription: Subscription) -> list[dict]:
+        """
+        creates one short url per entry of `urls` with a single counter reservation
+        :return: per url results in request order, each with either a shortUrl or an error
+        """
+        counts = self.counter.take(len(urls)) if self.counter is not None \
+            else self.url_repo.get_counter_range(len(urls))
+        subscription_val = subscription.to_number()
+        shortened_urls = short_code_codec.encode_many(short_code_codec.compose(subscription_val, count)
+                                                      for count in counts)
+
+        created_at = int(datetime.datetime.now(tz=datetime.timezone.utc).timestamp())
+        short_urls = [
+            ShortUrl(ShortURL=shortened_url, ID=str(uuid4()), URL=url, CreatedAt=created_at, OwnerID=user_id)
+            for shortened_url, url in zip(shortened_urls, urls)
+        ]
+
+        if self.code_filter is not None:
+            self.code_filter.add_many(shortened_urls)
+
+        failed = self.url_repo.add_urls(short_urls)
+
+        self._cache_created([(short_url.short_url, short_url.url) for short_url in short_urls
+                             if short_url.short_url not in failed], user_id)
+
+        return [
+            {"url": url, "error": "failed to store short url"} if shortened_url in failed
+            else {"url": url, "shortUrl": shortened_url}
+            for shortened_url, url in zip(shortened_urls, urls)
+        ]
+
+    def _cache_created(self, created: list[tuple[str, str]], user_id: str):
+        """
+        writes freshly stored urls through to redis so the first redirect is a
+        hit; this also replaces any negative entry a racing lookup left, and
+        drops the owner's cached listing. when the write fails the keys are
+        deleted instead, and if that fails too a stale negative entry lives at
+        most NEGATIVE_CACHE_TTL (and a stale listing URL_LIST_CACHE_TTL)
+        """
+        if not created:
+            return
+
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for shortened_url, url in created:
+                pipe.set(url_cache_key(shortened_url), url, ex=URL_CACHE_TTL)
+            pipe.delete(user_urls_key(user_id))
+            pipe.execute()
+            return
+        except Exception as e:
+            logger.warning("failed to cache created short urls", count=len(created), error=str(e))
+
+        # one DEL per key, the keys hash to different slots of a clustered cache
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.delete(user_urls_key(user_id))
+            for shortened_url, _ in created:
+                pipe.delete(url_cache_key(shortened_url))
+            pipe.execute()
+        except Exception as e:
+            logger.warning("failed to clear cached lookups of created short urls", count=len(created), error=str(e))
+
     @log_performance
     def get_original_url(self, shortened_url: str) -> str:
-        orig_url = self.redis_client.get(f"shorturl:{shortened_url}")
+        stale_url = self._pending_refresh.pop(shortened_url, None)
+        if stale_url is not None:
+            return self.found_or_raise(self.load_url(shortened_url, stale_url))
+
+        if self.local_cache is not None:
+            self._report_cache_stats()
+            cached_url = self.local_cache.get(shortened_url)
+            if cached_url is not None:
+                return self.found_or_raise(cached_url)
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.get(url_cache_key(shortened_url))
+        pipe.pttl(url_cache_key(shortened_url))
+        orig_url, ttl_ms = pipe.execute()
+
+        if orig_url and (orig_url == NEGATIVE_CACHE_MARKER or not self.should_refresh_early(ttl_ms)):
+            orig_url = str(orig_url)
+            self.cache_locally(shortened_url, orig_url)
+            return self.found_or_raise(orig_url)
+
         if not orig_url:
             # print("key not found in redis fetching from db")
+            if self.code_filter is not None and not self.code_filter.might_contain(shortened_url):
+                self.found_or_raise(NEGATIVE_CACHE_MARKER)
+
+        return self.found_or_raise(self.load_url(shortened_url, orig_url))
+
+    def load_url(self, shortened_url: str, stale_url: str | None = None) -> str:
+        """
+        reads the url from dynamodb into the caches, at most once per code at a time
+
+        concurrent loads in this container share one call; across containers a
+        short redis lock elects one loader while the others serve the stale url
+        or wait briefly for the loader to fill the cache
+        :param stale_url: url that is still cached but due for an early refresh
+        :return: the url, or the negative cache marker when a waiter sees it
+        """
+        return self._loads.do(shortened_url, lambda: self._load_shared(shortened_url, stale_url))
+
+    def _load_shared(self, shortened_url: str, stale_url: str | None) -> str:
+        lock_key = url_lock_key(shortened_url)
+        token = str(uuid4())
+        try:
+            locked = self.redis_client.set(lock_key, token, nx=True, px=URL_LOCK_TTL_MS)
+        except Exception as e:
+            logger.warning("failed to take load lock", short_url=shortened_url, error=str(e))
+            locked = False
+
+        if locked:
+            try:
+                return self._read_through(shortened_url)
+            finally:
+                try:
+                    self._release_lock(keys=[lock_key], args=[token])
+                except Exception as e:
+                    logger.warning("failed to release load lock", short_url=shortened_url, error=str(e))
+
+        if stale_url:
+            self.cache_locally(shortened_url, str(stale_url))
+            return str(stale_url)
+
+        deadline = time.monotonic() + URL_LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(URL_LOCK_POLL_INTERVAL)
+            orig_url = self.redis_client.get(url_cache_key(shortened_url))
+            if orig_url:
+                orig_url = str(orig_url)
+                self.cache_locally(shortened_url, orig_url)
+                return orig_url
+
+        return self._read_through(shortened_url)
+
+    def _read_through(self, shortened_url: str) -> str:
+        cache_key = url_cache_key(shortened_url)
+        started = time.perf_counter()
+        try:
             orig_url = self.url_repo.get_url(shortened_url)
-            self.redis_client.set(f"shorturl:{shortened_url}", orig_url, ex=600)
+        except WebException as e:
+            if e.status_code == 404:
+                # nx: never clobber the entry a create wrote through after our read
+                self.redis_client.set(cache_key, NEGATIVE_CACHE_MARKER, ex=NEGATIVE_CACHE_TTL, nx=True)
+                self.cache_locally(shortened_url, NEGATIVE_CACHE_MARKER)
+            raise
+        finally:
+            self._load_estimate += (time.perf_counter() - started - self._load_estimate) * 0.2
+
+        orig_url = str(orig_url)
+        self.redis_client.set(cache_key, orig_url, ex=self.cache_ttl_for(shortened_url))
+        self.cache_locally(shortened_url, orig_url)
+
+        return orig_url
+
+    def cache_ttl_for(self, shortened_url: str) -> int:
+        if self.hot_keys is not None and self.hot_keys.is_hot(shortened_url):
+            return HOT_URL_CACHE_TTL
+
+        return URL_CACHE_TTL
+
+    def should_refresh_early(self, ttl_ms: int | None) -> bool:
+        """
+        xfetch: the closer the key is to expiring, relative to how long a db
+        read takes, the more likely a reader refreshes it ahead of time
+        """
+        if ttl_ms is None or ttl_ms < 0:
+            return False
+
+        gap = self._load_estimate * URL_XFETCH_BETA * -math.log(1.0 - random.random())
+        return gap * 1000 >= ttl_ms
+
+    def accept_cached_url(self, shortened_url: str, orig_url: str, ttl_ms: int | None = None):
+        """
+        takes a url another redis read already fetched, unless the key is due
+        for an early refresh, in which case the next lookup refreshes it
+        """
+        if orig_url != NEGATIVE_CACHE_MARKER and self.should_refresh_early(ttl_ms):
+            if len(self._pending_refresh) >= _MAX_PENDING_REFRESHES:
+                self._pending_refresh.clear()
+            self._pending_refresh[shortened_url] = orig_url
+            return
+
+        self.cache_locally(shortened_url, orig_url)
+
+    def get_urls_by_user(self, user_id: str, limit: int = URL_LIST_PAGE_SIZE, cursor: str | None = None,
+                         newest_first: bool = True) -> dict:
+        """
+        one page of the user's short urls in creation order, served from a per
+        user redis cache that creates invalidate
+        :return: {"shortUrls": [...], "nextCursor": cursor for the next page or None}
+        """
+        cache_key = user_urls_key(user_id)
+        page_field = f"{'desc' if newest_first else 'asc'}:{limit}:{cursor or ''}"
+        try:
+            cached_page = self.redis_client.hget(cache_key, page_field)
+            if cached_page:
+                return json.loads(cached_page)
+        except Exception as e:
+            logger.warning("failed to read cached url listing", user_id=user_id, error=str(e))
+
+        start_key = None
+        if cursor:
+            start_key = decode_cursor(cursor)
+            if not self._is_listing_key(start_key, user_id):
+                # a cursor from someone else's listing, or one that was edited
+                raise WebException(
+                    status_code=400,
+                    message="Invalid page cursor",
+                    error_code=ErrorCodes.INVALID_CURSOR
+                )
+
+        short_urls, last_key = self.url_repo.get_urls_by_user_id(user_id, limit, start_key, newest_first)
+        page = {
+            "shortUrls": [short_url.model_dump(mode='json') for short_url in short_urls],
+            "nextCursor": encode_cursor(last_key) if last_key is not None else None,
+        }
+
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.hset(cache_key, page_field, json.dumps(page))
+            pipe.expire(cache_key, URL_LIST_CACHE_TTL)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("failed to cache url listing", user_id=user_id, error=str(e))
+
+        return page
+
+    @staticmethod
+    def _is_listing_key(key: dict, user_id: str) -> bool:
+        """
+        whether key is an OWNER_CREATED_INDEX key of the user's listing;
+        anything else would fail the query with a ValidationException
+        """
+        created_at = key.get("CreatedAt")
+        return (
+            key.keys() == {"PK", "SK", "ListedBy", "CreatedAt"}
+            and key["PK"] == f"USER#{user_id}"
+            and key["ListedBy"] == user_id
+            and isinstance(key["SK"], str) and key["SK"].startswith("SHORTURL#")
+            and isinstance(created_at, Decimal) and created_at.is_finite()
+            and created_at == created_at.to_integral_value()
+        )
+
+    def cache_locally(self, shortened_url: str, orig_url: str):
+        if self.local_cache is None:
+            return
+
+        if orig_url == NEGATIVE_CACHE_MARKER:
+            self.local_cache.set(shortened_url, orig_url, ttl=min(NEGATIVE_CACHE_TTL, self.local_cache.ttl))
+        else:
+            self.local_cache.set(shortened_url, orig_url)
+
+    @staticmethod
+    def found_or_raise(orig_url: str) -> str:
+        if orig_url == NEGATIVE_CACHE_MARKER:
+            raise WebException(
+                status_code=404,
+                message="The short URL does not exist",
+                error_code=ErrorCodes.SHORTURL_NOT_FOUND
+            )
 
-        return str(orig_url)
+        return orig_url
 
-    def get_urls_by_user(self, user_id: str) -> list[str]:
-        return self.url_repo.get_urls_by_user_id(user_id)
+    def _report_cache_stats(self):
+        self._lookups += 1
+        if self._lookups % L1_CACHE_STATS_INTERVAL == 0:
+            logger.info("l1 cache stats", **self.local_cache.stats())
@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import deque
+from typing import Callable
+
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class BatchBuffer:
+    """
+    buffers items and hands them to `send` in batches from a background thread
+
+    a batch goes out once max_batch items are waiting or the oldest one is
+    max_age seconds old; flush() pushes out everything that is still pending
+    and waits for it, so callers can drain the buffer before returning
+    """
+
+    def __init__(self, send: Callable[[list[str]], int], max_batch: int, max_age: float, max_pending: int):
+        """
+        :param send: sends one batch and returns how many of its items failed
+        :param max_batch: largest batch handed to send
+        :param max_age: seconds an item may wait for a fuller batch
+        :param max_pending: items buffered before new ones are dropped
+        """
+        self.send = send
+        self.max_batch = max_batch
+        self.max_age = max_age
+        self.max_pending = max_pending
+
+        self._pending: deque[tuple[float, str]] = deque()
+        self._in_flight = 0
+        self._flush_requested = False
+        self._cond = threading.Condition()
+        self._worker: threading.Thread | None = None
+
+        self.sent = 0
+        self.dropped = 0
+        self.batches = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def add(self, item: str):
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+
+            self._pending.append((time.monotonic(), item))
+            self._ensure_worker()
+            self._cond.notify_all()
+
+    def flush(self, timeout: float) -> bool:
+        """
+        :return: False when the buffer could not be drained within timeout
+        """
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            drained = self._cond.wait_for(lambda: not self._pending and self._in_flight == 0, timeout)
+            self._flush_requested = False
+            return drained
+
+    def stats(self) -> dict[str, int | float]:
+        with self._cond:
+            return {
+                "depth": len(self._pending) + self._in_flight,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "batches": self.batches,
+                "last_flush_latency": self.last_flush_latency,
+                "max_flush_latency": self.max_flush_latency,
+            }
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="batch-buffer", daemon=True)
+            self._worker.start()
+
+    def _batch_due(self) -> bool:
+        if not self._pending:
+            return False
+
+        return (self._flush_requested
+                or len(self._pending) >= self.max_batch
+                or time.monotonic() - self._pending[0][0] >= self.max_age)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._batch_due():
+                    timeout = None
+                    if self._pending:
+                        timeout = max(self.max_age - (time.monotonic() - self._pending[0][0]), 0)
+                    self._cond.wait(timeout)
+
+                batch = [self._pending.popleft()[1] for _ in range(min(self.max_batch, len(self._pending)))]
+                self._in_flight += len(batch)
+
+            started = time.perf_counter()
+            try:
+                failed = self.send(batch)
+            except Exception as e:
+                logger.warning("failed to send batch", items=len(batch), error=str(e))
+                failed = len(batch)
+            latency = time.perf_counter() - started
+
+            with self._cond:
+                self._in_flight -= len(batch)
+                self.sent += len(batch) - failed
+                self.dropped += failed
+                self.batches += 1
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(self.max_flush_latency, latency)
+                self._cond.notify_all()
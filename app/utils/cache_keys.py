@@ -0,0 +1,38 @@
+# keys for the same short code share a {hash tag} so multi-key scripts stay
+# on one slot of a clustered (serverless) cache
+
+
+def url_cache_key(short_url: str) -> str:
+    return f"shorturl:{{{short_url}}}"
+
+
+def rate_limit_key(short_url: str, window_start: int) -> str:
+    return f"rl:{{{short_url}}}:{window_start}"
+
+
+def url_lock_key(short_url: str) -> str:
+    return f"shorturl:{{{short_url}}}:lock"
+
+
+def hot_keys_key(window_start: int) -> str:
+    return f"{{hotkeys}}:{window_start}"
+
+
+def user_urls_key(user_id: str) -> str:
+    return f"userurls:{{{user_id}}}"
+
+
+def metrics_counters_key(short_url: str, hour: int) -> str:
+    return f"metrics:{{{short_url}}}:{hour}"
+
+
+def metrics_processing_key(short_url: str, hour: int) -> str:
+    return f"metrics:{{{short_url}}}:{hour}:processing"
+
+
+def metrics_dirty_key(shard: int) -> str:
+    return f"{{metrics:{shard}}}:dirty"
+
+
+def metrics_claims_key(shard: int) -> str:
+    return f"{{metrics:{shard}}}:claims"
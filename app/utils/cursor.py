@@ -0,0 +1,39 @@
+import base64
+import json
+from decimal import Decimal
+
+from app.errors.web_errors import WebException, ErrorCodes
+
+
+def _number(value):
+    # number attributes of a key come back from boto3 as Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"{type(value).__name__} is not a key attribute")
+
+
+def encode_cursor(last_key: dict) -> str:
+    """
+    opaque page cursor for a dynamodb LastEvaluatedKey
+    """
+    encoded = json.dumps(last_key, separators=(",", ":"), default=_number)
+    return base64.urlsafe_b64encode(encoded.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> dict:
+    """
+    :return: the LastEvaluatedKey of a cursor, numbers restored as Decimal
+    """
+    try:
+        last_key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")), parse_int=Decimal, parse_float=Decimal)
+    except ValueError:
+        last_key = None
+
+    if not isinstance(last_key, dict):
+        raise WebException(
+            status_code=400,
+            message="Invalid page cursor",
+            error_code=ErrorCodes.INVALID_CURSOR
+        )
+
+    return last_key
@@ -0,0 +1,109 @@
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+from typing import Any
+
+from app.constants import LOG_LEVEL
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    one json object per record; extra fields passed to StructuredLogger are
+    merged in, callables among them are only evaluated here
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in getattr(record, "fields", {}).items():
+            entry[key] = value() if callable(value) else value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+def configure():
+    """
+    installs the json handler on the "app" logger once; LOG_LEVEL sets the
+    default level and LOG_LEVELS overrides it per module, e.g.
+    LOG_LEVELS="app.service.rate_limiter=DEBUG,app.repository=WARNING"
+    """
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonFormatter())
+        app_logger = logging.getLogger("app")
+        app_logger.handlers = [handler]
+        # the lambda runtime puts its own handler on the root logger
+        app_logger.propagate = False
+        app_logger.setLevel(os.environ.get("LOG_LEVEL", LOG_LEVEL).upper())
+
+        for override in filter(None, os.environ.get("LOG_LEVELS", "").split(",")):
+            name, _, level = override.partition("=")
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+        _configured = True
+
+
+class StructuredLogger:
+    """
+    thin wrapper over a stdlib logger taking structured fields as keyword
+    arguments; nothing is formatted unless the level is enabled, and
+    sample=N emits only every Nth call for that message
+    """
+
+    def __init__(self, logger: logging.Logger):
+        self._logger = logger
+        self._samples: dict[str, itertools.count] = {}
+
+    def is_enabled_for(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def debug(self, msg: str, *, sample: int = 1, **fields: Any):
+        self._log(logging.DEBUG, msg, sample, fields)
+
+    def info(self, msg: str, *, sample: int = 1, **fields: Any):
+        self._log(logging.INFO, msg, sample, fields)
+
+    def warning(self, msg: str, *, sample: int = 1, **fields: Any):
+        self._log(logging.WARNING, msg, sample, fields)
+
+    def error(self, msg: str, **fields: Any):
+        self._log(logging.ERROR, msg, 1, fields)
+
+    def exception(self, msg: str, **fields: Any):
+        self._log(logging.ERROR, msg, 1, fields, exc_info=True)
+
+    def _log(self, level: int, msg: str, sample: int, fields: dict[str, Any], exc_info: bool = False):
+        if not self._logger.isEnabledFor(level):
+            return
+
+        if sample > 1:
+            counter = self._samples.get(msg)
+            if counter is None:
+                counter = self._samples.setdefault(msg, itertools.count())
+            if next(counter) % sample:
+                return
+            fields["sample"] = sample
+
+        self._logger.log(level, msg, exc_info=exc_info, extra={"fields": fields}, stacklevel=3)
+
+
+def get_logger(name: str) -> StructuredLogger:
+    configure()
+    return StructuredLogger(logging.getLogger(name))
+
@@ -0,0 +1,145 @@
+from bisect import bisect_right
+from typing import Iterable
+
+from hashids import Hashids, _reorder
+
+from app.constants import HASHID_SALT, SHORT_CODE_MIN_LENGTH
+
+_POWERS_OF_TEN = [10 ** i for i in range(40)]
+
+
+class ShortCodeCodec:
+    """
+    hashids compatible codec for the single integer behind every short code
+
+    hashids re-shuffles its alphabet for every encode, but for one value the
+    shuffle only depends on the lottery character, so all shuffled alphabets
+    (and their reverse lookups) are derived once here and reused
+    """
+
+    def __init__(self, salt: str, min_length: int):
+        hashids = Hashids(salt=salt, min_length=min_length)
+        self.min_length = min_length
+        self._hashids = hashids
+        self._alphabet: str = hashids._alphabet
+        self._guards: str = hashids._guards
+        self._separators = frozenset(hashids._separators)
+        self._len_alphabet = len(self._alphabet)
+        self._lottery_index = {char: i for i, char in enumerate(self._alphabet)}
+
+        self._shuffled: list[str] = []
+        self._unshuffled: list[dict[str, int]] = []
+        for lottery in self._alphabet:
+            shuffled = _reorder(self._alphabet, (lottery + salt + self._alphabet)[:self._len_alphabet])
+            self._shuffled.append(shuffled)
+            self._unshuffled.append({char: i for i, char in enumerate(shuffled)})
+
+        # padding alphabets for codes shorter than min_length, filled on demand
+        self._padding: list[list[str]] = [[] for _ in self._alphabet]
+
+    def encode(self, value: int) -> str:
+        # counters read back from dynamo are Decimals, which cannot index the alphabet
+        value = int(value)
+        values_hash = value % 100
+        lottery_index = values_hash % self._len_alphabet
+        alphabet = self._shuffled[lottery_index]
+
+        hashed = ""
+        number = value
+        while True:
+            hashed = alphabet[number % self._len_alphabet] + hashed
+            number //= self._len_alphabet
+            if not number:
+                break
+
+        encoded = self._alphabet[lottery_index] + hashed
+        if len(encoded) >= self.min_length:
+            return encoded
+
+        return self._pad(encoded, lottery_index, values_hash)
+
+    def decode(self, short_url: str) -> int | None:
+        """
+        :return: the encoded integer, or None when the code is not one this codec issues
+        """
+        if not short_url:
+            return None
+
+        parts = short_url
+        for guard in self._guards:
+            parts = parts.replace(guard, " ")
+        parts = parts.split(" ")
+        hashid = parts[1] if 2 <= len(parts) <= 3 else parts[0]
+        if not hashid:
+            return None
+
+        lottery_index = self._lottery_index.get(hashid[0])
+        if lottery_index is None:
+            return None
+
+        positions = self._unshuffled[lottery_index]
+        value = 0
+        for char in hashid[1:]:
+            position = positions.get(char)
+            if position is None:
+                return None
+            value = value * self._len_alphabet + position
+
+        return value if self.encode(value) == short_url else None
+
+    @staticmethod
+    def compose(tier: int, counter: int) -> int:
+        """
+        prefixes the decimal counter with the subscription tier digit
+        """
+        counter = int(counter)
+        digits = bisect_right(_POWERS_OF_TEN, counter) or 1
+        return tier * _POWERS_OF_TEN[digits] + counter
+
+    @staticmethod
+    def tier_of(value: int) -> int:
+        return value // _POWERS_OF_TEN[bisect_right(_POWERS_OF_TEN, value) - 1]
+
+    @staticmethod
+    def counter_of(value: int) -> int:
+        return value % _POWERS_OF_TEN[bisect_right(_POWERS_OF_TEN, value) - 1]
+
+    def encode_many(self, values: Iterable[int]) -> list[str]:
+        encode = self.encode
+        return [encode(value) for value in values]
+
+    def decode_many(self, short_urls: Iterable[str]) -> list[int | None]:
+        decode = self.decode
+        return [decode(short_url) for short_url in short_urls]
+
+    def tier_of_many(self, values: Iterable[int]) -> list[int]:
+        tier_of = self.tier_of
+        return [tier_of(value) for value in values]
+
+    def _pad(self, encoded: str, lottery_index: int, values_hash: int) -> str:
+        guards = self._guards
+        encoded = guards[(values_hash + ord(encoded[0])) % len(guards)] + encoded
+
+        if len(encoded) < self.min_length:
+            encoded += guards[(values_hash + ord(encoded[2])) % len(guards)]
+
+        paddings = self._padding[lottery_index]
+        split_at = self._len_alphabet // 2
+        rounds = 0
+        while len(encoded) < self.min_length:
+            if rounds == len(paddings):
+                previous = paddings[-1] if paddings else self._shuffled[lottery_index]
+                paddings.append(_reorder(previous, previous))
+            alphabet = paddings[rounds]
+            rounds += 1
+
+            encoded = alphabet[split_at:] + encoded + alphabet[:split_at]
+            excess = len(encoded) - self.min_length
+            if excess > 0:
+                from_index = excess // 2
+                encoded = encoded[from_index:from_index + self.min_length]
+
+        return encoded
+
+
+short_code_codec = ShortCodeCodec(salt=HASHID_SALT, min_length=SHORT_CODE_MIN_LENGTH)
@@ -0,0 +1,321 @@
+import hashlib
+import heapq
+import math
+import re
+import struct
+import zlib
+from array import array
+from typing import Iterable
+
+
+class CountMinSketch:
+    """
+    approximate per key counters in a fixed width x depth table; estimates
+    never undercount and overcount by at most ~2/width of the total with
+    probability 1 - (1/2)^depth
+    """
+
+    def __init__(self, width: int, depth: int):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self._rows = [array('Q', bytes(8 * width)) for _ in range(depth)]
+
+    def _columns(self, key: str) -> list[int]:
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key: str, count: int = 1) -> int:
+        """
+        :return: the key's estimate after the update
+        """
+        self.total += count
+        estimate = None
+        for row, column in zip(self._rows, self._columns(key)):
+            row[column] += count
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+
+        return estimate
+
+    def estimate(self, key: str) -> int:
+        return min(row[column] for row, column in zip(self._rows, self._columns(key)))
+
+    def clear(self):
+        self.total = 0
+        self._rows = [array('Q', bytes(8 * self.width)) for _ in range(self.depth)]
+
+
+class TopK:
+    """
+    the k keys with the highest estimates seen so far, kept in a min heap
+    with lazily discarded stale entries
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self._counts: dict[str, int] = {}
+        self._heap: list[tuple[int, str]] = []
+
+    def offer(self, key: str, estimate: int):
+        if key not in self._counts and len(self._counts) >= self.k:
+            if estimate <= self._min():
+                return
+            _, evicted = heapq.heappop(self._heap)
+            del self._counts[evicted]
+
+        self._counts[key] = estimate
+        heapq.heappush(self._heap, (estimate, key))
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(count, key) for key, count in self._counts.items()]
+            heapq.heapify(self._heap)
+
+    def _min(self) -> int:
+        # drops heap entries superseded by a newer estimate for the same key
+        while self._heap[0][0] != self._counts.get(self._heap[0][1]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0]
+
+    def items(self) -> list[tuple[str, int]]:
+        """
+        :return: (key, estimate) pairs, highest first
+        """
+        return sorted(self._counts.items(), key=lambda item: item[1], reverse=True)
+
+    def clear(self):
+        self._counts.clear()
+        self._heap.clear()
+
+
+class HotKeySketch:
+    """
+    count-min sketch feeding a top-k heap, memory stays constant no matter
+    how many distinct keys are added
+    """
+
+    def __init__(self, width: int, depth: int, k: int):
+        self.counts = CountMinSketch(width, depth)
+        self.top = TopK(k)
+
+    def add(self, key: str, count: int = 1):
+        self.top.offer(key, self.counts.add(key, count))
+
+    def top_keys(self) -> list[tuple[str, int]]:
+        return self.top.items()
+
+    def clear(self):
+        self.counts.clear()
+        self.top.clear()
+
+
+def misra_gries_trim(counts: dict, k: int) -> tuple[dict, int, int]:
+    """
+    weighted misra-gries step over plain counters: when more than k keys are
+    held, the (k+1)th largest count t is taken off every key and keys left
+    at zero or below are dropped
+
+    every remaining count undercounts its key by at most t, and since each
+    trim takes at least t * (k + 1) out of the total, the trims over a whole
+    stream of n hits undercount any key by at most n / (k + 1)
+    :return: (new counts of the kept keys, mass taken off, t)
+    """
+    if len(counts) <= k:
+        return counts, 0, 0
+
+    threshold = heapq.nlargest(k + 1, counts.values())[-1]
+    kept = {}
+    removed = 0
+    for key, count in counts.items():
+        if count > threshold:
+            kept[key] = count - threshold
+            removed += threshold
+        else:
+            removed += count
+
+    return kept, removed, threshold
+
+
+# scans the registers in c, a sparse sketch only has a few set
+_NON_ZERO = re.compile(rb"[^\x00]")
+# (uint16 index, uint8 rank) of a sparse register
+_SPARSE_REGISTER = struct.Struct(">HB")
+
+
+class HyperLogLog:
+    """
+    mergeable distinct counter over 64 bit hashes with 2^precision one byte
+    registers; the standard error is about 1.04 / sqrt(2^precision) and
+    merging is a per register max, so adding the same values again or
+    merging a sketch twice never changes the estimate
+    """
+
+    # dense: zlib compressed registers, sparse: (uint16 index, uint8 rank)
+    # pairs of the non zero registers, cheaper to build for small sketches
+    _DENSE, _SPARSE = 1, 2
+    _SPARSE_PAIR = 3
+    # 2^-rank for every rank a register can hold
+    _INVERSE_POWERS = [2.0 ** -rank for rank in range(65)]
+
+    def __init__(self, precision: int, registers: bytearray | None = None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = registers if registers is not None else bytearray(self.size)
+        self._rest_bits = 64 - precision
+        self._rest_mask = (1 << self._rest_bits) - 1
+
+    @staticmethod
+    def hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    @classmethod
+    def of_hashes(cls, precision: int, hashes: Iterable[int]) -> "HyperLogLog":
+        sketch = cls(precision)
+        add_hash = sketch.add_hash
+        for value_hash in hashes:
+            add_hash(value_hash)
+        return sketch
+
+    @classmethod
+    def of_registers(cls, precision: int, registers: dict[int, int]) -> "HyperLogLog":
+        """
+        :param registers: index -> rank of the non zero registers, see register_of
+        """
+        sketch = cls(precision)
+        for index, rank in registers.items():
+            sketch.registers[index] = rank
+        return sketch
+
+    def add(self, value: str):
+        self.add_hash(self.hash(value))
+
+    @staticmethod
+    def register_of(precision: int, value_hash: int) -> tuple[int, int]:
+        """
+        :return: the (index, rank) a hash updates, see add_hash
+        """
+        rest_bits = 64 - precision
+        return value_hash >> rest_bits, rest_bits - (value_hash & ((1 << rest_bits) - 1)).bit_length() + 1
+
+    @staticmethod
+    def hash_of_register(precision: int, index: int, rank: int) -> int:
+        """
+        :return: a hash that sets register index to rank, so registers kept
+            elsewhere can be added back like any other hash
+        """
+        rest_bits = 64 - precision
+        return index << rest_bits | (1 << (rest_bits - rank) if rank <= rest_bits else 0)
+
+    def add_hash(self, value_hash: int):
+        index = value_hash >> self._rest_bits
+        rank = self._rest_bits - (value_hash & self._rest_mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> bool:
+        """
+        :return: whether any register grew
+        """
+        if other.precision != self.precision:
+            raise ValueError(f"cannot merge precision {other.precision} into {self.precision}")
+
+        registers = self.registers
+        changed = False
+        for index, rank in enumerate(other.registers):
+            if rank > registers[index]:
+                registers[index] = rank
+                changed = True
+        return changed
+
+    def count(self) -> int:
+        registers = self.registers
+        inverse_powers = self._INVERSE_POWERS
+        # a few dozen distinct ranks, counted in c rather than summed per register
+        harmonic = sum(inverse_powers[rank] * registers.count(rank) for rank in set(registers))
+        return self._estimate(self.size, harmonic, registers.count(0))
+
+    @classmethod
+    def count_of_registers(cls, precision: int, registers: dict[int, int]) -> int:
+        """
+        count() of the sketch of_registers would build, without building it
+        """
+        size = 1 << precision
+        empty = size - len(registers)
+        if empty > 0.3 * size:
+            # an empty register adds 2^-0 to the harmonic sum, this many keep
+            # the estimate in the linear counting range whatever the ranks are
+            return round(size * math.log(size / empty))
+
+        inverse_powers = cls._INVERSE_POWERS
+        return cls._estimate(size, empty + sum(inverse_powers[rank] for rank in registers.values()), empty)
+
+    @staticmethod
+    def _estimate(size: int, harmonic: float, empty: int) -> int:
+        estimate = (0.7213 / (1 + 1.079 / size)) * size * size / harmonic
+        if empty and estimate <= 2.5 * size:
+            # linear counting is more accurate while many registers are unused
+            estimate = size * math.log(size / empty)
+
+        return round(estimate)
+
+    def to_bytes(self) -> bytes:
+        registers = self.registers
+        used = self.size - registers.count(0)
+        if used * 16 > self.size:
+            return bytes((self._DENSE, self.precision)) + zlib.compress(bytes(registers))
+
+        sparse = bytearray((self._SPARSE, self.precision))
+        for match in _NON_ZERO.finditer(registers):
+            sparse += match.start().to_bytes(2, 'big')
+            sparse += match.group()
+        return bytes(sparse)
+
+    @classmethod
+    def bytes_of_registers(cls, precision: int, registers: dict[int, int]) -> bytes:
+        """
+        to_bytes() of the sketch of_registers would build; a sparse one is
+        written straight from the registers
+        """
+        if len(registers) * 16 > 1 << precision:
+            return cls.of_registers(precision, registers).to_bytes()
+
+        pack = _SPARSE_REGISTER.pack
+        return b"".join([bytes((cls._SPARSE, precision)), *[pack(index, registers[index]) for index in sorted(registers)]])
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        if len(data) < 2 or data[0] not in (cls._DENSE, cls._SPARSE) or not 4 <= data[1] <= 16:
+            raise ValueError("unsupported hyperloglog encoding")
+
+        precision = data[1]
+        size = 1 << precision
+        if data[0] == cls._SPARSE:
+            body = memoryview(data)[2:]
+            if len(body) % cls._SPARSE_PAIR:
+                raise ValueError("truncated hyperloglog registers")
+            registers = bytearray(size)
+            for offset in range(0, len(body), cls._SPARSE_PAIR):
+                index = int.from_bytes(body[offset:offset + 2], 'big')
+                if index >= size:
+                    raise ValueError("hyperloglog register out of range")
+                registers[index] = body[offset + 2]
+            return cls(precision, registers)
+
+        try:
+            registers = bytearray(zlib.decompress(data[2:]))
+        except zlib.error as e:
+            raise ValueError("corrupt hyperloglog registers") from e
+        if len(registers) != size:
+            raise ValueError("hyperloglog registers do not match their precision")
+        return cls(precision, registers)
+
+    @classmethod
+    def union(cls, sketches: Iterable["HyperLogLog"]) -> "HyperLogLog | None":
+        merged = None
+        for sketch in sketches:
+            if merged is None:
+                merged = cls(sketch.precision, bytearray(sketch.registers))
+            else:
+                merged.merge(sketch)
+        return merged
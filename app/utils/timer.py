@@ -1,17 +1,26 @@
+import logging
 import time
 import functools
 
+from app.constants import LOG_HOT_PATH_SAMPLE
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
 def log_performance(func):
     """Decorator to measure the execution time of a function."""
+    message = f"{func.__qualname__} finished"
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
+        if not logger.is_enabled_for(logging.DEBUG):
+            return func(*args, **kwargs)
+
         start_time = time.perf_counter()
         try:
             return func(*args, **kwargs)
-        except:
-            raise
         finally:
-            end_time = time.perf_counter()
-            run_time = end_time - start_time
-            print(f"Function {func.__name__!r} took {run_time:.4f} seconds to execute.")
-    return wrapper
\ No newline at end of file
+            run_time = time.perf_counter() - start_time
+            logger.debug(message, function=func.__qualname__, seconds=round(run_time, 4), sample=LOG_HOT_PATH_SAMPLE)
+    return wrapper
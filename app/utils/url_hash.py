@@ -0,0 +1,39 @@
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str) -> str:
+    """
+    canonical form used to spot the same destination shortened twice:
+    https is assumed when no scheme is given (as the redirect does), scheme
+    and host are lowercased and default ports are dropped. fragments are kept
+    since single page apps route on them. a url whose port cannot be read is
+    returned as given
+    """
+    url = url.strip()
+    parts = urlsplit(url)
+    # "example.com:8080/a" splits into scheme "example.com" and no host
+    if not parts.scheme or not parts.netloc:
+        parts = urlsplit(f"https://{url}")
+
+    try:
+        port = parts.port
+    except ValueError:
+        return url
+
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    netloc = host
+    if port is not None and port != _DEFAULT_PORTS.get(scheme):
+        netloc = f"{host}:{port}"
+    if parts.username is not None:
+        credentials = parts.username if parts.password is None else f"{parts.username}:{parts.password}"
+        netloc = f"{credentials}@{netloc}"
+
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, parts.fragment))
+
+
+def url_hash(url: str) -> str:
+    return hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
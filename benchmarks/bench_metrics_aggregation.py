@@ -0,0 +1,95 @@
+"""
+compares the per message pydantic aggregation process_event used to do with
+MetricsAggregator and its single pass batch validation; the aggregator also
+builds the hour and month rollups and the per day and month visitor
+sketches the old path never had
+
+    python -m benchmarks.bench_metrics_aggregation
+"""
+import datetime
+import json
+import random
+import timeit
+
+from app.models.metrics import AccessMetricsSQSMessage, DailyAccessMetrics, DeviceType, MetricsGranularity
+from app.service.metrics_aggregator import MetricsAggregator
+
+BATCH_SIZES = [100, 1_000, 10_000]
+START = int(datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc).timestamp())
+
+
+def make_records(count: int, rng=random.Random(7)) -> list[dict]:
+    urls = [f"code{i}" for i in range(50)]
+    countries = ["IN", "US", "DE", "BR", "unknown"]
+    referrers = ["none", "https://t.co", "https://news.ycombinator.com", None]
+    return [
+        {
+            "messageId": str(i),
+            "body": json.dumps({
+                "url": rng.choice(urls),
+                "ip": "1.1.1.1",
+                "timestamp": START + rng.randrange(2 * 86400),
+                "referrer": rng.choice(referrers),
+                "user_agent": "Mozilla/5.0",
+                "country": rng.choice(countries),
+                "device": rng.choice(list(DeviceType)),
+            }),
+        }
+        for i in range(count)
+    ]
+
+
+def pydantic_aggregate(records: list[dict]) -> list[DailyAccessMetrics]:
+    messages = [AccessMetricsSQSMessage(message_id=r["messageId"], **json.loads(r["body"])) for r in records]
+
+    daily_metrics: dict[tuple[str, str], DailyAccessMetrics] = {}
+    for message in messages:
+        day = datetime.datetime.fromtimestamp(message.timestamp, tz=datetime.timezone.utc).strftime('%Y-%m-%d')
+        existing = daily_metrics.get((message.url, day))
+        if existing:
+            existing.total_hits += 1
+            existing.message_ids.append(message.message_id)
+            existing.by_country[message.country] = existing.by_country.get(message.country, 0) + 1
+            existing.by_device_type[message.device] = existing.by_device_type.get(message.device, 0) + 1
+            existing.by_referrer[message.referrer] = existing.by_referrer.get(message.referrer, 0) + 1
+        else:
+            daily_metrics[(message.url, day)] = DailyAccessMetrics(
+                ShortURL=message.url,
+                Day=day,
+                TotalHits=1,
+                ByCountry={message.country: 1},
+                ByDeviceType={message.device: 1},
+                ByReferrer={message.referrer: 1},
+                message_ids=[message.message_id],
+            )
+
+    return list(daily_metrics.values())
+
+
+def aggregator_aggregate(records: list[dict], period_labels: dict[int, tuple[str, str, str]] = {}) -> list[DailyAccessMetrics]:
+    aggregator = MetricsAggregator(period_labels)
+    aggregator.add_records(records)
+    return aggregator.results()
+
+
+def main():
+    for size in BATCH_SIZES:
+        records = make_records(size)
+        expected = {(m.short_url, m.day): m.total_hits for m in pydantic_aggregate(records)}
+        assert expected == {
+            (m.short_url, m.day): m.total_hits
+            for m in aggregator_aggregate(records)
+            if m.granularity is MetricsGranularity.DAY
+        }
+
+        timings = {}
+        for name, bench in [("pydantic", pydantic_aggregate), ("aggregator", aggregator_aggregate)]:
+            # small batches are run many times over so a timing is not one scheduler tick
+            number = max(1, 10_000 // size)
+            timings[name] = min(timeit.repeat(lambda: bench(records), number=number, repeat=7)) / number
+            print(f"{size:>6} records {name:<12} {timings[name] / size * 1e6:8.2f} us/record")
+        print(f"{size:>6} records speedup      {timings['pydantic'] / timings['aggregator']:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+compares per-call Hashids construction (what the services used to do) with
+the shared ShortCodeCodec
+
+    python -m benchmarks.bench_short_code
+"""
+import timeit
+
+import hashids
+
+from app.constants import HASHID_SALT, SHORT_CODE_MIN_LENGTH
+from app.utils.short_code import short_code_codec
+
+VALUES = [int(f"{tier}{counter}") for tier in (1, 2) for counter in range(100_000, 105_000)]
+CODES = short_code_codec.encode_many(VALUES)
+
+
+def per_call_encode():
+    for value in VALUES:
+        hashids.Hashids(salt=HASHID_SALT, min_length=SHORT_CODE_MIN_LENGTH).encode(value)
+
+
+def per_call_decode():
+    for code in CODES:
+        decoded = hashids.Hashids(salt=HASHID_SALT, min_length=SHORT_CODE_MIN_LENGTH).decode(code)
+        str(decoded[0]).startswith("1")
+
+
+def shared_hashids_decode(encoder=hashids.Hashids(salt=HASHID_SALT, min_length=SHORT_CODE_MIN_LENGTH)):
+    for code in CODES:
+        encoder.decode(code)
+
+
+def codec_encode():
+    encode = short_code_codec.encode
+    for value in VALUES:
+        encode(value)
+
+
+def codec_decode():
+    decode, tier_of = short_code_codec.decode, short_code_codec.tier_of
+    for code in CODES:
+        tier_of(decode(code))
+
+
+def codec_batch():
+    short_code_codec.tier_of_many(short_code_codec.decode_many(CODES))
+
+
+def main():
+    benchmarks = [
+        ("hashids per call encode", per_call_encode),
+        ("hashids per call decode + tier", per_call_decode),
+        ("hashids shared decode", shared_hashids_decode),
+        ("codec encode", codec_encode),
+        ("codec decode + tier", codec_decode),
+        ("codec batch decode + tier", codec_batch),
+    ]
+
+    for name, bench in benchmarks:
+        best = min(timeit.repeat(bench, number=1, repeat=5))
+        print(f"{name:<32} {best / len(VALUES) * 1e6:8.2f} us/op")
+
+
+if __name__ == "__main__":
+    main()
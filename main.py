@@ -32,7 +32,7 @@ def main():
     #     print(e)
     # print(hashids.Hashids(salt=HASHID_SALT, min_length=7).decode("Yo6eY67")[0])
     print(hashids.Hashids(salt=HASHID_SALT, min_length=8).encode("ds"))
-    repo.save_metrics([
+    repo.save_metrics([[metric] for metric in [
         DailyAccessMetrics(
             ByCountry={
                 "IN":10,
@@ -61,7 +61,7 @@ def main():
             },
             Day= "2026-01-25"
         )
-    ])
+    ]])
     table = db.Table(DYNAMO_DB_TABLE_NAME)
 
     # item = table.get_item(Key={
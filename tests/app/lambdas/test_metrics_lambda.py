@@ -3,7 +3,7 @@ import unittest
 from unittest.mock import MagicMock, patch
 
 from app.lambdas import metrics as metrics_lambda
-from app.models.metrics import DailyAccessMetrics
+from app.models.metrics import DailyAccessMetrics, MetricsGranularity
 
 
 class TestMetricsLambda(unittest.TestCase):
@@ -43,6 +43,17 @@ class TestMetricsLambda(unittest.TestCase):
                 self.assertEqual(case["expect_result"], result)
                 self.mock_service.process_event.assert_called()
 
+    def test_flush_metrics(self):
+        self.mock_service.flush_counters.return_value = {"flushed": 12, "released": 1}
+
+        ctx = MagicMock()
+
+        result = metrics_lambda.flush_metrics({}, ctx)
+
+        self.assertEqual({"flushed": 12, "released": 1}, result)
+        # the flush stops before the invocation runs out of time
+        self.mock_service.flush_counters.assert_called_once_with(ctx.get_remaining_time_in_millis)
+
     def test_get_url_metrics(self):
         metric = DailyAccessMetrics(
             ShortURL="abc",
@@ -64,6 +75,30 @@ class TestMetricsLambda(unittest.TestCase):
                 "metrics": [metric],
                 "expect_status": 200,
                 "expect_short_url": "abc",
+                "expect_call": {"start_day": "2023-01-01", "end_day": "2023-01-02", "granularity": None},
+            },
+            {
+                "name": "granularity is passed through",
+                "event": {
+                    "headers": {"Authorization": "Bearer good"},
+                    "pathParameters": {"short_url": "abc"},
+                    "queryStringParameters": {"startDate": "2023-01-01", "endDate": "2023-03-31", "granularity": "month"},
+                },
+                "metrics": [metric],
+                "expect_status": 200,
+                "expect_short_url": "abc",
+                "expect_call": {"start_day": "2023-01-01", "end_day": "2023-03-31", "granularity": MetricsGranularity.MONTH},
+            },
+            {
+                "name": "unknown granularity",
+                "event": {
+                    "headers": {"Authorization": "Bearer good"},
+                    "pathParameters": {"short_url": "abc"},
+                    "queryStringParameters": {"startDate": "2023-01-01", "endDate": "2023-01-02", "granularity": "week"},
+                },
+                "metrics": [],
+                "expect_status": 422,
+                "expect_error_code": metrics_lambda.ErrorCodes.VALIDATION_ERROR,
             },
             {
                 "name": "missing path parameters",
@@ -88,4 +123,58 @@ class TestMetricsLambda(unittest.TestCase):
                     self.assertEqual(case["expect_short_url"], body[0]["short_url"])
                 if "expect_error_code" in case:
                     self.assertEqual(case["expect_error_code"], body["code"])
+                if "expect_call" in case:
+                    self.mock_service.get_metrics_by_url.assert_called_with(url="abc", user_id="user-1", **case["expect_call"])
 
+    def test_get_url_visitors(self):
+        cases = [
+            {
+                "name": "unique visitors of the range",
+                "event": {
+                    "headers": {"Authorization": "Bearer good"},
+                    "pathParameters": {"short_url": "abc"},
+                    "queryStringParameters": {"startDate": "2023-01-01", "endDate": "2023-02-15"},
+                },
+                "expect_status": 200,
+                "expect_body": {
+                    "short_url": "abc",
+                    "start_date": "2023-01-01",
+                    "end_date": "2023-02-15",
+                    "unique_visitors": 17,
+                },
+            },
+            {
+                "name": "invalid date",
+                "event": {
+                    "headers": {"Authorization": "Bearer good"},
+                    "pathParameters": {"short_url": "abc"},
+                    "queryStringParameters": {"startDate": "yesterday"},
+                },
+                "expect_status": 422,
+                "expect_error_code": metrics_lambda.ErrorCodes.VALIDATION_ERROR,
+            },
+            {
+                "name": "missing path parameters",
+                "event": {"headers": {"Authorization": "Bearer good"}, "pathParameters": None},
+                "expect_status": 404,
+                "expect_error_code": metrics_lambda.ErrorCodes.SHORTURL_NOT_FOUND,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.mock_service.get_unique_visitors_by_url.return_value = 17
+
+                with patch("app.utils.auth_decorator.jwt.decode", return_value=self.jwt_payload):
+                    resp = metrics_lambda.get_url_visitors(case["event"], None)
+
+                self.assertEqual(case["expect_status"], resp["statusCode"])
+                body = json.loads(resp["body"])
+
+                if "expect_body" in case:
+                    self.assertEqual(case["expect_body"], body)
+                    self.mock_service.get_unique_visitors_by_url.assert_called_with(
+                        url="abc", user_id="user-1", start_day="2023-01-01", end_day="2023-02-15"
+                    )
+                if "expect_error_code" in case:
+                    self.assertEqual(case["expect_error_code"], body["code"])
@@ -44,6 +44,40 @@ class TestUrlShortenerLambda(unittest.TestCase):
                 body = json.loads(response["body"])
                 self.assertEqual(case["expect_short_url"], body["shortUrl"])
 
+    def test_create_shorturls_batch_handler(self):
+        cases = [
+            {
+                "name": "all created",
+                "body": {"urls": ["a.com", "b.com"]},
+                "service_return": [{"url": "a.com", "shortUrl": "x"}, {"url": "b.com", "shortUrl": "y"}],
+                "expect_status": 201,
+            },
+            {
+                "name": "partial failure",
+                "body": {"urls": ["a.com", "b.com"]},
+                "service_return": [{"url": "a.com", "shortUrl": "x"}, {"url": "b.com", "error": "failed"}],
+                "expect_status": 207,
+            },
+            {
+                "name": "empty batch is rejected",
+                "body": {"urls": []},
+                "service_return": [],
+                "expect_status": 422,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.mock_url_service.create_short_urls.return_value = case["service_return"]
+                event = {"headers": {"Authorization": "Bearer token"}, "body": json.dumps(case["body"])}
+
+                with patch("app.utils.auth_decorator.jwt.decode", return_value=self.jwt_payload):
+                    response = url_shortener.create_shorturls_batch_handler(event, None)
+
+                self.assertEqual(case["expect_status"], response["statusCode"])
+                if case["expect_status"] != 422:
+                    self.assertEqual(case["service_return"], json.loads(response["body"])["results"])
+
     def test_get_url_handler(self):
         cases = [
             {
@@ -87,26 +121,42 @@ class TestUrlShortenerLambda(unittest.TestCase):
                     self.assertEqual(case["expect_error_code"], body["code"])
 
     def test_get_user_short_urls(self):
+        page = {"shortUrls": ["a", "b"], "nextCursor": "next"}
+
         cases = [
             {
-                "name": "returns user urls",
-                "event": {"headers": {"Authorization": "Bearer token"}},
-                "service_return": ["a", "b"],
+                "name": "returns the first page",
+                "event": {"headers": {"Authorization": "Bearer token"}, "queryStringParameters": None},
                 "expect_status": 200,
-                "expect_urls": ["a", "b"],
+                "expect_args": ("u1", 50, None, True),
+            },
+            {
+                "name": "passes limit and cursor",
+                "event": {"headers": {"Authorization": "Bearer token"},
+                          "queryStringParameters": {"limit": "10", "cursor": "abc", "order": "oldest"}},
+                "expect_status": 200,
+                "expect_args": ("u1", 10, "abc", False),
+            },
+            {
+                "name": "rejects oversized pages",
+                "event": {"headers": {"Authorization": "Bearer token"}, "queryStringParameters": {"limit": "1000"}},
+                "expect_status": 422,
+                "expect_args": None,
             },
         ]
 
         for case in cases:
             with self.subTest(case["name"]):
-                self.mock_url_service.get_urls_by_user.return_value = case["service_return"]
+                self.mock_url_service.get_urls_by_user.reset_mock()
+                self.mock_url_service.get_urls_by_user.return_value = page
                 
                 with patch("app.utils.auth_decorator.jwt.decode", return_value=self.jwt_payload):
                     response = url_shortener.get_user_short_urls(case["event"], None)
                 
                 self.assertEqual(case["expect_status"], response["statusCode"])
-                body = json.loads(response["body"])
-                self.assertEqual(case["expect_urls"], body)
+                if case["expect_args"]:
+                    self.mock_url_service.get_urls_by_user.assert_called_once_with(*case["expect_args"])
+                    self.assertEqual(page, json.loads(response["body"]))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+import json
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from app.errors.web_errors import ErrorCodes
+from app.lambdas import url_shortener_async
+from app.service.rate_limiter import RateLimitingService
+
+
+class TestUrlShortenerAsyncLambda(unittest.TestCase):
+    def setUp(self):
+        self.mock_resolve = AsyncMock()
+        self.resolve_patcher = patch.object(url_shortener_async.redirect_service, "resolve", self.mock_resolve)
+        self.resolve_patcher.start()
+
+    def tearDown(self):
+        self.resolve_patcher.stop()
+
+    def test_get_url_handler(self):
+        cases = [
+            {
+                "name": "allowed no scheme",
+                "resolve_return": "example.com",
+                "expect_status": 302,
+                "expect_location": "https://example.com",
+            },
+            {
+                "name": "allowed with scheme",
+                "resolve_return": "http://withscheme",
+                "expect_status": 302,
+                "expect_location": "http://withscheme",
+            },
+            {
+                "name": "blocked by rate limit",
+                "resolve_error": RateLimitingService.too_many_requests(),
+                "expect_status": 429,
+                "expect_error_code": ErrorCodes.TOO_MANY_REQUESTS,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                event = {
+                    "pathParameters": {"short_url": "stdcode"},
+                    "headers": {},
+                    "requestContext": {"identity": {"sourceIp": "1.1.1.1"}},
+                }
+                self.mock_resolve.side_effect = case.get("resolve_error")
+                self.mock_resolve.return_value = case.get("resolve_return")
+
+                response = url_shortener_async.get_url_handler(event, None)
+
+                self.assertEqual(case["expect_status"], response["statusCode"])
+                if "expect_location" in case:
+                    self.assertEqual(case["expect_location"], response["headers"]["Location"])
+                if "expect_error_code" in case:
+                    body = json.loads(response["body"])
+                    self.assertEqual(case["expect_error_code"], body["code"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,47 +1,201 @@
+import threading
 import unittest
-from unittest.mock import MagicMock
+from datetime import date
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
 
+from boto3.dynamodb.types import Binary
 from botocore.exceptions import ClientError
 
-from app.models.metrics import DailyAccessMetrics
+from app.constants import DYNAMO_DB_TABLE_NAME, VISITOR_MERGE_ATTEMPTS
+from app.models.metrics import DailyAccessMetrics, DeviceType, MetricsGranularity
 from app.repository.metrics_repo import MetricsRepository
+from app.utils.sketch import HyperLogLog
 
 
 class _FakeTable:
-    def __init__(self, put_error_code=None, query_items=None):
-        self.put_calls = []
+    def __init__(self, update_error_code=None, query_items=None, put_error_code=None):
         self.update_calls = []
+        self.put_calls = []
         self.query_items = query_items or []
+        self.update_error_code = update_error_code
         self.put_error_code = put_error_code
 
     def put_item(self, **kwargs):
         self.put_calls.append(kwargs)
         if self.put_error_code:
+            raise ClientError({"Error": {"Code": self.put_error_code, "Message": "boom"}}, "PutItem")
+        return {}
+
+    def update_item(self, **kwargs):
+        self.update_calls.append(kwargs)
+        if self.update_error_code:
             raise ClientError(
                 {
                     "Error": {
-                        "Code": self.put_error_code,
+                        "Code": self.update_error_code,
                         "Message": "boom",
                     }
                 },
-                "PutItem",
+                "UpdateItem",
             )
         return {"ResponseMetadata": {"HTTPStatusCode": 200}}
 
+    def query(self, **kwargs):
+        return {"Items": self.query_items}
+
+
+class _ConcurrentTable(_FakeTable):
+    """
+    every update waits for `in_flight` updates to be running at once, and
+    updates of the urls in `failing` raise
+    """
+
+    def __init__(self, in_flight: int, failing: set[str]):
+        super().__init__()
+        self.barrier = threading.Barrier(in_flight, timeout=2)
+        self.failing = failing
+
     def update_item(self, **kwargs):
-        self.update_calls.append(kwargs)
-        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+        self.barrier.wait()
+        if kwargs["Key"]["PK"].removeprefix("SHORTURL#") in self.failing:
+            raise ClientError({"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "slow down"}}, "UpdateItem")
+        return super().update_item(**kwargs)
+
+
+class _RangeTable(_FakeTable):
+    """
+    answers queries with the items whose SK falls in the queried range
+    """
+
+    def __init__(self, sort_keys: list[str], rollups_since: str | None = "2020-01-01"):
+        super().__init__()
+        self.rollups_since = rollups_since
+        self.items = [
+            {"PK": "SHORTURL#abc", "SK": sk, "ShortURL": "abc", "Day": sk.partition("#")[2], "TotalHits": Decimal(1)}
+            for sk in sort_keys
+        ]
+        self.ranges = []
 
     def query(self, **kwargs):
-        return {"Items": self.query_items}
+        _, sort_key = kwargs["KeyConditionExpression"].get_expression()["values"]
+        _, first, last = sort_key.get_expression()["values"]
+        self.ranges.append((first, last))
+        return {"Items": [item for item in self.items if first <= item["SK"] <= last]}
+
+    def get_item(self, **kwargs):
+        if kwargs["Key"] != {"PK": "METRICS", "SK": "ROLLUPS"} or self.rollups_since is None:
+            return {}
+        return {"Item": {**kwargs["Key"], "Since": self.rollups_since}}
+
+
+class _CompactingTable(_FakeTable):
+    """
+    the upsert hands back `item`, the compaction fails with `compact_error_code`
+    """
+
+    def __init__(self, item: dict, compact_error_code=None):
+        super().__init__()
+        self.item = item
+        self.compact_error_code = compact_error_code
+
+    def update_item(self, **kwargs):
+        self.update_calls.append(kwargs)
+        if "ConditionExpression" in kwargs and self.compact_error_code:
+            raise ClientError({"Error": {"Code": self.compact_error_code, "Message": "moved"}}, "UpdateItem")
+        return {"Attributes": self.item}
+
+
+class _VisitorTable(_FakeTable):
+    """
+    keeps one item; `races` other writers merge `rival` into its visitor
+    sketch just before this writer's conditional update lands
+    """
+
+    def __init__(self, item: dict, races: int = 0, rival: bytes | None = None):
+        super().__init__()
+        self.item = item
+        self.races = races
+        self.rival = rival
+        self.get_calls = 0
+
+    def _store(self, visitors: bytes, version: int):
+        self.item = {**self.item, "Visitors": Binary(visitors), "VisitorsVersion": Decimal(version)}
+
+    def update_item(self, **kwargs):
+        self.update_calls.append(kwargs)
+        if "ConditionExpression" not in kwargs:
+            return {"Attributes": self.item}
+
+        if self.races:
+            self.races -= 1
+            stored = self.item.get("Visitors")
+            rival = HyperLogLog.from_bytes(self.rival)
+            if stored is not None:
+                rival.merge(HyperLogLog.from_bytes(bytes(stored)))
+            self._store(rival.to_bytes(), int(self.item.get("VisitorsVersion", 0)) + 1)
+
+        values = kwargs["ExpressionAttributeValues"]
+        if int(self.item.get("VisitorsVersion", 0)) != values.get(":version", 0):
+            raise ClientError({"Error": {"Code": "ConditionalCheckFailedException", "Message": "moved"}}, "UpdateItem")
+        self._store(values[":visitors"], values[":next"])
+        self.item["UniqueVisitors"] = Decimal(values[":count"])
+        return {}
+
+    def get_item(self, **kwargs):
+        self.get_calls += 1
+        return {"Item": {name: self.item[name] for name in ("Visitors", "VisitorsVersion") if name in self.item}}
+
+
+class _ReadBackTable(_FakeTable):
+    """
+    hands back `item` for every read, or raises `get_error_code`
+    """
+
+    def __init__(self, item: dict, get_error_code=None):
+        super().__init__()
+        self.item = item
+        self.get_error_code = get_error_code
+        self.get_calls = []
+
+    def get_item(self, **kwargs):
+        self.get_calls.append(kwargs)
+        if self.get_error_code:
+            raise ClientError({"Error": {"Code": self.get_error_code, "Message": "boom"}}, "GetItem")
+        return {"Item": self.item}
+
+
+class _TransactClient:
+    """
+    cancels a transaction for each list of reason codes in `cancellations`
+    """
+
+    def __init__(self, cancellations: list[list[str]]):
+        self.calls = []
+        self.cancellations = list(cancellations)
+
+    def transact_write_items(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.cancellations:
+            reasons = self.cancellations.pop(0)
+            raise ClientError(
+                {
+                    "Error": {"Code": "TransactionCanceledException", "Message": "cancelled"},
+                    "CancellationReasons": [{"Code": code} for code in reasons],
+                },
+                "TransactWriteItems",
+            )
+        return {}
 
 
 class _FakeDB:
-    def __init__(self, table: _FakeTable):
+    def __init__(self, table: _FakeTable, client=None):
         self._table = table
-        self.meta = type("meta", (), {"client": None})
+        self.meta = type("meta", (), {"client": client})
+        self.table_calls = 0
 
     def Table(self, name):
+        self.table_calls += 1
         return self._table
 
 
@@ -67,28 +221,572 @@ class TestMetricsRepository(unittest.TestCase):
     def test_save_metrics(self):
         cases = [
             {
-                "name": "insert then update on conditional failure",
+                "name": "one upsert per metric",
+                "update_error_code": None,
+                "expect_failed": [],
+            },
+            {
+                "name": "error returns failed",
+                "update_error_code": "Other",
+                "expect_failed": ["m1", "m2"],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                table = _FakeTable(update_error_code=case["update_error_code"])
+                repo = MetricsRepository(_FakeDB(table))
+
+                failed = repo.save_metrics([[self.sample_metric]])
+
+                self.assertEqual(case["expect_failed"], failed)
+                self.assertEqual(1, len(table.update_calls))
+
+    def test_save_metrics_marks_rollups(self):
+        cases = [
+            {
+                "name": "first writer sets the marker",
+                "put_error_code": None,
+                "expect_failed": [],
+                "expect_puts": 1,
+                "expect_updates": 2,
+            },
+            {
+                "name": "an existing marker is kept",
                 "put_error_code": "ConditionalCheckFailedException",
                 "expect_failed": [],
-                "expect_update_calls": 1,
+                "expect_puts": 1,
+                "expect_updates": 2,
             },
             {
-                "name": "non conditional error returns failed",
-                "put_error_code": "Other",
+                "name": "nothing is written without the marker",
+                "put_error_code": "InternalServerError",
                 "expect_failed": ["m1", "m2"],
-                "expect_update_calls": 0,
+                "expect_puts": 2,
+                "expect_updates": 0,
             },
         ]
 
         for case in cases:
             with self.subTest(case["name"]):
                 table = _FakeTable(put_error_code=case["put_error_code"])
-                repo = MetricsRepository(_FakeDB(table))
+                repo = MetricsRepository(_FakeDB(table), top_referrers=0)
+
+                self.assertEqual(case["expect_failed"], repo.save_metrics([[self.sample_metric]]))
+                repo.save_metrics([[self.sample_metric]])
+
+                # once per repository, until it is written
+                self.assertEqual(case["expect_puts"], len(table.put_calls))
+                put = table.put_calls[0]
+                self.assertEqual({"PK": "METRICS", "SK": "ROLLUPS"}, {k: put["Item"][k] for k in ("PK", "SK")})
+                self.assertEqual("attribute_not_exists(PK)", put["ConditionExpression"])
+                self.assertEqual(case["expect_updates"], len(table.update_calls))
+
+    def test_save_metrics_group(self):
+        hour = self.sample_metric.model_copy(update={"day": "2023-01-01T05", "granularity": MetricsGranularity.HOUR})
+        later = hour.model_copy(update={"day": "2023-01-01T06", "message_ids": ["m3"]})
+        visitors = HyperLogLog.of_hashes(11, [HyperLogLog.hash("a")]).to_bytes()
+        day = self.sample_metric.model_copy(update={"total_hits": 3, "message_ids": ["m1", "m2", "m3"], "visitors": visitors})
+        month = day.model_copy(update={"day": "2023-01", "granularity": MetricsGranularity.MONTH})
+        group = [hour, later, day, month]
+
+        cases = [
+            {
+                "name": "a group is one transaction",
+                "cancellations": [],
+                "get_error_code": None,
+                "expect_attempts": 1,
+                "expect_gets": ["DAY#2023-01-01", "MONTH#2023-01"],
+                "expect_failed": [],
+            },
+            {
+                "name": "a lost conflict is tried again",
+                "cancellations": [["None", "TransactionConflict", "None", "None"]],
+                "get_error_code": None,
+                "expect_attempts": 2,
+                "expect_gets": ["DAY#2023-01-01", "MONTH#2023-01"],
+                "expect_failed": [],
+            },
+            {
+                "name": "a cancelled transaction fails every message of the group",
+                "cancellations": [["None", "ValidationError", "None", "None"]],
+                "get_error_code": None,
+                "expect_attempts": 1,
+                "expect_gets": [],
+                "expect_failed": ["m1", "m2", "m3"],
+            },
+            {
+                "name": "gives up after the attempts",
+                "cancellations": [["TransactionConflict"]] * 3,
+                "get_error_code": None,
+                "expect_attempts": 3,
+                "expect_gets": [],
+                "expect_failed": ["m1", "m2", "m3"],
+            },
+            {
+                "name": "a failed read back does not fail the written counts",
+                "cancellations": [],
+                "get_error_code": "InternalServerError",
+                "expect_attempts": 1,
+                "expect_gets": ["DAY#2023-01-01", "MONTH#2023-01"],
+                "expect_failed": [],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                table = _ReadBackTable({"R#ref": Decimal(2)}, case["get_error_code"])
+                client = _TransactClient(case["cancellations"])
+                repo = MetricsRepository(_FakeDB(table, client))
+
+                with patch("app.repository.metrics_repo.time.sleep"):
+                    failed = repo.save_metrics([group])
+
+                self.assertEqual(case["expect_failed"], failed)
+                self.assertEqual(case["expect_attempts"], len(client.calls))
+                items = client.calls[0]["TransactItems"]
+                self.assertEqual(
+                    [
+                        {"PK": "SHORTURL#abc", "SK": sk}
+                        for sk in ("HOUR#2023-01-01T05", "HOUR#2023-01-01T06", "DAY#2023-01-01", "MONTH#2023-01")
+                    ],
+                    [item["Update"]["Key"] for item in items],
+                )
+                self.assertEqual({DYNAMO_DB_TABLE_NAME}, {item["Update"]["TableName"] for item in items})
+                self.assertEqual(case["expect_gets"], [get["Key"]["SK"] for get in table.get_calls])
+
+    def test_save_metrics_group_reads(self):
+        visitors = HyperLogLog.of_hashes(11, [HyperLogLog.hash("a")]).to_bytes()
+        hour = self.sample_metric.model_copy(update={"day": "2023-01-01T05", "granularity": MetricsGranularity.HOUR})
+        later = hour.model_copy(update={"day": "2023-01-01T06", "by_referrer": {"ref": 1, "other": 1}})
+        day = self.sample_metric.model_copy(update={"visitors": visitors})
+        month = day.model_copy(update={"day": "2023-01", "granularity": MetricsGranularity.MONTH})
+
+        cases = [
+            {
+                "name": "items without visitors or a full breakdown are not read",
+                "group": [hour, later, day.model_copy(update={"visitors": None})],
+                "top_referrers": 50,
+                "expect_gets": [],
+            },
+            {
+                "name": "day and month items are read for their visitors",
+                "group": [hour, later, day, month],
+                "top_referrers": 50,
+                "expect_gets": [("DAY#2023-01-01", None), ("MONTH#2023-01", None)],
+            },
+            {
+                "name": "an hour bringing a full breakdown is read for compaction",
+                "group": [hour, later, day, month],
+                "top_referrers": 2,
+                "expect_gets": [("HOUR#2023-01-01T06", None), ("DAY#2023-01-01", None), ("MONTH#2023-01", None)],
+            },
+            {
+                "name": "without caps only the visitors are read",
+                "group": [hour, later, day, month],
+                "top_referrers": 0,
+                "expect_gets": [("DAY#2023-01-01", "Visitors, VisitorsVersion"),
+                                ("MONTH#2023-01", "Visitors, VisitorsVersion")],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                table = _ReadBackTable({})
+                repo = MetricsRepository(_FakeDB(table, _TransactClient([])), top_referrers=case["top_referrers"])
+
+                self.assertEqual([], repo.save_metrics([case["group"]]))
+
+                self.assertEqual(
+                    case["expect_gets"],
+                    [(get["Key"]["SK"], get.get("ProjectionExpression")) for get in table.get_calls],
+                )
+                self.assertTrue(all(get["ConsistentRead"] for get in table.get_calls))
+
+    def test_save_metrics_expression(self):
+        table = _FakeTable()
+        repo = MetricsRepository(_FakeDB(table))
+        other = self.sample_metric.model_copy(update={
+            "short_url": "xyz",
+            "day": "2023-01",
+            "granularity": MetricsGranularity.MONTH,
+            "by_country": {"US": 5},
+            "by_device_type": {DeviceType.TABLET: 1, DeviceType.MOBILE: 4},
+            "by_referrer": {None: 5},
+        })
+
+        repo.save_metrics([[self.sample_metric]])
+        repo.save_metrics([[other]])
+
+        first, second = table.update_calls
+        self.assertEqual(
+            "SET #url = :url, #day = :day ADD TotalHits :total_hits, #c0 :c0, #d0 :d0, #d1 :d1, #r0 :r0",
+            first["UpdateExpression"],
+        )
+        # same shape, same expression string
+        self.assertIs(first["UpdateExpression"], second["UpdateExpression"])
+        self.assertEqual({"PK": "SHORTURL#abc", "SK": "DAY#2023-01-01"}, first["Key"])
+        self.assertEqual({"PK": "SHORTURL#xyz", "SK": "MONTH#2023-01"}, second["Key"])
+        self.assertEqual(
+            {"#url": "ShortURL", "#day": "Day", "#c0": "C#US", "#d0": "D#tablet", "#d1": "D#mobile", "#r0": "R#none"},
+            second["ExpressionAttributeNames"],
+        )
+        self.assertEqual(
+            {":url": "xyz", ":day": "2023-01", ":total_hits": 2, ":c0": 5, ":d0": 1, ":d1": 4, ":r0": 5},
+            second["ExpressionAttributeValues"],
+        )
+
+    def test_save_metrics_compaction(self):
+        referrers = {"R#r0": Decimal(10), "R#r1": Decimal(8), "R#r2": Decimal(3), "R#r3": Decimal(2), "R#r4": Decimal(1)}
+        cases = [
+            {
+                "name": "under twice the cap nothing is compacted",
+                "item": {"R#r0": Decimal(10), "R#r1": Decimal(8), "R#(other)": Decimal(40), "C#IN": Decimal(5)},
+                "compact_error_code": None,
+                "expect_calls": 1,
+                "expect_failed": [],
+            },
+            {
+                "name": "over twice the cap is trimmed back to the top k",
+                "item": {**referrers, "R#(other)": Decimal(4), "E#R": Decimal(1), "C#IN": Decimal(5)},
+                "compact_error_code": None,
+                "expect_calls": 2,
+                "expect_compaction": {
+                    "UpdateExpression": "REMOVE #x0, #x1, #x2 ADD #other :removed, #error :threshold, #k0 :decrement, #k1 :decrement",
+                    "ConditionExpression": "#x0 = :x0 AND #x1 = :x1 AND #x2 = :x2",
+                    "ExpressionAttributeNames": {
+                        "#other": "R#(other)", "#error": "E#R",
+                        "#x0": "R#r2", "#x1": "R#r3", "#x2": "R#r4",
+                        "#k0": "R#r0", "#k1": "R#r1",
+                    },
+                    "ExpressionAttributeValues": {
+                        ":removed": 12, ":threshold": 3, ":decrement": -3,
+                        ":x0": 3, ":x1": 2, ":x2": 1,
+                    },
+                },
+                "expect_failed": [],
+            },
+            {
+                "name": "a raced compaction is left for later",
+                "item": referrers,
+                "compact_error_code": "ConditionalCheckFailedException",
+                "expect_calls": 2,
+                "expect_failed": [],
+            },
+            {
+                "name": "a failed compaction does not fail the written counts",
+                "item": referrers,
+                "compact_error_code": "InternalServerError",
+                "expect_calls": 2,
+                "expect_failed": [],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                table = _CompactingTable(case["item"], case["compact_error_code"])
+                repo = MetricsRepository(_FakeDB(table), top_referrers=2)
+
+                failed = repo.save_metrics([[self.sample_metric]])
+
+                self.assertEqual(case["expect_failed"], failed)
+                self.assertEqual(case["expect_calls"], len(table.update_calls))
+                self.assertEqual("ALL_NEW", table.update_calls[0]["ReturnValues"])
+                if "expect_compaction" in case:
+                    compaction = table.update_calls[1]
+                    self.assertEqual(table.update_calls[0]["Key"], compaction["Key"])
+                    for field, value in case["expect_compaction"].items():
+                        self.assertEqual(value, compaction[field])
+
+    def test_save_metrics_errors(self):
+        table = _FakeTable()
+        repo = MetricsRepository(_FakeDB(table), top_referrers=0)
+        metric = self.sample_metric.model_copy(update={"referrer_error": 3})
+
+        repo.save_metrics([[metric]])
+
+        call = table.update_calls[0]
+        self.assertTrue(call["UpdateExpression"].endswith("#r0 :r0, #e0 :e0"))
+        self.assertEqual("E#R", call["ExpressionAttributeNames"]["#e0"])
+        self.assertEqual(3, call["ExpressionAttributeValues"][":e0"])
+        self.assertEqual("NONE", call["ReturnValues"])
+
+    def test_save_metrics_visitors(self):
+        def sketch(*visitors: str) -> bytes:
+            return HyperLogLog.of_hashes(11, map(HyperLogLog.hash, visitors)).to_bytes()
+
+        cases = [
+            {
+                "name": "first sketch of the item",
+                "item": {},
+                "races": 0,
+                "rival": None,
+                "visitors": sketch("a", "b"),
+                "expect_calls": 2,
+                "expect_gets": 0,
+                "expect_unique": 2,
+                "expect_version": 1,
+            },
+            {
+                "name": "merged into the stored sketch",
+                "item": {"Visitors": Binary(sketch("b", "c")), "VisitorsVersion": Decimal(3)},
+                "races": 0,
+                "rival": None,
+                "visitors": sketch("a", "b"),
+                "expect_calls": 2,
+                "expect_gets": 0,
+                "expect_unique": 3,
+                "expect_version": 4,
+            },
+            {
+                "name": "already counted visitors are not written again",
+                "item": {"Visitors": Binary(sketch("a", "b", "c")), "VisitorsVersion": Decimal(3), "UniqueVisitors": Decimal(3)},
+                "races": 0,
+                "rival": None,
+                "visitors": sketch("a", "b"),
+                "expect_calls": 1,
+                "expect_gets": 0,
+                "expect_unique": 3,
+                "expect_version": 3,
+            },
+            {
+                "name": "a lost race re-reads and merges again",
+                "item": {},
+                "races": 2,
+                "rival": sketch("x", "y"),
+                "visitors": sketch("a", "b"),
+                "expect_calls": 4,
+                "expect_gets": 2,
+                "expect_unique": 4,
+                "expect_version": 3,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                table = _VisitorTable(case["item"], case["races"], case["rival"])
+                repo = MetricsRepository(_FakeDB(table), top_referrers=0)
+                metric = self.sample_metric.model_copy(update={"visitors": case["visitors"]})
+
+                failed = repo.save_metrics([[metric]])
+
+                self.assertEqual([], failed)
+                self.assertEqual("ALL_NEW", table.update_calls[0]["ReturnValues"])
+                self.assertEqual(case["expect_calls"], len(table.update_calls))
+                self.assertEqual(case["expect_gets"], table.get_calls)
+                self.assertEqual(case["expect_unique"], table.item["UniqueVisitors"])
+                self.assertEqual(case["expect_unique"], HyperLogLog.from_bytes(bytes(table.item["Visitors"])).count())
+                self.assertEqual(case["expect_version"], table.item["VisitorsVersion"])
+
+    def test_save_metrics_visitors_gives_up(self):
+        table = _VisitorTable({}, races=10, rival=HyperLogLog.of_hashes(11, [HyperLogLog.hash("x")]).to_bytes())
+        repo = MetricsRepository(_FakeDB(table), top_referrers=0)
+        metric = self.sample_metric.model_copy(update={"visitors": HyperLogLog.of_hashes(11, [1]).to_bytes()})
+
+        # the counts are written, only the sketch merge is dropped
+        self.assertEqual([], repo.save_metrics([[metric]]))
+        self.assertEqual(1 + VISITOR_MERGE_ATTEMPTS, len(table.update_calls))
+
+    def test_get_unique_visitors(self):
+        def sketch(*visitors: str) -> Binary:
+            return Binary(HyperLogLog.of_hashes(11, map(HyperLogLog.hash, visitors)).to_bytes())
+
+        table = _RangeTable(["MONTH#2023-01", "DAY#2023-02-01", "DAY#2023-02-02", "DAY#2023-02-03"])
+        sketches = {
+            "MONTH#2023-01": sketch("a", "b", "c"),
+            "DAY#2023-02-01": sketch("a", "d"),
+            # written before visitors were tracked
+            "DAY#2023-02-02": None,
+            "DAY#2023-02-03": Binary(b"garbage"),
+        }
+        for item in table.items:
+            if sketches[item["SK"]] is not None:
+                item["Visitors"] = sketches[item["SK"]]
+        repo = MetricsRepository(_FakeDB(table))
+
+        cases = [
+            {"name": "month and days are unioned", "start": "2023-01-01", "end": "2023-02-03", "expect": 4},
+            {"name": "days without sketches count nothing", "start": "2023-02-02", "end": "2023-02-03", "expect": 0},
+            {"name": "single day", "start": "2023-02-01", "end": "2023-02-01", "expect": 2},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.assertEqual(case["expect"], repo.get_unique_visitors(case["start"], case["end"], "abc"))
+
+    def test_save_metrics_concurrent(self):
+        cases = [
+            {
+                "name": "all writes succeed",
+                "urls": ["a", "b", "c"],
+                "failing": set(),
+                "expect_failed": [],
+            },
+            {
+                "name": "failures map back to their message ids",
+                "urls": ["a", "b", "c"],
+                "failing": {"a", "c"},
+                "expect_failed": ["a1", "a2", "c1", "c2"],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                metrics = [
+                    DailyAccessMetrics(
+                        ShortURL=url,
+                        Day="2023-01-01",
+                        TotalHits=2,
+                        ByCountry={"IN": 2},
+                        ByDeviceType={"desktop": 2},
+                        ByReferrer={"ref": 2},
+                        message_ids=[f"{url}1", f"{url}2"],
+                    )
+                    for url in case["urls"]
+                ]
+                # the barrier only opens when every metric is written at the same time
+                table = _ConcurrentTable(in_flight=len(metrics), failing=case["failing"])
+                db = _FakeDB(table)
+                repo = MetricsRepository(db, workers=len(metrics))
 
-                failed = repo.save_metrics([self.sample_metric])
+                failed = repo.save_metrics([[metric] for metric in metrics])
 
                 self.assertEqual(case["expect_failed"], failed)
-                self.assertEqual(case["expect_update_calls"], len(table.update_calls))
+                self.assertEqual(len(metrics) - len(case["failing"]), len(table.update_calls))
+                # one table for the repository and one per writer thread
+                self.assertEqual(1 + len(metrics), db.table_calls)
+
+    def test_plan_ranges(self):
+        cases = [
+            {
+                "name": "inside one month",
+                "start": date(2024, 3, 5),
+                "end": date(2024, 3, 20),
+                "expect_months": [],
+                "expect_days": [(date(2024, 3, 5), date(2024, 3, 20))],
+            },
+            {
+                "name": "exactly one month",
+                "start": date(2024, 2, 1),
+                "end": date(2024, 2, 29),
+                "expect_months": [date(2024, 2, 1)],
+                "expect_days": [],
+            },
+            {
+                "name": "a year with partial edges",
+                "start": date(2023, 12, 20),
+                "end": date(2024, 12, 10),
+                "expect_months": [date(2024, month, 1) for month in range(1, 12)],
+                "expect_days": [(date(2023, 12, 20), date(2023, 12, 31)), (date(2024, 12, 1), date(2024, 12, 10))],
+            },
+            {
+                "name": "month ending on the last day",
+                "start": date(2024, 1, 31),
+                "end": date(2024, 2, 29),
+                "expect_months": [date(2024, 2, 1)],
+                "expect_days": [(date(2024, 1, 31), date(2024, 1, 31))],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                months, days = MetricsRepository.plan_ranges(case["start"], case["end"])
+
+                self.assertEqual(case["expect_months"], months)
+                self.assertEqual(case["expect_days"], days)
+
+    def test_get_url_metrics_planned(self):
+        cases = [
+            {
+                "name": "full months are read from month items",
+                "sort_keys": ["DAY#2023-12-31", "DAY#2024-01-15", "MONTH#2024-01", "MONTH#2024-02", "DAY#2024-03-01"],
+                "start": "2023-12-31",
+                "end": "2024-03-01",
+                "granularity": None,
+                "expect_days": ["2023-12-31", "2024-01", "2024-02", "2024-03-01"],
+                "expect_ranges": [
+                    ("MONTH#2024-01", "MONTH#2024-02"),
+                    ("DAY#2023-12-31", "DAY#2023-12-31"),
+                    ("DAY#2024-03-01", "DAY#2024-03-01"),
+                ],
+            },
+            {
+                "name": "the month rollups started in is read from its days",
+                "sort_keys": ["DAY#2024-01-02", "DAY#2024-02-03", "DAY#2024-02-20", "MONTH#2024-02", "DAY#2024-03-04",
+                              "MONTH#2024-03"],
+                "rollups_since": "2024-02-10",
+                "start": "2024-01-01",
+                "end": "2024-03-31",
+                "granularity": None,
+                "expect_days": ["2024-01-02", "2024-02-03", "2024-02-20", "2024-03"],
+                "expect_ranges": [
+                    ("MONTH#2024-03", "MONTH#2024-03"),
+                    ("DAY#2024-01-01", "DAY#2024-02-29"),
+                ],
+            },
+            {
+                "name": "a month starting the day after the marker is read from its days",
+                "sort_keys": ["DAY#2024-03-04", "MONTH#2024-03"],
+                "rollups_since": "2024-02-29",
+                "start": "2024-03-01",
+                "end": "2024-03-31",
+                "granularity": None,
+                "expect_days": ["2024-03-04"],
+                "expect_ranges": [("DAY#2024-03-01", "DAY#2024-03-31")],
+            },
+            {
+                "name": "before any rollup every month is read from its days",
+                "sort_keys": ["DAY#2024-03-04"],
+                "rollups_since": None,
+                "start": "2024-03-01",
+                "end": "2024-04-30",
+                "granularity": None,
+                "expect_days": ["2024-03-04"],
+                "expect_ranges": [("DAY#2024-03-01", "DAY#2024-04-30")],
+            },
+            {
+                "name": "hours",
+                "sort_keys": ["HOUR#2024-01-01T00", "HOUR#2024-01-02T23", "HOUR#2024-01-03T00", "DAY#2024-01-01"],
+                "start": "2024-01-01",
+                "end": "2024-01-02",
+                "granularity": MetricsGranularity.HOUR,
+                "expect_days": ["2024-01-01T00", "2024-01-02T23"],
+                "expect_ranges": [("HOUR#2024-01-01T00", "HOUR#2024-01-02T23")],
+            },
+            {
+                "name": "days",
+                "sort_keys": ["DAY#2024-01-01", "MONTH#2024-01", "DAY#2024-01-31"],
+                "start": "2024-01-01",
+                "end": "2024-01-31",
+                "granularity": MetricsGranularity.DAY,
+                "expect_days": ["2024-01-01", "2024-01-31"],
+                "expect_ranges": [("DAY#2024-01-01", "DAY#2024-01-31")],
+            },
+            {
+                "name": "start after end",
+                "sort_keys": ["DAY#2024-01-01"],
+                "start": "2024-01-02",
+                "end": "2024-01-01",
+                "granularity": None,
+                "expect_days": [],
+                "expect_ranges": [],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                table = _RangeTable(case["sort_keys"], case.get("rollups_since", "2020-01-01"))
+                repo = MetricsRepository(_FakeDB(table))
+
+                result = repo.get_url_metrics(case["start"], case["end"], "abc", granularity=case["granularity"])
+
+                self.assertEqual(case["expect_days"], [metric.day for metric in result])
+                self.assertEqual(case["expect_ranges"], table.ranges)
+
+        table = _RangeTable(["MONTH#2024-01", "HOUR#2024-01-01T05"])
+        repo = MetricsRepository(_FakeDB(table))
+        granularities = [m.granularity for m in repo.get_url_metrics("2024-01-01", "2024-01-31", "abc")]
+        self.assertEqual([MetricsGranularity.MONTH], granularities)
 
     def test_get_url_metrics(self):
         cases = [
@@ -102,6 +800,65 @@ class TestMetricsRepository(unittest.TestCase):
                 "query_items": [self.sample_metric.model_dump(by_alias=True)],
                 "expect_count": 1,
                 "expect_short_url": "abc",
+                "expect_by_country": {"IN": 2},
+            },
+            {
+                "name": "flat counters are folded into the maps",
+                "query_items": [
+                    {
+                        "PK": "SHORTURL#abc",
+                        "SK": "DAY#2023-01-01",
+                        "ShortURL": "abc",
+                        "Day": "2023-01-01",
+                        "TotalHits": Decimal(3),
+                        "C#IN": Decimal(2),
+                        "C#US": Decimal(1),
+                        "D#desktop": Decimal(3),
+                        "R#none": Decimal(3),
+                    }
+                ],
+                "expect_count": 1,
+                "expect_short_url": "abc",
+                "expect_by_country": {"IN": 2, "US": 1},
+                "expect_by_device_type": {"desktop": 3},
+            },
+            {
+                "name": "capped breakdowns carry other and their error",
+                "query_items": [
+                    {
+                        "ShortURL": "abc",
+                        "Day": "2023-01-01",
+                        "TotalHits": Decimal(9),
+                        "R#ref": Decimal(4),
+                        "R#(other)": Decimal(5),
+                        "E#R": Decimal(2),
+                    }
+                ],
+                "expect_count": 1,
+                "expect_short_url": "abc",
+                "expect_by_referrer": {"ref": 4, "(other)": 5},
+                "expect_referrer_error": 2,
+            },
+            {
+                "name": "legacy maps are merged with flat counters",
+                "query_items": [
+                    {
+                        "ShortURL": "abc",
+                        "Day": "2023-01-01",
+                        "TotalHits": Decimal(4),
+                        "ByCountry": {"IN": Decimal(2)},
+                        "ByDeviceType": {"desktop": Decimal(2)},
+                        "ByReferrer": {"ref": Decimal(2)},
+                        "C#IN": Decimal(1),
+                        "C#DE": Decimal(1),
+                        "R#ref": Decimal(2),
+                        "D#mobile": Decimal(2),
+                    }
+                ],
+                "expect_count": 1,
+                "expect_short_url": "abc",
+                "expect_by_country": {"IN": 3, "DE": 1},
+                "expect_by_device_type": {"desktop": 2, "mobile": 2},
             },
         ]
 
@@ -115,6 +872,14 @@ class TestMetricsRepository(unittest.TestCase):
                 self.assertEqual(case["expect_count"], len(result))
                 if "expect_short_url" in case:
                     self.assertEqual(case["expect_short_url"], result[0].short_url)
+                if "expect_by_country" in case:
+                    self.assertEqual(case["expect_by_country"], result[0].by_country)
+                if "expect_by_device_type" in case:
+                    self.assertEqual(case["expect_by_device_type"], result[0].by_device_type)
+                if "expect_by_referrer" in case:
+                    self.assertEqual(case["expect_by_referrer"], result[0].by_referrer)
+                if "expect_referrer_error" in case:
+                    self.assertEqual(case["expect_referrer_error"], result[0].referrer_error)
 
 
 if __name__ == "__main__":
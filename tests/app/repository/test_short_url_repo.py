@@ -1,6 +1,10 @@
 import unittest
-from unittest.mock import MagicMock
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
 
+from botocore.exceptions import ClientError
+
+from app.constants import OWNER_CREATED_INDEX
 from app.errors.web_errors import ErrorCodes, WebException
 from app.models.short_url import ShortUrl
 from app.repository.short_url_repo import ShortURLRepository
@@ -37,37 +41,253 @@ class TestShortURLRepository(unittest.TestCase):
                     self.assertEqual(case["expect"], self.repo.get_url(case["short"]))
 
     def test_get_urls_by_user_id(self):
+        one = {"ID": "1", "URL": "a.com", "ShortURL": "one", "OwnerID": "user-1", "CreatedAt": 2}
+        two = {"ID": "2", "URL": "b.com", "ShortURL": "two", "OwnerID": "user-1", "CreatedAt": 1}
+
         cases = [
             {
-                "name": "returns user urls",
-                "query_return": {"Items": [{"SK": "SHORTURL#one"}, {"SK": "SHORTURL#two"}]},
-                "user_id": "user-1",
-                "expect": ["one", "two"],
+                "name": "returns a page newest first and its continuation key",
+                "query_return": {"Items": [one, two], "LastEvaluatedKey": {"PK": "USER#user-1", "SK": "SHORTURL#two"}},
+                "start_key": None,
+                "newest_first": True,
+                "expect": ([ShortUrl(**one), ShortUrl(**two)], {"PK": "USER#user-1", "SK": "SHORTURL#two"}),
+            },
+            {
+                "name": "last page oldest first continues from the start key",
+                "query_return": {"Items": [two]},
+                "start_key": {"PK": "USER#user-1", "SK": "SHORTURL#one"},
+                "newest_first": False,
+                "expect": ([ShortUrl(**two)], None),
             },
         ]
 
         for case in cases:
             with self.subTest(case["name"]):
                 self.mock_table.query.return_value = case["query_return"]
-                result = self.repo.get_urls_by_user_id(case["user_id"])
+                result = self.repo.get_urls_by_user_id("user-1", 2, case["start_key"], case["newest_first"])
                 self.assertEqual(case["expect"], result)
 
+                query_kwargs = self.mock_table.query.call_args.kwargs
+                self.assertEqual(OWNER_CREATED_INDEX, query_kwargs["IndexName"])
+                self.assertEqual(2, query_kwargs["Limit"])
+                self.assertEqual(not case["newest_first"], query_kwargs["ScanIndexForward"])
+                self.assertEqual(case["start_key"], query_kwargs.get("ExclusiveStartKey"))
+
+    def test_owns_url(self):
+        items = {("USER#user", "SHORTURL#mine"): {"PK": "USER#user"}}
+        self.mock_table.get_item.side_effect = lambda Key, **kwargs: {"Item": items.get((Key["PK"], Key["SK"]))}
+
+        cases = [
+            {"name": "owned", "short": "mine", "expect": True},
+            {"name": "not owned", "short": "other", "expect": False},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.assertEqual(case["expect"], self.repo.owns_url("user", case["short"]))
+
+        self.mock_table.get_item.side_effect = None
+
+    def test_scan_short_urls(self):
+        cases = [
+            {
+                "name": "follows pagination",
+                "pages": [
+                    {"Items": [{"ShortURL": "one"}], "LastEvaluatedKey": {"PK": "SHORTURL#one"}},
+                    {"Items": [{"ShortURL": "two"}]},
+                ],
+                "expect": ["one", "two"],
+                "expect_scans": 2,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.mock_table.scan.reset_mock()
+                self.mock_table.scan.side_effect = case["pages"]
+
+                result = list(self.repo.scan_short_urls())
+
+                self.assertEqual(case["expect"], result)
+                self.assertEqual(case["expect_scans"], self.mock_table.scan.call_count)
+                last_call = self.mock_table.scan.call_args.kwargs
+                self.assertEqual({"PK": "SHORTURL#one"}, last_call["ExclusiveStartKey"])
+
     def test_add_url(self):
         cases = [
             {
                 "name": "adds url with transaction",
                 "url": ShortUrl(ShortURL="stdabc123", ID="1", URL="example.com", CreatedAt=1, OwnerID="user"),
+                "url_hash": None,
                 "expect_items_count": 2,
             },
+            {
+                "name": "indexes url hash in the same transaction",
+                "url": ShortUrl(ShortURL="stdabc123", ID="1", URL="example.com", CreatedAt=1, OwnerID="user"),
+                "url_hash": "abc",
+                "expect_items_count": 3,
+            },
         ]
 
         for case in cases:
             with self.subTest(case["name"]):
-                self.repo.add_url(case["url"])
+                self.repo.add_url(case["url"], case["url_hash"])
                 self.mock_client.transact_write_items.assert_called()
                 call_kwargs = self.mock_client.transact_write_items.call_args.kwargs
                 self.assertEqual(case["expect_items_count"], len(call_kwargs["TransactItems"]))
 
+    def test_get_short_url_by_hash(self):
+        items = {("USER#user", "URLHASH#abc"): {"ShortURL": "code1"}}
+        self.mock_table.get_item.side_effect = lambda Key, **kwargs: {"Item": items.get((Key["PK"], Key["SK"]))}
+
+        cases = [
+            {"name": "indexed destination", "hash": "abc", "expect": "code1"},
+            {"name": "new destination", "hash": "def", "expect": None},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.assertEqual(case["expect"], self.repo.get_short_url_by_hash("user", case["hash"]))
+
+        self.mock_table.get_item.side_effect = None
+
+    def test_add_urls(self):
+        def _client_error(code):
+            return ClientError({"Error": {"Code": code, "Message": "boom"}}, "BatchWriteItem")
+
+        def _url(i):
+            return ShortUrl(ShortURL=f"code{i}", ID=str(i), URL="example.com", CreatedAt=1, OwnerID="user")
+
+        def _unprocessed(request_items, codes):
+            return [r for r in request_items if r["PutRequest"]["Item"]["PK"] in {f"SHORTURL#{c}" for c in codes}]
+
+        cases = [
+            {
+                "name": "splits into 25 item requests",
+                "urls": [_url(i) for i in range(30)],
+                "unprocessed": lambda items, attempt: [],
+                "expect_calls": 3,
+                "expect_failed": set(),
+            },
+            {
+                "name": "retries unprocessed items",
+                "urls": [_url(i) for i in range(2)],
+                "unprocessed": lambda items, attempt: _unprocessed(items, {"code1"}) if attempt == 0 else [],
+                "expect_calls": 2,
+                "expect_failed": set(),
+            },
+            {
+                "name": "reports items still unprocessed after all attempts",
+                "urls": [_url(i) for i in range(2)],
+                "unprocessed": lambda items, attempt: _unprocessed(items, {"code1"}),
+                "expect_calls": 5,
+                "expect_failed": {"code1"},
+                "expect_deletes": [{"PK": "USER#user", "SK": "SHORTURL#code1"}],
+            },
+            {
+                "name": "a url left wholly unprocessed has nothing to delete",
+                "urls": [_url(i) for i in range(2)],
+                "unprocessed": lambda items, attempt: [r for r in items if r["PutRequest"]["Item"]["ShortURL"] == "code1"],
+                "expect_calls": 5,
+                "expect_failed": {"code1"},
+            },
+            {
+                "name": "deletes the written half of a partly unprocessed pair",
+                "urls": [_url(i) for i in range(3)],
+                "unprocessed": lambda items, attempt: [
+                    r for r in items if r["PutRequest"]["Item"]["SK"] == "SHORTURL#code2"
+                ],
+                "expect_calls": 5,
+                "expect_failed": {"code2"},
+                "expect_deletes": [{"PK": "SHORTURL#code2", "SK": "DETAILS"}],
+            },
+            {
+                "name": "retries throttled requests",
+                "urls": [_url(i) for i in range(2)],
+                "error": lambda attempt: _client_error("ProvisionedThroughputExceededException") if attempt < 2 else None,
+                "unprocessed": lambda items, attempt: [],
+                "expect_calls": 3,
+                "expect_failed": set(),
+            },
+            {
+                "name": "does not retry a rejected request",
+                "urls": [_url(i) for i in range(2)],
+                "error": lambda attempt: _client_error("ValidationException"),
+                "unprocessed": lambda items, attempt: [],
+                "expect_calls": 1,
+                "expect_failed": {"code0", "code1"},
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                attempts = []
+                deletes = []
+
+                def _batch_write_item(RequestItems):
+                    items = list(RequestItems.values())[0]
+                    self.assertLessEqual(len(items), 25)
+                    if "DeleteRequest" in items[0]:
+                        deletes.extend(item["DeleteRequest"]["Key"] for item in items)
+                        return {}
+                    error = case.get("error", lambda attempt: None)(len(attempts))
+                    if error is not None:
+                        attempts.append(len(items))
+                        raise error
+                    unprocessed = case["unprocessed"](items, len(attempts))
+                    attempts.append(len(items))
+                    return {"UnprocessedItems": {"url-shortener-test": unprocessed} if unprocessed else {}}
+
+                self.mock_client.batch_write_item.side_effect = _batch_write_item
+
+                with patch("app.repository.short_url_repo.time.sleep"):
+                    failed = self.repo.add_urls(case["urls"])
+
+                self.assertEqual(case["expect_failed"], failed)
+                self.assertEqual(case["expect_calls"], len(attempts))
+                self.assertEqual(case.get("expect_deletes", []), deletes)
+
+    def test_add_url_owner_mapping(self):
+        cases = [
+            {
+                "name": "owner mapping carries the listing attributes",
+                "url": ShortUrl(ShortURL="code1", ID="1", URL="example.com", CreatedAt=7, OwnerID="user"),
+                "expect": {"PK": "USER#user", "SK": "SHORTURL#code1", "ListedBy": "user", "ID": "1",
+                           "URL": "example.com", "ShortURL": "code1", "OwnerID": "user", "CreatedAt": 7},
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.repo.add_url(case["url"])
+                items = self.mock_client.transact_write_items.call_args.kwargs["TransactItems"]
+                self.assertEqual(case["expect"], items[1]["Put"]["Item"])
+
+    def test_put_owner_mappings(self):
+        cases = [
+            {
+                "name": "writes only owner mappings 25 per request",
+                "urls": [ShortUrl(ShortURL=f"code{i}", ID=str(i), URL="a.com", CreatedAt=1, OwnerID="user")
+                         for i in range(30)],
+                "expect_requests": [25, 5],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                sizes = []
+
+                def _batch_write_item(RequestItems):
+                    items = list(RequestItems.values())[0]
+                    sizes.append(len(items))
+                    self.assertTrue(all(r["PutRequest"]["Item"]["PK"].startswith("USER#") for r in items))
+                    return {}
+
+                self.mock_client.batch_write_item.side_effect = _batch_write_item
+
+                self.assertEqual(set(), self.repo.put_owner_mappings(case["urls"]))
+                self.assertEqual(case["expect_requests"], sorted(sizes, reverse=True))
+
     def test_get_counter(self):
         cases = [
             {
@@ -75,6 +295,11 @@ class TestShortURLRepository(unittest.TestCase):
                 "initial_val": 5,
                 "expect": 6,
             },
+            {
+                "name": "decimal count read back as int",
+                "initial_val": Decimal(5),
+                "expect": 6,
+            },
         ]
 
         for case in cases:
@@ -88,6 +313,37 @@ class TestShortURLRepository(unittest.TestCase):
                 self.mock_table.update_item.side_effect = _update_item
                 result = self.repo.get_counter()
                 self.assertEqual(case["expect"], result)
+                self.assertIs(int, type(result))
+
+    def test_get_counter_range(self):
+        cases = [
+            {
+                "name": "reserves a block with one update",
+                "initial_val": 5,
+                "size": 3,
+                "expect": [6, 7, 8],
+            },
+            {
+                "name": "consecutive blocks do not overlap",
+                "initial_val": 8,
+                "size": 2,
+                "expect": [9, 10],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                counter = {"val": case["initial_val"]}
+
+                def _update_item(**kwargs):
+                    counter["val"] += int(kwargs.get("ExpressionAttributeValues", {}).get(":inc", 0))
+                    return {"Attributes": {"CurrentCount": counter["val"]}}
+
+                self.mock_table.update_item.reset_mock()
+                self.mock_table.update_item.side_effect = _update_item
+                result = self.repo.get_counter_range(case["size"])
+                self.assertEqual(case["expect"], list(result))
+                self.assertEqual(1, self.mock_table.update_item.call_count)
 
 
 if __name__ == "__main__":
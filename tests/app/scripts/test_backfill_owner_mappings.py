@@ -0,0 +1,47 @@
+import unittest
+from unittest.mock import MagicMock
+
+from app.models.short_url import ShortUrl
+from app.scripts.backfill_owner_mappings import backfill
+
+
+class TestBackfillOwnerMappings(unittest.TestCase):
+    def setUp(self):
+        self.mock_repo = MagicMock()
+
+    def tearDown(self):
+        pass
+
+    def test_backfill(self):
+        urls = [ShortUrl(ShortURL=f"code{i}", ID=str(i), URL="a.com", CreatedAt=1, OwnerID="user") for i in range(5)]
+
+        cases = [
+            {
+                "name": "rewrites every mapping in batches",
+                "failed": [set(), set(), set()],
+                "expect": {"written": 5, "failed": []},
+                "expect_batches": [2, 2, 1],
+            },
+            {
+                "name": "collects failed codes",
+                "failed": [{"code1"}, set(), {"code4"}],
+                "expect": {"written": 3, "failed": ["code1", "code4"]},
+                "expect_batches": [2, 2, 1],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.mock_repo.reset_mock()
+                self.mock_repo.scan_url_details.return_value = iter(urls)
+                self.mock_repo.put_owner_mappings.side_effect = case["failed"]
+
+                state = backfill(self.mock_repo, batch_size=2)
+
+                self.assertEqual(case["expect"], state)
+                batches = [len(call.args[0]) for call in self.mock_repo.put_owner_mappings.call_args_list]
+                self.assertEqual(case["expect_batches"], batches)
+
+
+if __name__ == "__main__":
+    unittest.main()
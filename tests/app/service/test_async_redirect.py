@@ -0,0 +1,170 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from app.constants import NEGATIVE_CACHE_MARKER, NEGATIVE_CACHE_TTL, URL_CACHE_TTL
+from app.errors.web_errors import ErrorCodes, WebException
+from app.models.subscriptions import Subscription
+from app.service.async_redirect import AsyncRedirectService
+from app.service.url_service import ShortURLService
+from app.utils.cache_keys import url_cache_key
+from app.utils.local_cache import LocalCache
+from app.utils.short_code import short_code_codec
+
+
+class TestAsyncRedirectService(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.short = short_code_codec.encode(short_code_codec.compose(Subscription.STANDARD.to_number(), 123))
+        self.event = {
+            "pathParameters": {"short_url": self.short},
+            "headers": {},
+            "requestContext": {"identity": {"sourceIp": "1.1.1.1"}},
+        }
+        self.mock_redis = MagicMock()
+        self.script = AsyncMock()
+        self.mock_redis.register_script.return_value = self.script
+        self.mock_repo = MagicMock()
+        self.local_cache = LocalCache(max_bytes=10_000, ttl=60)
+        self.sync_redis = MagicMock()
+        self.url_service = ShortURLService(self.mock_repo, self.sync_redis, self.local_cache)
+        self.mock_metrics = MagicMock()
+        self.mock_metrics.build_message.return_value = "{}"
+        self.mock_metrics.metrics_buffer.flush.return_value = True
+        self.mock_metrics.counters = None
+        self.service = AsyncRedirectService(self.mock_redis, self.url_service, self.mock_metrics)
+
+    def tearDown(self):
+        pass
+
+    async def test_resolve(self):
+        not_found = WebException(status_code=404, message="missing", error_code=ErrorCodes.SHORTURL_NOT_FOUND)
+
+        cases = [
+            {
+                "name": "cached url",
+                "script_return": [1, "cached.com", 600_000],
+                "db": "db.com",
+                "expect_result": "cached.com",
+                "expect_db_called": False,
+                "expect_set": None,
+                "expect_metrics": True,
+            },
+            {
+                "name": "db fallback populates cache",
+                "script_return": [1, None, -2],
+                "db": "db.com",
+                "expect_result": "db.com",
+                "expect_db_called": True,
+                "expect_set": ("db.com", {"ex": URL_CACHE_TTL}),
+                "expect_metrics": True,
+            },
+            {
+                "name": "unknown code is cached negatively",
+                "script_return": [1, None, -2],
+                "db": not_found,
+                "expect_error": ErrorCodes.SHORTURL_NOT_FOUND,
+                "expect_db_called": True,
+                "expect_set": (NEGATIVE_CACHE_MARKER, {"ex": NEGATIVE_CACHE_TTL, "nx": True}),
+                "expect_metrics": True,
+            },
+            {
+                "name": "cached url due for early refresh is reloaded",
+                "script_return": [1, "cached.com", 5],
+                "db": "db.com",
+                "expect_result": "db.com",
+                "expect_db_called": True,
+                "expect_set": ("db.com", {"ex": URL_CACHE_TTL}),
+                "expect_metrics": True,
+            },
+            {
+                "name": "over limit",
+                "script_return": [6, "cached.com", 600_000],
+                "db": "db.com",
+                "expect_error": ErrorCodes.TOO_MANY_REQUESTS,
+                "expect_db_called": False,
+                "expect_set": None,
+                "expect_metrics": False,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.local_cache.clear()
+                self.script.return_value = case["script_return"]
+                self.sync_redis.set.reset_mock()
+                self.mock_repo.get_url.reset_mock()
+                self.mock_metrics.metrics_buffer.add.reset_mock()
+                if isinstance(case["db"], Exception):
+                    self.mock_repo.get_url.side_effect = case["db"]
+                else:
+                    self.mock_repo.get_url.side_effect = None
+                    self.mock_repo.get_url.return_value = case["db"]
+
+                with patch("app.service.url_service.random.random", return_value=0.5):
+                    if "expect_error" in case:
+                        with self.assertRaises(WebException) as ctx:
+                            await self.service.resolve(self.event)
+                        self.assertEqual(case["expect_error"], ctx.exception.error_code)
+                    else:
+                        self.assertEqual(case["expect_result"], await self.service.resolve(self.event))
+
+                self.assertEqual(case["expect_db_called"], self.mock_repo.get_url.called)
+                self.assertEqual(case["expect_metrics"], self.mock_metrics.metrics_buffer.add.called)
+                if case["expect_set"]:
+                    value, options = case["expect_set"]
+                    self.sync_redis.set.assert_called_with(url_cache_key(self.short), value, **options)
+                else:
+                    self.sync_redis.set.assert_not_called()
+
+    async def test_resolve_hot_keys(self):
+        not_found = WebException(status_code=404, message="missing", error_code=ErrorCodes.SHORTURL_NOT_FOUND)
+        cases = [
+            {"name": "found", "script_return": [1, "cached.com", 600_000], "expect_recorded": True},
+            {"name": "recorded before a failed lookup", "script_return": [1, None, -2], "expect_recorded": True},
+            {"name": "rate limited hits are not recorded", "script_return": [6, "cached.com", 600_000], "expect_recorded": False},
+        ]
+
+        self.url_service.hot_keys = MagicMock()
+        self.url_service.hot_keys.is_hot.return_value = False
+        self.mock_repo.get_url.side_effect = not_found
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.local_cache.clear()
+                self.url_service.hot_keys.record.reset_mock()
+                self.script.return_value = case["script_return"]
+
+                try:
+                    await self.service.resolve(self.event)
+                except WebException:
+                    pass
+
+                if case["expect_recorded"]:
+                    self.url_service.hot_keys.record.assert_called_once_with(self.short)
+                else:
+                    self.url_service.hot_keys.record.assert_not_called()
+
+    async def test_resolve_counters(self):
+        self.mock_metrics.counters = MagicMock()
+        self.script.return_value = [1, "cached.com", 600_000]
+
+        self.assertEqual("cached.com", await self.service.resolve(self.event))
+
+        self.mock_metrics.count_hit.assert_called_once_with(self.event)
+        self.mock_metrics.metrics_buffer.add.assert_not_called()
+
+    async def test_resolve_invalid_event(self):
+        cases = [
+            {"name": "missing path", "event": {"pathParameters": None}},
+            {"name": "missing short url", "event": {"pathParameters": {}}},
+            {"name": "invalid code", "event": {"pathParameters": {"short_url": "bad123"}}},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                with self.assertRaises(WebException) as ctx:
+                    await self.service.resolve(case["event"])
+                self.assertEqual(ErrorCodes.SHORTURL_NOT_FOUND, ctx.exception.error_code)
+                self.script.assert_not_awaited()
+
+
+if __name__ == "__main__":
+    unittest.main()
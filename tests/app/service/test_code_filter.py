@@ -0,0 +1,161 @@
+import unittest
+
+from app.service.code_filter import ShortCodeFilter
+
+
+class _FakePipeline:
+    def __init__(self, redis):
+        self._redis = redis
+        self._calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self._calls.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [getattr(self._redis, name)(*args, **kwargs) for name, args, kwargs in self._calls]
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.store: dict[str, bytearray] = {}
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+    def register_script(self, script):
+        def run(keys, args):
+            if keys[0] not in self.store:
+                return 0
+            for pos in args:
+                self.setbit(keys[0], pos, 1)
+            return 1
+        return run
+
+    def getbit(self, key, offset):
+        data = self.store.get(key, bytearray())
+        if offset >> 3 >= len(data):
+            return 0
+        return 1 if data[offset >> 3] & (0x80 >> (offset & 7)) else 0
+
+    def setbit(self, key, offset, value):
+        data = self.store.setdefault(key, bytearray())
+        if offset >> 3 >= len(data):
+            data.extend(bytes((offset >> 3) + 1 - len(data)))
+        if value:
+            data[offset >> 3] |= 0x80 >> (offset & 7)
+        else:
+            data[offset >> 3] &= ~(0x80 >> (offset & 7)) & 0xFF
+
+    def set(self, key, value):
+        self.store[key] = bytearray(value)
+
+    def bitop(self, op, dest, *keys):
+        length = max(len(self.store.get(k, b"")) for k in keys)
+        result = bytearray(length)
+        for k in keys:
+            for i, byte in enumerate(self.store.get(k, b"")):
+                result[i] |= byte
+        self.store[dest] = result
+
+    def delete(self, key):
+        self.store.pop(key, None)
+
+
+class TestShortCodeFilter(unittest.TestCase):
+    def setUp(self):
+        self.redis = _FakeRedis()
+        self.code_filter = ShortCodeFilter(self.redis, num_bits=1 << 12, num_hashes=4, key="{test}:bloom")
+
+    def tearDown(self):
+        pass
+
+    def test_might_contain(self):
+        cases = [
+            {
+                "name": "fails open before rebuild",
+                "rebuild": None,
+                "added": [],
+                "code": "unknown",
+                "expect": True,
+            },
+            {
+                "name": "rebuilt code is found",
+                "rebuild": ["aaaaaaa", "bbbbbbb"],
+                "added": [],
+                "code": "aaaaaaa",
+                "expect": True,
+            },
+            {
+                "name": "unknown code is rejected after rebuild",
+                "rebuild": ["aaaaaaa", "bbbbbbb"],
+                "added": [],
+                "code": "zzzzzzz",
+                "expect": False,
+            },
+            {
+                "name": "code added after rebuild is found",
+                "rebuild": ["aaaaaaa"],
+                "added": ["ccccccc"],
+                "code": "ccccccc",
+                "expect": True,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.redis.store.clear()
+                if case["rebuild"] is not None:
+                    self.assertEqual(len(case["rebuild"]), self.code_filter.rebuild(case["rebuild"]))
+                for code in case["added"]:
+                    self.code_filter.add(code)
+
+                self.assertEqual(case["expect"], self.code_filter.might_contain(case["code"]))
+
+    def test_add(self):
+        cases = [
+            {
+                "name": "no-op while filter is absent",
+                "prepare": False,
+                "expect_key": False,
+            },
+            {
+                "name": "records code once filter exists",
+                "prepare": True,
+                "expect_key": True,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.redis.store.clear()
+                if case["prepare"]:
+                    self.code_filter.rebuild([])
+
+                self.code_filter.add("ddddddd")
+
+                self.assertEqual(case["expect_key"], "{test}:bloom" in self.redis.store)
+                self.assertNotIn("{test}:bloom:rebuild", self.redis.store)
+
+    def test_add_many(self):
+        cases = [
+            {
+                "name": "every code is found after a bulk add",
+                "codes": [f"code{i}" for i in range(25)],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.redis.store.clear()
+                self.code_filter.rebuild([])
+
+                self.code_filter.add_many(case["codes"])
+
+                self.assertTrue(all(self.code_filter.might_contain(code) for code in case["codes"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from app.service.counter_allocator import CounterAllocator
+
+
+class TestCounterAllocator(unittest.TestCase):
+    def setUp(self):
+        self.mock_repo = MagicMock()
+        self.counter = {"val": 0}
+        self.counter_lock = threading.Lock()
+
+        def _get_counter_range(size):
+            with self.counter_lock:
+                self.counter["val"] += size
+                return range(self.counter["val"] - size + 1, self.counter["val"] + 1)
+
+        self.mock_repo.get_counter_range.side_effect = _get_counter_range
+
+    def tearDown(self):
+        pass
+
+    def test_take(self):
+        cases = [
+            {
+                "name": "spends a block before reserving another",
+                "block_size": 5,
+                "refill_at": 0,
+                "takes": [1, 1, 1],
+                "expect": [[1], [2], [3]],
+                "expect_reservations": 1,
+            },
+            {
+                "name": "prefetches the next block when running low",
+                "block_size": 3,
+                "refill_at": 1,
+                "takes": [1, 1, 1, 1],
+                "expect": [[1], [2], [3], [4]],
+                "expect_reservations": 2,
+            },
+            {
+                "name": "large take reserves the remainder directly",
+                "block_size": 4,
+                "refill_at": 0,
+                "takes": [2, 5],
+                "expect": [[1, 2], [3, 4, 5, 6, 7]],
+                "expect_reservations": 3,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.counter["val"] = 0
+                self.mock_repo.get_counter_range.reset_mock()
+                allocator = CounterAllocator(self.mock_repo, block_size=case["block_size"], refill_at=case["refill_at"])
+
+                taken = [allocator.take(count) for count in case["takes"]]
+
+                self.assertEqual(case["expect"], taken)
+                allocator._executor.shutdown(wait=True)
+                self.assertEqual(case["expect_reservations"], self.mock_repo.get_counter_range.call_count)
+
+    def test_next_concurrent(self):
+        cases = [
+            {"name": "no value is handed out twice", "threads": 8, "per_thread": 250, "block_size": 64},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                allocator = CounterAllocator(self.mock_repo, block_size=case["block_size"], refill_at=16)
+                values = []
+                values_lock = threading.Lock()
+
+                def worker():
+                    taken = [allocator.next() for _ in range(case["per_thread"])]
+                    with values_lock:
+                        values.extend(taken)
+
+                threads = [threading.Thread(target=worker) for _ in range(case["threads"])]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+                self.assertEqual(case["threads"] * case["per_thread"], len(set(values)))
+
+    def test_next_prefetch_failure(self):
+        cases = [
+            {"name": "failed prefetch falls back to a synchronous reservation"},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.mock_repo.get_counter_range.side_effect = [range(1, 3), ConnectionError("down"), range(10, 12)]
+                allocator = CounterAllocator(self.mock_repo, block_size=2, refill_at=1)
+
+                self.assertEqual([1, 2, 10], [allocator.next() for _ in range(3)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from app.service.hot_keys import HotKeyTracker
+from app.utils.cache_keys import hot_keys_key
+
+
+class TestHotKeyTracker(unittest.TestCase):
+    def setUp(self):
+        self.mock_redis = MagicMock()
+        self.mock_pipe = self.mock_redis.pipeline.return_value
+        self.tracker = HotKeyTracker(self.mock_redis, width=256, depth=4, k=2, flush_interval=10, threshold=100)
+
+    def tearDown(self):
+        pass
+
+    def test_flush(self):
+        cases = [
+            {
+                "name": "merges local top keys and picks up hot codes",
+                "hits": {"a": 3, "b": 2, "c": 1},
+                "redis_hot": [["old"], ["a"]],
+                "expect_increments": [("a", 3), ("b", 2)],
+                "expect_hot": {"a", "old"},
+            },
+            {
+                "name": "redis failure keeps the previous hot codes",
+                "hits": {"a": 1},
+                "redis_hot": ConnectionError("down"),
+                "expect_increments": [("a", 1)],
+                "expect_hot": {"a", "old"},
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.mock_pipe.reset_mock()
+                if isinstance(case["redis_hot"], Exception):
+                    self.mock_pipe.execute.side_effect = case["redis_hot"]
+                else:
+                    self.mock_pipe.execute.side_effect = None
+                    self.mock_pipe.execute.return_value = [1] * len(case["expect_increments"]) + [True] + case["redis_hot"]
+
+                for key, hits in case["hits"].items():
+                    for _ in range(hits):
+                        self.tracker.record(key)
+
+                with patch.object(HotKeyTracker, "current_window", return_value=600):
+                    self.tracker.flush()
+
+                increments = [(c.args[2], c.args[1]) for c in self.mock_pipe.zincrby.call_args_list]
+                self.assertEqual(case["expect_increments"], increments)
+                self.assertEqual(hot_keys_key(600), self.mock_pipe.zincrby.call_args.args[0])
+                self.assertEqual(case["expect_hot"], set(self.tracker.hot_codes))
+                self.assertEqual([], self.tracker.sketch.top_keys())
+
+    def test_record(self):
+        cases = [
+            {"name": "flushes once the interval passed", "elapsed": 11, "expect_flush": True},
+            {"name": "stays local within the interval", "elapsed": 1, "expect_flush": False},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.mock_redis.pipeline.reset_mock()
+                with patch("app.service.hot_keys.time.monotonic", return_value=self.tracker._last_flush + case["elapsed"]):
+                    self.tracker.record("a")
+
+                self.assertEqual(case["expect_flush"], self.mock_redis.pipeline.called)
+
+    def test_report(self):
+        cases = [
+            {
+                "name": "sums windows highest first",
+                "zunion": [("a", 5.0), ("b", 50.0)],
+                "size": 1,
+                "expect": [{"shortUrl": "b", "hits": 50}],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.mock_redis.zunion.return_value = case["zunion"]
+
+                with patch.object(HotKeyTracker, "current_window", return_value=600):
+                    report = self.tracker.report(windows=2, size=case["size"])
+
+                self.assertEqual(case["expect"], report)
+                self.mock_redis.zunion.assert_called_with([hot_keys_key(600), hot_keys_key(540)], withscores=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
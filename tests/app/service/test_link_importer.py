@@ -0,0 +1,162 @@
+import io
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from app.models.subscriptions import Subscription
+from app.service.link_importer import LinkImporter, read_records
+from app.utils.short_code import short_code_codec
+
+
+class TestLinkImporter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mock_repo = MagicMock()
+        self.counter = {"val": 0}
+        self.written = []
+        self.lock = threading.Lock()
+
+        def _get_counter_range(size):
+            self.counter["val"] += size
+            return range(self.counter["val"] - size + 1, self.counter["val"] + 1)
+
+        def _add_urls(short_urls):
+            with self.lock:
+                self.written.extend(short_urls)
+            return set()
+
+        self.mock_repo.get_counter_range.side_effect = _get_counter_range
+        self.mock_repo.add_urls.side_effect = _add_urls
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        return path
+
+    def test_read_records(self):
+        cases = [
+            {
+                "name": "csv rows drop empty columns",
+                "file": ("links.csv", "url,owner_id,created_at\na.com,u1,\nb.com,u2,5\n"),
+                "expect": [(1, {"url": "a.com", "owner_id": "u1"}),
+                           (2, {"url": "b.com", "owner_id": "u2", "created_at": "5"})],
+            },
+            {
+                "name": "jsonl lines are passed through and blank lines skipped",
+                "file": ("links.jsonl", '{"url": "a.com"}\n\n{"url": "b.com"}\n'),
+                "expect": [(1, '{"url": "a.com"}\n'), (2, '{"url": "b.com"}\n')],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                path = self._write(*case["file"])
+                self.assertEqual(case["expect"], list(read_records(path)))
+
+    def test_run(self):
+        cases = [
+            {
+                "name": "imports every valid record in counter range batches",
+                "records": [(i, {"url": f"site{i}.com"}) for i in range(1, 8)],
+                "batch_size": 3,
+                "failed_codes": lambda short_urls: set(),
+                "expect_imported": 7,
+                "expect_failed": 0,
+                "expect_ranges": 3,
+            },
+            {
+                "name": "malformed and invalid records fail alone",
+                "records": [(1, '{"url": "a.com"}'), (2, "not json"), (3, {"owner_id": "x"}), (4, '[1]')],
+                "batch_size": 10,
+                "failed_codes": lambda short_urls: set(),
+                "expect_imported": 1,
+                "expect_failed": 3,
+                "expect_ranges": 1,
+            },
+            {
+                "name": "unwritten items are reported as failed",
+                "records": [(i, {"url": f"site{i}.com"}) for i in range(1, 5)],
+                "batch_size": 4,
+                "failed_codes": lambda short_urls: {short_urls[0].short_url},
+                "expect_imported": 3,
+                "expect_failed": 1,
+                "expect_ranges": 1,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.counter["val"] = 0
+                self.written.clear()
+                self.mock_repo.get_counter_range.reset_mock()
+                self.mock_repo.add_urls.side_effect = lambda short_urls: case["failed_codes"](short_urls)
+                code_filter = MagicMock()
+                importer = LinkImporter(self.mock_repo, code_filter, default_owner="owner",
+                                        batch_size=case["batch_size"], workers=2, max_in_flight=2)
+                results = io.StringIO()
+
+                state = importer.run(case["records"], results)
+
+                self.assertEqual(case["expect_imported"], state["imported"])
+                self.assertEqual(case["expect_failed"], state["failed"])
+                self.assertEqual(case["records"][-1][0], state["position"])
+                self.assertEqual(case["expect_ranges"], self.mock_repo.get_counter_range.call_count)
+                lines = [json.loads(line) for line in results.getvalue().splitlines()]
+                self.assertEqual([position for position, _ in case["records"]], [line["position"] for line in lines])
+                self.assertEqual(case["expect_imported"], sum("shortUrl" in line for line in lines))
+                added = {code for call in code_filter.add_many.call_args_list for code in call.args[0]}
+                self.assertTrue({line["shortUrl"] for line in lines if "shortUrl" in line} <= added)
+
+        self.mock_repo.add_urls.side_effect = None
+
+    def test_run_resume(self):
+        cases = [
+            {
+                "name": "resumes after the checkpointed record",
+                "records": [(i, {"url": f"site{i}.com"}) for i in range(1, 11)],
+                "checkpoint": {"position": 6, "imported": 6, "failed": 0},
+                "expect_written": ["site7.com", "site8.com", "site9.com", "site10.com"],
+                "expect_state": {"position": 10, "imported": 10, "failed": 0},
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                checkpoint_path = self._write("import.ckpt", json.dumps(case["checkpoint"]))
+                importer = LinkImporter(self.mock_repo, default_owner="owner", batch_size=3,
+                                        checkpoint_path=checkpoint_path)
+
+                state = importer.run(case["records"])
+
+                self.assertEqual(case["expect_written"], [short_url.url for short_url in self.written])
+                self.assertEqual(case["expect_state"], state)
+                with open(checkpoint_path, encoding="utf-8") as f:
+                    self.assertEqual(case["expect_state"], json.load(f))
+
+    def test_run_codes(self):
+        cases = [
+            {
+                "name": "codes carry each record's subscription",
+                "records": [(1, {"url": "a.com", "subscription": "pro"}), (2, {"url": "b.com"})],
+                "expect_tiers": [Subscription.PREMIUM.to_number(), Subscription.STANDARD.to_number()],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                LinkImporter(self.mock_repo, default_owner="owner").run(case["records"])
+
+                tiers = [short_code_codec.tier_of(short_code_codec.decode(short_url.short_url))
+                         for short_url in self.written]
+                self.assertEqual(case["expect_tiers"], tiers)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,9 +4,55 @@ import os
 import unittest
 from unittest.mock import MagicMock, patch
 
+from botocore.exceptions import ClientError
+
 from app.errors.web_errors import ErrorCodes, WebException
-from app.models.metrics import DailyAccessMetrics, DeviceType
+from app.models.metrics import DailyAccessMetrics, DeviceType, MetricsGranularity
+from app.repository.metrics_repo import MetricsRepository
 from app.service.metrics import MetricsService
+from app.service.metrics_counters import MetricsCounters
+
+
+class _LedgerDB:
+    """
+    adds the counts of metric writes to in memory items; a transaction that
+    writes one of the `failing` sort keys fails once, writing nothing
+    """
+
+    def __init__(self, failing: set[str] = frozenset()):
+        self.items: dict[tuple[str, str], dict] = {}
+        self.failing = set(failing)
+        self.meta = type("meta", (), {"client": self})
+
+    def Table(self, name):
+        return self
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ExpressionAttributeNames=None, **kwargs):
+        item = self.items.setdefault((Key["PK"], Key["SK"]), {})
+        # only the counts are kept, sketch merges and compactions are skipped
+        if " ADD " in UpdateExpression and "ConditionExpression" not in kwargs:
+            names = ExpressionAttributeNames or {}
+            for add in UpdateExpression.partition(" ADD ")[2].split(", "):
+                name, value = add.split(" ")
+                name = names.get(name, name)
+                item[name] = item.get(name, 0) + ExpressionAttributeValues[value]
+        return {"Attributes": dict(item)}
+
+    def get_item(self, Key, **kwargs):
+        return {"Item": dict(self.items.get((Key["PK"], Key["SK"]), {}))}
+
+    def put_item(self, Item, **kwargs):
+        self.items[(Item["PK"], Item["SK"])] = Item
+
+    def transact_write_items(self, TransactItems):
+        failing = {item["Update"]["Key"]["SK"] for item in TransactItems} & self.failing
+        if failing:
+            self.failing -= failing
+            raise ClientError({"Error": {"Code": "InternalServerError", "Message": "boom"}}, "TransactWriteItems")
+        for item in TransactItems:
+            update = dict(item["Update"])
+            update.pop("TableName")
+            self.update_item(**update)
 
 
 class TestMetricsService(unittest.TestCase):
@@ -71,9 +117,9 @@ class TestMetricsService(unittest.TestCase):
 
         for case in cases:
             with self.subTest(case["name"]):
-                self.mock_sqs.send_message.reset_mock()
-                self.mock_sqs.send_message.side_effect = case["side_effect"]
-                self.mock_sqs.send_message.return_value = {"MessageId": "1"}
+                self.mock_sqs.send_message_batch.reset_mock()
+                self.mock_sqs.send_message_batch.side_effect = case["side_effect"]
+                self.mock_sqs.send_message_batch.return_value = {"Successful": [{"Id": "0"}]}
 
                 wrapped = self.service.track_metrics(case["func"])
                 event = {
@@ -88,11 +134,118 @@ class TestMetricsService(unittest.TestCase):
                     else:
                         self.assertEqual({"ok": True}, wrapped(event))
 
-                self.mock_sqs.send_message.assert_called()
-                call_kwargs = self.mock_sqs.send_message.call_args.kwargs
-                body = json.loads(call_kwargs["MessageBody"])
+                self.mock_sqs.send_message_batch.assert_called_once()
+                call_kwargs = self.mock_sqs.send_message_batch.call_args.kwargs
+                self.assertEqual("queue", call_kwargs["QueueUrl"])
+                self.assertEqual(1, len(call_kwargs["Entries"]))
+                body = json.loads(call_kwargs["Entries"][0]["MessageBody"])
                 self.assertEqual(case["expect_device"], body["device"])
 
+    def test_track_metrics_counters(self):
+        cases = [
+            {"name": "hit is counted in redis", "record_error": None},
+            {"name": "redis failure does not fail the redirect", "record_error": ConnectionError("down")},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                counters = MagicMock()
+                counters.record.side_effect = case["record_error"]
+                service = MetricsService(self.mock_sqs, self.mock_metrics_repo, self.mock_url_repo, counters)
+                self.mock_sqs.send_message_batch.reset_mock()
+
+                wrapped = service.track_metrics(lambda event=None: {"ok": True})
+                result = wrapped({
+                    "headers": {"CloudFront-Viewer-Country": "IN"},
+                    "requestContext": {"identity": {"sourceIp": "1.1.1.1"}},
+                    "pathParameters": {"short_url": "abc"},
+                })
+
+                self.assertEqual({"ok": True}, result)
+                record = counters.record.call_args.args[0]
+                self.assertEqual(("abc", "IN", "1.1.1.1"), (record.url, record.country, record.ip))
+                self.mock_sqs.send_message_batch.assert_not_called()
+
+    def test_flush_counters(self):
+        hour = int(datetime.datetime(2023, 1, 1, 12, tzinfo=datetime.timezone.utc).timestamp()) // 3600
+        fields = {"TotalHits": 2, "C#IN": 2, "D#desktop": 2, "R#none": 2, "V#3": 1}
+        first = [(f"{hour}:abc", "abc", hour, fields), (f"{hour}:gone", "gone", hour, {})]
+        second = [(f"{hour + 1}:abc", "abc", hour + 1, fields), (f"{hour}:xyz", "xyz", hour, fields)]
+
+        cases = [
+            {
+                "name": "drains until nothing is dirty",
+                "drained": [first, second, []],
+                "failed": [[], []],
+                "max_keys": 100,
+                "remaining": None,
+                "expect_result": {"flushed": 4, "released": 0},
+                "expect_finished": first + second,
+                "expect_released": [],
+                "expect_hits": [2, 4],
+            },
+            {
+                "name": "failed hashes are released",
+                "drained": [second, []],
+                "failed": [[f"{hour}:xyz"]],
+                "max_keys": 100,
+                "remaining": None,
+                "expect_result": {"flushed": 1, "released": 1},
+                "expect_finished": [second[0]],
+                "expect_released": [second[1]],
+                "expect_hits": [4],
+            },
+            {
+                "name": "stops at max keys",
+                "drained": [first, second],
+                "failed": [[]],
+                "max_keys": 2,
+                "remaining": None,
+                "expect_result": {"flushed": 2, "released": 0},
+                "expect_finished": first,
+                "expect_released": [],
+                "expect_hits": [2],
+            },
+            {
+                "name": "stops before the invocation runs out of time",
+                "drained": [first, second],
+                "failed": [[]],
+                "max_keys": 100,
+                "remaining": [60_000, 9_000],
+                "expect_result": {"flushed": 2, "released": 0},
+                "expect_finished": first,
+                "expect_released": [],
+                "expect_hits": [2],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                counters = MagicMock()
+                counters.drain.side_effect = case["drained"]
+                counters.counts_of.side_effect = MetricsCounters(MagicMock()).counts_of
+                finished, released = [], []
+                counters.finish.side_effect = lambda drained: finished.extend(drained)
+                counters.release.side_effect = lambda drained: released.extend(drained)
+                self.mock_metrics_repo.save_metrics.reset_mock()
+                self.mock_metrics_repo.save_metrics.side_effect = case["failed"]
+                service = MetricsService(self.mock_sqs, self.mock_metrics_repo, self.mock_url_repo, counters)
+                remaining = MagicMock(side_effect=case["remaining"]) if case["remaining"] else None
+
+                result = service.flush_counters(remaining, max_keys=case["max_keys"], batch_size=2)
+
+                self.assertEqual(case["expect_result"], result)
+                self.assertEqual(case["expect_finished"], finished)
+                self.assertEqual(case["expect_released"], released)
+                # every drained hour is written with its day and month rollups
+                hits = [
+                    sum(m.total_hits for group in c.args[0] for m in group if m.granularity is MetricsGranularity.DAY)
+                    for c in self.mock_metrics_repo.save_metrics.call_args_list
+                ]
+                self.assertEqual(case["expect_hits"], hits)
+
+        self.mock_metrics_repo.save_metrics.side_effect = None
+
     def test_process_event(self):
         timestamp = int(
             datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
@@ -152,24 +305,126 @@ class TestMetricsService(unittest.TestCase):
                 "expect_total_hits": 3,
                 "expect_countries": {"IN": 2, "US": 1},
             },
+            {
+                "name": "malformed records are reported as failures",
+                "event": {
+                    "Records": [
+                        {"messageId": "m1", "body": "not json"},
+                        {
+                            "messageId": "m2",
+                            "body": json.dumps(
+                                {
+                                    "url": "abc",
+                                    "ip": "2.2.2.2",
+                                    "timestamp": timestamp,
+                                    "referrer": "ref1",
+                                    "user_agent": "ua",
+                                    "country": "IN",
+                                    "device": DeviceType.MOBILE,
+                                }
+                            ),
+                        },
+                    ]
+                },
+                "save_return": ["m2"],
+                "expect_result": ["m1", "m2"],
+                "expect_total_hits": 1,
+                "expect_countries": {"IN": 1},
+            },
         ]
 
         for case in cases:
             with self.subTest(case["name"]):
+                self.mock_metrics_repo.save_metrics.reset_mock()
                 self.mock_metrics_repo.save_metrics.return_value = case["save_return"]
 
                 result = self.service.process_event(case["event"])
 
                 self.assertEqual(case["expect_result"], result)
                 self.mock_metrics_repo.save_metrics.assert_called_once()
-                metrics = self.mock_metrics_repo.save_metrics.call_args[0][0]
-                self.assertEqual(1, len(metrics))
-                metric = metrics[0]
+                [metrics] = self.mock_metrics_repo.save_metrics.call_args[0][0]
+                self.assertEqual(
+                    [
+                        (MetricsGranularity.HOUR, "2023-01-01T00"),
+                        (MetricsGranularity.DAY, "2023-01-01"),
+                        (MetricsGranularity.MONTH, "2023-01"),
+                    ],
+                    [(m.granularity, m.day) for m in metrics],
+                )
+                metric = metrics[1]
                 self.assertEqual("abc", metric.short_url)
-                self.assertEqual("2023-01-01", metric.day)
                 self.assertEqual(case["expect_total_hits"], metric.total_hits)
                 self.assertEqual(case["expect_countries"], metric.by_country)
 
+    def test_partial_failure_totals(self):
+        def record(message_id: str, url: str, moment: datetime.datetime) -> dict:
+            return {
+                "messageId": message_id,
+                "body": json.dumps({
+                    "url": url,
+                    "ip": "1.1.1.1",
+                    "timestamp": int(moment.timestamp()),
+                    "referrer": "ref",
+                    "user_agent": "ua",
+                    "country": "IN",
+                    "device": DeviceType.DESKTOP,
+                }),
+            }
+
+        first_day = datetime.datetime(2023, 1, 1, 12, tzinfo=datetime.timezone.utc)
+        second_day = datetime.datetime(2023, 1, 2, 5, tzinfo=datetime.timezone.utc)
+        records = [
+            record("m1", "abc", first_day),
+            record("m2", "abc", first_day + datetime.timedelta(hours=1)),
+            record("m3", "abc", second_day),
+            record("m4", "xyz", first_day),
+        ]
+        hour = int(first_day.timestamp()) // 3600
+        fields = {"TotalHits": 2, "C#IN": 2, "D#desktop": 2, "R#none": 2}
+        drained = [
+            (f"{hour}:abc", "abc", hour, fields),
+            (f"{hour + 14}:abc", "abc", hour + 14, fields),
+            (f"{hour}:xyz", "xyz", hour, fields),
+        ]
+
+        def process(service: MetricsService) -> list:
+            failed = service.process_event({"Records": records})
+            # sqs redelivers only the failed messages
+            return failed + service.process_event({"Records": [r for r in records if r["messageId"] in failed]})
+
+        def flush(service: MetricsService) -> list:
+            # a released hash is drained again with the same counts
+            released = []
+            service.counters.drain.side_effect = [drained, [], released, []]
+            service.counters.release.side_effect = lambda hashes: released.extend(hashes)
+            service.flush_counters()
+            service.flush_counters()
+            return released
+
+        cases = [
+            {"name": "redelivered messages", "run": process, "expect_retried": ["m3"], "expect_month_hits": 3},
+            {"name": "released redis hashes", "run": flush, "expect_retried": [drained[1]], "expect_month_hits": 4},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                totals = []
+                for failing in (set(), {"DAY#2023-01-02"}):
+                    db = _LedgerDB(failing)
+                    counters = MagicMock()
+                    counters.counts_of.side_effect = MetricsCounters(MagicMock()).counts_of
+                    repo = MetricsRepository(db, workers=1, top_referrers=0)
+                    service = MetricsService(self.mock_sqs, repo, self.mock_url_repo, counters)
+
+                    retried = case["run"](service)
+
+                    self.assertEqual(case["expect_retried"] if failing else [], retried)
+                    totals.append(db.items)
+
+                # the hour and month items the failed day was written with are not counted twice
+                self.assertEqual(totals[0], totals[1])
+                self.assertEqual(case["expect_month_hits"], totals[1][("SHORTURL#abc", "MONTH#2023-01")]["TotalHits"])
+
     def test_get_metrics_by_url(self):
         metric = DailyAccessMetrics(
             ShortURL="mine",
@@ -203,7 +458,7 @@ class TestMetricsService(unittest.TestCase):
 
         for case in cases:
             with self.subTest(case["name"]):
-                self.mock_url_repo.get_urls_by_user_id.return_value = case["user_urls"]
+                self.mock_url_repo.owns_url.side_effect = lambda user_id, url: url in case["user_urls"]
                 self.mock_metrics_repo.get_url_metrics.return_value = case["metrics"]
 
                 if case["raises"]:
@@ -226,6 +481,37 @@ class TestMetricsService(unittest.TestCase):
                     )
                     self.assertEqual(case["expect_result"], result)
 
+    def test_get_unique_visitors_by_url(self):
+        cases = [
+            {
+                "name": "blocks unowned url",
+                "url": "other",
+                "raises": WebException,
+            },
+            {
+                "name": "returns the range's unique visitors",
+                "url": "mine",
+                "raises": None,
+                "expect_result": 42,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.mock_url_repo.owns_url.side_effect = lambda user_id, url: url == "mine"
+                self.mock_metrics_repo.get_unique_visitors.return_value = 42
+
+                if case["raises"]:
+                    with self.assertRaises(case["raises"]) as ctx:
+                        self.service.get_unique_visitors_by_url(case["url"], "u1", "2024-01-01", "2024-01-31")
+                    self.assertEqual(ErrorCodes.FORBIDDEN, ctx.exception.error_code)
+                else:
+                    result = self.service.get_unique_visitors_by_url(case["url"], "u1", "2024-01-01", "2024-01-31")
+                    self.assertEqual(case["expect_result"], result)
+                    self.mock_metrics_repo.get_unique_visitors.assert_called_with(
+                        url="mine", start_day="2024-01-01", end_day="2024-01-31"
+                    )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,377 @@
+import datetime
+import json
+import unittest
+
+from app.models.metrics import DeviceType, MetricsGranularity, OTHER_BUCKET
+from app.service.metrics_aggregator import MetricsAggregator
+from app.utils.sketch import HyperLogLog
+
+
+def body(url="abc", day=datetime.datetime(2023, 1, 1, 12, tzinfo=datetime.timezone.utc), **overrides):
+    message = {
+        "url": url,
+        "ip": "1.1.1.1",
+        "timestamp": int(day.timestamp()),
+        "referrer": "ref",
+        "user_agent": "ua",
+        "country": "IN",
+        "device": DeviceType.DESKTOP,
+        **overrides,
+    }
+    return json.dumps(message)
+
+
+class TestMetricsAggregator(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_results(self):
+        day = datetime.datetime(2023, 1, 1, 12, tzinfo=datetime.timezone.utc)
+        next_hour = datetime.datetime(2023, 1, 1, 13, 59, 59, tzinfo=datetime.timezone.utc)
+        next_month = datetime.datetime(2023, 2, 1, tzinfo=datetime.timezone.utc)
+
+        cases = [
+            {
+                "name": "same url and hour share a bucket in every granularity",
+                "records": [
+                    ("m1", body()),
+                    ("m2", body(country="US", device=DeviceType.MOBILE)),
+                    ("m3", body(referrer=None, device=DeviceType.MOBILE)),
+                ],
+                "expect": {
+                    (granularity, label): {
+                        "total_hits": 3,
+                        "by_country": {"IN": 2, "US": 1},
+                        "by_device_type": {DeviceType.DESKTOP: 1, DeviceType.MOBILE: 2},
+                        "by_referrer": {"ref": 2, None: 1},
+                        "message_ids": ["m1", "m2", "m3"],
+                    }
+                    for granularity, label in [
+                        (MetricsGranularity.HOUR, "2023-01-01T12"),
+                        (MetricsGranularity.DAY, "2023-01-01"),
+                        (MetricsGranularity.MONTH, "2023-01"),
+                    ]
+                },
+            },
+            {
+                "name": "hours roll up into days and months",
+                "records": [
+                    ("m1", body(day=day)),
+                    ("m3", body(day=next_hour, country="US")),
+                    ("m4", body(day=next_month)),
+                ],
+                "expect": {
+                    (MetricsGranularity.HOUR, "2023-01-01T12"): {"total_hits": 1, "message_ids": ["m1"]},
+                    (MetricsGranularity.HOUR, "2023-01-01T13"): {"total_hits": 1, "message_ids": ["m3"]},
+                    (MetricsGranularity.HOUR, "2023-02-01T00"): {"total_hits": 1, "message_ids": ["m4"]},
+                    (MetricsGranularity.DAY, "2023-01-01"): {"total_hits": 2, "message_ids": ["m1", "m3"]},
+                    (MetricsGranularity.DAY, "2023-02-01"): {"total_hits": 1, "message_ids": ["m4"]},
+                    (MetricsGranularity.MONTH, "2023-01"): {
+                        "total_hits": 2,
+                        "by_country": {"IN": 1, "US": 1},
+                        "message_ids": ["m1", "m3"],
+                    },
+                    (MetricsGranularity.MONTH, "2023-02"): {"total_hits": 1, "message_ids": ["m4"]},
+                },
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                aggregator = MetricsAggregator()
+                malformed = aggregator.add_records(
+                    [{"messageId": message_id, "body": record} for message_id, record in case["records"]]
+                )
+
+                self.assertEqual([], malformed)
+                results = {(m.granularity, m.day): m for m in aggregator.results()}
+                self.assertEqual(set(case["expect"]), set(results))
+                for key, fields in case["expect"].items():
+                    for field, value in fields.items():
+                        self.assertEqual(value, getattr(results[key], field))
+                    self.assertEqual("abc", results[key].short_url)
+
+    def test_groups(self):
+        hours = [
+            datetime.datetime(2023, 1, 1, 12, tzinfo=datetime.timezone.utc),
+            datetime.datetime(2023, 1, 2, 0, 0, 1, tzinfo=datetime.timezone.utc),
+            datetime.datetime(2023, 1, 1, 13, 59, 59, tzinfo=datetime.timezone.utc),
+        ]
+        aggregator = MetricsAggregator()
+        aggregator.add_records([{"messageId": f"m{i}", "body": body(day=hour)} for i, hour in enumerate(hours)])
+
+        groups = aggregator.groups()
+
+        # every bucket of a message is in one group, the month is added to once per day
+        self.assertEqual(
+            [
+                [
+                    (MetricsGranularity.HOUR, "2023-01-01T12", ["m0"]),
+                    (MetricsGranularity.HOUR, "2023-01-01T13", ["m2"]),
+                    (MetricsGranularity.DAY, "2023-01-01", ["m0", "m2"]),
+                    (MetricsGranularity.MONTH, "2023-01", ["m0", "m2"]),
+                ],
+                [
+                    (MetricsGranularity.HOUR, "2023-01-02T00", ["m1"]),
+                    (MetricsGranularity.DAY, "2023-01-02", ["m1"]),
+                    (MetricsGranularity.MONTH, "2023-01", ["m1"]),
+                ],
+            ],
+            [[(m.granularity, m.day, m.message_ids) for m in group] for group in groups],
+        )
+        self.assertEqual([2, 1], [group[-1].total_hits for group in groups])
+        self.assertEqual([m for group in groups for m in group], aggregator.results())
+
+    def test_results_urls(self):
+        aggregator = MetricsAggregator()
+        aggregator.add_records([
+            {"messageId": "m1", "body": body()},
+            {"messageId": "m2", "body": body(url="xyz")},
+        ])
+
+        results = aggregator.results()
+        self.assertEqual(6, len(results))
+        self.assertEqual({"abc": 3, "xyz": 3}, {url: sum(m.short_url == url for m in results) for url in ("abc", "xyz")})
+
+    def test_results_capped(self):
+        cases = [
+            {
+                "name": "referrers beyond the cap go to other",
+                "referrers": ["a"] * 6 + ["b"] * 4 + ["c", "d", "e", "f"],
+                "countries": ["IN"] * 14,
+                "top_countries": 0,
+                "top_referrers": 2,
+                "expect_referrers": {"a": 4, "b": 2, OTHER_BUCKET: 8},
+                "expect_referrer_error": 2,
+                "expect_countries": {"IN": 14},
+                "expect_country_error": 0,
+            },
+            {
+                "name": "countries can be capped too",
+                "referrers": ["a"] * 4,
+                "countries": ["IN", "IN", "US", "DE"],
+                "top_countries": 1,
+                "top_referrers": 2,
+                "expect_referrers": {"a": 4},
+                "expect_referrer_error": 0,
+                "expect_countries": {"IN": 1, OTHER_BUCKET: 3},
+                "expect_country_error": 1,
+            },
+            {
+                "name": "no cap keeps everything",
+                "referrers": ["a", "b", "c"],
+                "countries": ["IN", "US", "DE"],
+                "top_countries": 0,
+                "top_referrers": 0,
+                "expect_referrers": {"a": 1, "b": 1, "c": 1},
+                "expect_referrer_error": 0,
+                "expect_countries": {"IN": 1, "US": 1, "DE": 1},
+                "expect_country_error": 0,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                aggregator = MetricsAggregator(top_countries=case["top_countries"], top_referrers=case["top_referrers"])
+                aggregator.add_records([
+                    {"messageId": f"m{i}", "body": body(referrer=referrer, country=country)}
+                    for i, (referrer, country) in enumerate(zip(case["referrers"], case["countries"]))
+                ])
+
+                for metric in aggregator.results():
+                    self.assertEqual(case["expect_referrers"], metric.by_referrer)
+                    self.assertEqual(case["expect_referrer_error"], metric.referrer_error)
+                    self.assertEqual(case["expect_countries"], metric.by_country)
+                    self.assertEqual(case["expect_country_error"], metric.country_error)
+
+    def test_results_capped_rollup(self):
+        aggregator = MetricsAggregator(top_referrers=1)
+        hours = [datetime.datetime(2023, 1, 1, hour, tzinfo=datetime.timezone.utc) for hour in (1, 2)]
+        aggregator.add_records([
+            {"messageId": f"m{i}", "body": body(day=hours[i % 2], referrer=referrer)}
+            for i, referrer in enumerate(["a", "b", "a", "c", "a", "b"])
+        ])
+
+        results = {(m.granularity, m.day): m for m in aggregator.results()}
+        # hour 1 saw a x3, hour 2 saw b x2 and c x1
+        self.assertEqual({"a": 3}, results[(MetricsGranularity.HOUR, "2023-01-01T01")].by_referrer)
+        self.assertEqual({"b": 1, OTHER_BUCKET: 2}, results[(MetricsGranularity.HOUR, "2023-01-01T02")].by_referrer)
+        day = results[(MetricsGranularity.DAY, "2023-01-01")]
+        self.assertEqual({"a": 2, OTHER_BUCKET: 4}, day.by_referrer)
+        self.assertEqual(2, day.referrer_error)
+        self.assertEqual(6, sum(day.by_referrer.values()))
+
+    def test_results_dump(self):
+        aggregator = MetricsAggregator()
+        aggregator.add_records([{"messageId": "m1", "body": body()}])
+
+        self.assertEqual(
+            {
+                "ShortURL": "abc",
+                "Day": "2023-01-01T12",
+                "Granularity": MetricsGranularity.HOUR,
+                "TotalHits": 1,
+                "ByCountry": {"IN": 1},
+                "ByDeviceType": {DeviceType.DESKTOP: 1},
+                "ByReferrer": {"ref": 1},
+                "CountryError": 0,
+                "ReferrerError": 0,
+                "UniqueVisitors": 0,
+            },
+            aggregator.results()[0].model_dump(by_alias=True),
+        )
+
+    def test_results_visitors(self):
+        hours = [datetime.datetime(2023, 1, day, hour, tzinfo=datetime.timezone.utc) for day, hour in ((1, 1), (1, 2), (2, 1))]
+        visitors = [("1.1.1.1", "ua"), ("1.1.1.1", "ua"), ("1.1.1.1", "other ua"), ("2.2.2.2", "ua"), ("1.1.1.1", "ua")]
+        aggregator = MetricsAggregator()
+        aggregator.add_records([
+            {"messageId": f"m{i}", "body": body(day=hours[i % 3], ip=ip, user_agent=user_agent)}
+            for i, (ip, user_agent) in enumerate(visitors)
+        ])
+
+        results = {(m.granularity, m.day): m for m in aggregator.results()}
+        cases = [
+            {"name": "hours carry no sketch", "key": (MetricsGranularity.HOUR, "2023-01-01T01"), "expect": 0},
+            {"name": "day", "key": (MetricsGranularity.DAY, "2023-01-01"), "expect": 2},
+            {"name": "next day", "key": (MetricsGranularity.DAY, "2023-01-02"), "expect": 1},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                metric = results[case["key"]]
+                self.assertEqual(case["expect"], metric.unique_visitors)
+                if case["expect"]:
+                    self.assertEqual(case["expect"], HyperLogLog.from_bytes(metric.visitors).count())
+                else:
+                    self.assertIsNone(metric.visitors)
+
+        # each day's share of the month carries that day's sketch, the stored month sketch is their union
+        months = [group[-1] for group in aggregator.groups()]
+        self.assertEqual([2, 1], [month.unique_visitors for month in months])
+        merged = HyperLogLog.union([HyperLogLog.from_bytes(month.visitors) for month in months])
+        self.assertEqual(3, merged.count())
+
+    def test_add_counts(self):
+        hour = int(datetime.datetime(2023, 1, 1, 12, tzinfo=datetime.timezone.utc).timestamp()) // 3600
+        # hashed like a record's ip and user agent, so "a" is the visitor of m1 too
+        visitors = [HyperLogLog.hash(f"{ip}\x00") for ip in ("a", "b", "c")]
+        aggregator = MetricsAggregator(top_referrers=1)
+        aggregator.add_records([{"messageId": "m1", "body": body(referrer="x", ip="a", user_agent="")}])
+        aggregator.add_counts("k1", "abc", hour, 3, {"IN": 1, "US": 2}, {DeviceType.MOBILE: 3}, {"x": 2, "y": 1}, visitors[1:])
+        aggregator.add_counts("k2", "abc", hour + 1, 1, {"US": 1}, {DeviceType.TABLET: 1}, {"z": 1}, visitors[:1])
+
+        results = {(m.granularity, m.day): m for m in aggregator.results()}
+        self.assertEqual(
+            {(MetricsGranularity.HOUR, "2023-01-01T12"), (MetricsGranularity.HOUR, "2023-01-01T13"),
+             (MetricsGranularity.DAY, "2023-01-01"), (MetricsGranularity.MONTH, "2023-01")},
+            set(results),
+        )
+        hour_metric = results[(MetricsGranularity.HOUR, "2023-01-01T12")]
+        self.assertEqual(4, hour_metric.total_hits)
+        self.assertEqual({"IN": 2, "US": 2}, hour_metric.by_country)
+        self.assertEqual({DeviceType.DESKTOP: 1, DeviceType.MOBILE: 3}, hour_metric.by_device_type)
+        self.assertEqual({"x": 2, OTHER_BUCKET: 2}, hour_metric.by_referrer)
+        self.assertEqual(["m1", "k1"], hour_metric.message_ids)
+
+        day = results[(MetricsGranularity.DAY, "2023-01-01")]
+        self.assertEqual(5, day.total_hits)
+        self.assertEqual(["m1", "k1", "k2"], day.message_ids)
+        self.assertEqual(3, HyperLogLog.from_bytes(day.visitors).count())
+
+    def test_labels_of(self):
+        cases = [
+            {
+                "name": "start of day",
+                "moment": datetime.datetime(2024, 2, 29, tzinfo=datetime.timezone.utc),
+                "expect": ("2024-02-29T00", "2024-02-29", "2024-02"),
+            },
+            {
+                "name": "last second of day",
+                "moment": datetime.datetime(2024, 2, 29, 23, 59, 59, tzinfo=datetime.timezone.utc),
+                "expect": ("2024-02-29T23", "2024-02-29", "2024-02"),
+            },
+            {
+                "name": "next month",
+                "moment": datetime.datetime(2024, 3, 1, tzinfo=datetime.timezone.utc),
+                "expect": ("2024-03-01T00", "2024-03-01", "2024-03"),
+            },
+            {
+                "name": "same hour again",
+                "moment": datetime.datetime(2024, 3, 1, 0, 30, tzinfo=datetime.timezone.utc),
+                "expect": ("2024-03-01T00", "2024-03-01", "2024-03"),
+            },
+        ]
+
+        period_labels = {}
+        aggregator = MetricsAggregator(period_labels)
+        for case in cases:
+            with self.subTest(case["name"]):
+                hour = int(case["moment"].timestamp()) // 3600
+                self.assertEqual(case["expect"], aggregator.labels_of(hour))
+
+        self.assertEqual(3, len(period_labels))
+
+    def test_add_records_malformed(self):
+        cases = [
+            {"name": "not json", "body": "{"},
+            {"name": "missing url", "body": json.dumps({"timestamp": 1, "country": "IN", "device": "desktop"})},
+            {"name": "unknown device", "body": body(device="watch")},
+            {"name": "bad timestamp", "body": body(timestamp="soon")},
+            {"name": "timestamp past the calendar", "body": body(timestamp=10 ** 12)},
+            {"name": "two messages in one body", "body": body() + "," + body()},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                aggregator = MetricsAggregator()
+                malformed = aggregator.add_records([
+                    {"messageId": "m1", "body": body()},
+                    {"messageId": "m2", "body": case["body"]},
+                    {"messageId": "m3", "body": body()},
+                ])
+
+                self.assertEqual(["m2"], malformed)
+                results = aggregator.results()
+                self.assertEqual(3, len(results))
+                for metric in results:
+                    self.assertEqual(["m1", "m3"], metric.message_ids)
+
+    def test_add_records_shifted_bodies(self):
+        record = body(url="xyz")
+        split = record.index(", ")
+        cases = [
+            {
+                "name": "a record split across two bodies",
+                "bodies": [body() + "," + record[:split], record[split + 2:]],
+                "expect_malformed": ["m1", "m2"],
+            },
+            {
+                "name": "two values making up for an empty body",
+                "bodies": ["", "1,2", body()],
+                "expect_malformed": ["m1", "m2"],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                aggregator = MetricsAggregator()
+                malformed = aggregator.add_records([
+                    {"messageId": f"m{i + 1}", "body": b} for i, b in enumerate(case["bodies"])
+                ])
+
+                self.assertEqual(case["expect_malformed"], malformed)
+                self.assertNotIn("xyz", {m.short_url for m in aggregator.results()})
+
+    def test_add_records_empty(self):
+        aggregator = MetricsAggregator()
+
+        self.assertEqual([], aggregator.add_records([]))
+        self.assertEqual([], aggregator.results())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,243 @@
+import unittest
+import zlib
+from unittest.mock import MagicMock, call, patch
+
+from redis import Connection, ConnectionPool, Redis
+from redis.exceptions import NoScriptError
+
+from app.models.metrics import AccessMetricsSQSMessage, DeviceType
+from app.service.metrics_counters import MetricsCounters
+from app.utils.cache_keys import metrics_counters_key, metrics_processing_key, metrics_dirty_key, \
+    metrics_claims_key
+from app.utils.sketch import HyperLogLog
+
+
+class TestMetricsCounters(unittest.TestCase):
+    def setUp(self):
+        self.mock_redis = MagicMock()
+        self.mock_pipe = self.mock_redis.pipeline.return_value
+        self.register_script = MagicMock()
+        self.claim_script = MagicMock()
+        self.take_script = MagicMock()
+        self.mock_redis.register_script.side_effect = [self.register_script, self.claim_script, self.take_script]
+        self.counters = MetricsCounters(self.mock_redis, precision=11, claim_ttl=300, shards=4)
+
+    def tearDown(self):
+        pass
+
+    def test_record(self):
+        cases = [
+            {
+                "name": "counts every breakdown of the hour",
+                "message": {"referrer": "https://t.co", "country": "IN", "device": DeviceType.MOBILE},
+                "expect_fields": ["TotalHits", "C#IN", "D#mobile", "R#https://t.co"],
+            },
+            {
+                "name": "missing referrer",
+                "message": {"referrer": None, "country": "unknown", "device": DeviceType.DESKTOP},
+                "expect_fields": ["TotalHits", "C#unknown", "D#desktop", "R#none"],
+            },
+        ]
+
+        # 2023-01-01T12:30 utc
+        timestamp = 1672576200
+        key = metrics_counters_key("abc", timestamp // 3600)
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.mock_pipe.reset_mock()
+                self.register_script.reset_mock()
+                message = AccessMetricsSQSMessage(url="abc", ip="1.1.1.1", user_agent="ua", timestamp=timestamp, **case["message"])
+
+                self.counters.record(message)
+
+                self.assertEqual([call(key, field, 1) for field in case["expect_fields"]], self.mock_pipe.hincrby.call_args_list)
+                index, rank = HyperLogLog.register_of(11, HyperLogLog.hash("1.1.1.1\x00ua"))
+                self.mock_pipe.evalsha.assert_called_once_with(self.register_script.sha, 1, key, f"V#{index}", rank)
+                self.register_script.assert_not_called()
+                shard = zlib.crc32(b"abc") % 4
+                self.mock_pipe.sadd.assert_called_once_with(metrics_dirty_key(shard), f"{timestamp // 3600}:abc")
+                self.mock_pipe.execute.assert_called_once()
+                self.mock_redis.pipeline.assert_called_with(transaction=False)
+
+    def test_record_round_trips(self):
+        cases = [
+            {
+                "name": "script already loaded",
+                "evalsha_error": None,
+                "expect_round_trips": 1,
+            },
+            {
+                "name": "script cache flushed",
+                "evalsha_error": NoScriptError("NOSCRIPT No matching script."),
+                "expect_round_trips": 3,
+            },
+        ]
+
+        message = AccessMetricsSQSMessage(url="abc", ip="1.1.1.1", user_agent="ua", timestamp=1672576200,
+                                          referrer=None, country="IN", device=DeviceType.MOBILE)
+        for case in cases:
+            with self.subTest(case["name"]):
+                sent = []
+                # hincrby x4, evalsha, sadd; then script load and evalsha again
+                responses = [1, 1, 1, 1, case["evalsha_error"] or 0, 1, "sha", 0]
+
+                class _Connection(Connection):
+                    def connect(self):
+                        pass
+
+                    def send_packed_command(self, command, check_health=True):
+                        sent.append(command)
+
+                    def read_response(self, *args, **kwargs):
+                        response = responses.pop(0)
+                        if isinstance(response, Exception):
+                            raise response
+                        return response
+
+                client = Redis(connection_pool=ConnectionPool(connection_class=_Connection))
+                with patch.object(Redis, "script_load", return_value="sha"):
+                    counters = MetricsCounters(client, precision=11, shards=4)
+
+                counters.record(message)
+
+                self.assertEqual(case["expect_round_trips"], len(sent))
+
+    def test_drain(self):
+        cases = [
+            {
+                "name": "nothing dirty in any shard",
+                "claimed": [[], [], [], []],
+                "hashes": [],
+                "expect_claims": [(0, 2), (1, 2), (2, 2), (3, 2)],
+                "expect": [],
+            },
+            {
+                "name": "takes each claimed hash",
+                "claimed": [["464000:abc"], ["464001:a:b"]],
+                "hashes": [["TotalHits", "3", "C#IN", "3", "V#7", "2"], []],
+                "expect_claims": [(0, 2), (1, 1)],
+                "expect": [
+                    ("464000:abc", "abc", 464000, {"TotalHits": 3, "C#IN": 3, "V#7": 2}),
+                    ("464001:a:b", "a:b", 464001, {}),
+                ],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.counters._next_shard = 0
+                self.claim_script.reset_mock()
+                self.take_script.reset_mock()
+                self.claim_script.side_effect = case["claimed"]
+                self.mock_pipe.execute.return_value = case["hashes"]
+
+                with patch("app.service.metrics_counters.time.time", return_value=1000.0):
+                    self.assertEqual(case["expect"], self.counters.drain(2))
+
+                # claims older than the ttl are taken over, each shard is asked for what is still missing
+                self.assertEqual(
+                    [
+                        call(keys=[metrics_dirty_key(shard), metrics_claims_key(shard)], args=[count, 1000.0, 700.0])
+                        for shard, count in case["expect_claims"]
+                    ],
+                    self.claim_script.call_args_list,
+                )
+                self.assertEqual(
+                    [
+                        call(keys=[metrics_counters_key(url, hour), metrics_processing_key(url, hour)], client=self.mock_pipe)
+                        for _, url, hour, _ in case["expect"]
+                    ],
+                    self.take_script.call_args_list,
+                )
+
+    def test_drain_rotates_shards(self):
+        self.claim_script.side_effect = [["464000:abc"], ["464000:xyz"], [], [], [], []]
+        self.mock_pipe.execute.return_value = [[]]
+
+        self.counters.drain(1)
+        self.counters.drain(1)
+        self.assertEqual([], self.counters.drain(2))
+
+        # each drain starts after the shard the last one stopped at, an empty one goes all the way round
+        self.assertEqual(
+            [metrics_dirty_key(shard) for shard in (0, 1, 2, 3, 0, 1)],
+            [c.kwargs["keys"][0] for c in self.claim_script.call_args_list],
+        )
+
+    def test_finish(self):
+        order = MagicMock()
+        order.attach_mock(self.mock_pipe.delete, "delete")
+        order.attach_mock(self.mock_pipe.zrem, "zrem")
+        order.attach_mock(self.mock_pipe.execute, "execute")
+        drained = [
+            ("464000:abc", "abc", 464000, {"TotalHits": 3}),
+            ("464001:xyz", "xyz", 464001, {}),
+            ("464001:abc", "abc", 464001, {"TotalHits": 1}),
+        ]
+
+        self.counters.finish(drained)
+
+        # the claims go only once their processing hashes are gone
+        abc, xyz = self.counters.shard_of("abc"), self.counters.shard_of("xyz")
+        self.assertEqual(
+            [
+                call.delete(metrics_processing_key("abc", 464000)),
+                call.delete(metrics_processing_key("xyz", 464001)),
+                call.delete(metrics_processing_key("abc", 464001)),
+                call.execute(),
+                call.zrem(metrics_claims_key(abc), "464000:abc", "464001:abc"),
+                call.zrem(metrics_claims_key(xyz), "464001:xyz"),
+                call.execute(),
+            ],
+            order.mock_calls,
+        )
+
+    def test_release(self):
+        order = MagicMock()
+        order.attach_mock(self.mock_pipe.sadd, "sadd")
+        order.attach_mock(self.mock_pipe.zrem, "zrem")
+        order.attach_mock(self.mock_pipe.delete, "delete")
+        order.attach_mock(self.mock_pipe.execute, "execute")
+
+        self.counters.release([
+            ("464000:abc", "abc", 464000, {"TotalHits": 3, "V#7": 2}),
+            ("464001:abc", "abc", 464001, {"TotalHits": 1}),
+        ])
+
+        # the processing hashes stay, the next drain adds newer hits into them
+        shard = self.counters.shard_of("abc")
+        self.assertEqual(
+            [
+                call.sadd(metrics_dirty_key(shard), "464000:abc", "464001:abc"),
+                call.zrem(metrics_claims_key(shard), "464000:abc", "464001:abc"),
+                call.execute(),
+            ],
+            order.mock_calls,
+        )
+
+    def test_finish_release_nothing(self):
+        self.counters.finish([])
+        self.counters.release([])
+
+        self.mock_redis.pipeline.assert_not_called()
+
+    def test_counts_of(self):
+        total, countries, devices, referrers, visitors = self.counters.counts_of({
+            "TotalHits": 4,
+            "C#IN": 3,
+            "C#US": 1,
+            "D#mobile": 4,
+            "R#none": 1,
+            "R#https://t.co": 3,
+            "V#7": 2,
+        })
+
+        self.assertEqual(4, total)
+        self.assertEqual({"IN": 3, "US": 1}, countries)
+        self.assertEqual({DeviceType.MOBILE: 4}, devices)
+        self.assertEqual({"none": 1, "https://t.co": 3}, referrers)
+        self.assertEqual([(7, 2)], [HyperLogLog.register_of(11, visitor) for visitor in visitors])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,6 +8,7 @@ from app.constants import HASHID_SALT, PRO_RATE_LIMIT, STD_RATE_LIMIT
 from app.errors.web_errors import ErrorCodes, WebException
 from app.models.subscriptions import Subscription
 from app.service.rate_limiter import RateLimitingService
+from app.utils.cache_keys import rate_limit_key, url_cache_key
 
 
 class TestRateLimitingService(unittest.TestCase):
@@ -63,14 +64,16 @@ class TestRateLimitingService(unittest.TestCase):
                     mock_dt.timedelta = datetime.timedelta
                     
                     window_start = int(self.fixed_time.timestamp()) - (int(self.fixed_time.timestamp()) % 60)
-                    key = f"rl:{case['short']}:{window_start}"
+                    key = rate_limit_key(case['short'], window_start)
                     
                     if callable(case["prep_counts"]):
                         counts = case["prep_counts"](key)
                     else:
                         counts = case["prep_counts"]
                     
-                    self.mock_redis.incr.return_value = counts.get(key, 1)
+                    script = self.mock_redis.register_script.return_value
+                    script.reset_mock()
+                    script.return_value = [counts.get(key, 1), None, -2]
                     
                     if case["raises"]:
                         with self.assertRaises(WebException) as ctx:
@@ -79,6 +82,117 @@ class TestRateLimitingService(unittest.TestCase):
                     else:
                         allowed = self.service.check_access(case["short"])
                         self.assertEqual(case["expect_allowed"], allowed)
+                        script.assert_called_once_with(keys=[key, url_cache_key(case['short'])], args=[60])
+
+    def test_check_access_cached_url(self):
+        cases = [
+            {
+                "name": "cached url is handed over",
+                "script_return": [1, "example.com", 5000],
+                "expect_calls": [(self.pro_short, "example.com", 5000)],
+            },
+            {
+                "name": "missing url is not handed over",
+                "script_return": [1, None, -2],
+                "expect_calls": [],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                received = []
+                service = RateLimitingService(self.mock_redis, lambda code, url, ttl_ms: received.append((code, url, ttl_ms)))
+                self.mock_redis.register_script.return_value.return_value = case["script_return"]
+
+                self.assertTrue(service.check_access(self.pro_short))
+                self.assertEqual(case["expect_calls"], received)
+
+    def test_check_access_lease(self):
+        cases = [
+            {
+                "name": "lease is spent locally",
+                "short": self.pro_short,
+                "grants": [3],
+                "hits": 3,
+                "expect_allowed": [True, True, True],
+                "expect_lease_calls": 1,
+                "expect_redirect_calls": 0,
+            },
+            {
+                "name": "lease is refilled once used up",
+                "short": self.pro_short,
+                "grants": [2, 2],
+                "hits": 4,
+                "expect_allowed": [True, True, True, True],
+                "expect_lease_calls": 2,
+                "expect_redirect_calls": 0,
+            },
+            {
+                "name": "spent budget is denied without going back to redis",
+                "short": self.pro_short,
+                "grants": [1, 0],
+                "hits": 4,
+                "expect_allowed": [True, False, False, False],
+                "expect_lease_calls": 2,
+                "expect_redirect_calls": 0,
+            },
+            {
+                "name": "low limit links are not leased",
+                "short": self.std_short,
+                "grants": [],
+                "hits": 2,
+                "expect_allowed": [True, True],
+                "expect_lease_calls": 0,
+                "expect_redirect_calls": 2,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                redirect_script = MagicMock(return_value=[1, None, -2])
+                lease_script = MagicMock(side_effect=[[grant, "example.com", 5000] for grant in case["grants"]])
+                self.mock_redis.register_script.side_effect = [redirect_script, lease_script]
+                service = RateLimitingService(self.mock_redis, lease_size=3)
+
+                with patch("app.service.rate_limiter.datetime") as mock_dt:
+                    mock_dt.datetime.now.return_value = self.fixed_time
+                    mock_dt.timezone = datetime.timezone
+
+                    allowed = [service.check_access(case["short"]) for _ in range(case["hits"])]
+
+                self.assertEqual(case["expect_allowed"], allowed)
+                self.assertEqual(case["expect_lease_calls"], lease_script.call_count)
+                self.assertEqual(case["expect_redirect_calls"], redirect_script.call_count)
+                if lease_script.called:
+                    self.assertEqual([60, 3, PRO_RATE_LIMIT], lease_script.call_args.kwargs["args"])
+
+        self.mock_redis.register_script.side_effect = None
+
+    def test_check_access_lease_window(self):
+        cases = [
+            {
+                "name": "exhausted lease resets with the window",
+                "grants": [0, 5],
+                "expect_allowed": [False, True],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                lease_script = MagicMock(side_effect=[[grant, None, -2] for grant in case["grants"]])
+                self.mock_redis.register_script.side_effect = [MagicMock(), lease_script]
+                service = RateLimitingService(self.mock_redis, lease_size=5)
+
+                allowed = []
+                for minute in range(len(case["grants"])):
+                    with patch("app.service.rate_limiter.datetime") as mock_dt:
+                        mock_dt.datetime.now.return_value = self.fixed_time + datetime.timedelta(minutes=minute)
+                        mock_dt.timezone = datetime.timezone
+                        allowed.append(service.check_access(self.pro_short))
+
+                self.assertEqual(case["expect_allowed"], allowed)
+
+        self.mock_redis.register_script.side_effect = None
 
     def test_rate_limit(self):
         event = {"pathParameters": {"short_url": "stdabc"}}
@@ -1,17 +1,26 @@
+import json
 import unittest
-from unittest.mock import MagicMock
+from decimal import Decimal
+from unittest.mock import MagicMock, call, patch
 
 import hashids
+from botocore.exceptions import ClientError
 
-from app.constants import HASHID_SALT
+from app.constants import HASHID_SALT, NEGATIVE_CACHE_MARKER, NEGATIVE_CACHE_TTL, URL_CACHE_TTL, HOT_URL_CACHE_TTL
+from app.errors.web_errors import ErrorCodes, WebException
+from app.models.short_url import ShortUrl
 from app.models.subscriptions import Subscription
 from app.service.url_service import ShortURLService
+from app.utils.cache_keys import url_cache_key, url_lock_key, user_urls_key
+from app.utils.cursor import encode_cursor
+from app.utils.local_cache import LocalCache
 
 
 class TestShortURLService(unittest.TestCase):
     def setUp(self):
         self.mock_repo = MagicMock()
         self.mock_redis = MagicMock()
+        self.mock_pipe = self.mock_redis.pipeline.return_value
         self.service = ShortURLService(self.mock_repo, self.mock_redis)
         self.encoder = hashids.Hashids(salt=HASHID_SALT, min_length=7)
 
@@ -46,6 +55,161 @@ class TestShortURLService(unittest.TestCase):
                 decoded_str = str(decoded[0])
                 self.assertTrue(decoded_str.startswith(case["expect_prefix"]))
                 self.mock_repo.add_url.assert_called()
+                self.mock_pipe.set.assert_called_with(url_cache_key(short_url), "https://example.com", ex=URL_CACHE_TTL)
+                self.mock_pipe.delete.assert_called_with(user_urls_key("user-id"))
+
+    def test_create_short_url_write_through(self):
+        cases = [
+            {
+                "name": "cache is populated after the write",
+                "add_error": None,
+                "cache_error": None,
+                "expect_set": True,
+                "expect_delete": False,
+            },
+            {
+                "name": "failed write leaves the cache alone",
+                "add_error": ConnectionError("dynamo down"),
+                "cache_error": None,
+                "expect_set": False,
+                "expect_delete": False,
+            },
+            {
+                "name": "failed cache write falls back to deleting the key",
+                "add_error": None,
+                "cache_error": ConnectionError("redis down"),
+                "expect_set": True,
+                "expect_delete": True,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.mock_repo.reset_mock()
+                self.mock_redis.reset_mock()
+                write_pipe, delete_pipe = MagicMock(), MagicMock()
+                self.mock_redis.pipeline.side_effect = [write_pipe, delete_pipe]
+                self.mock_repo.get_counter.return_value = 11
+                self.mock_repo.add_url.side_effect = case["add_error"]
+                write_pipe.execute.side_effect = case["cache_error"]
+
+                if case["add_error"]:
+                    with self.assertRaises(ConnectionError):
+                        self.service.create_short_url("example.com", "user-id", Subscription.STANDARD)
+                else:
+                    short_url = self.service.create_short_url("example.com", "user-id", Subscription.STANDARD)
+                    if case["expect_delete"]:
+                        # one key per DEL, a multi key DEL is CROSSSLOT on a clustered cache
+                        self.assertEqual(
+                            [call(user_urls_key("user-id")), call(url_cache_key(short_url))],
+                            delete_pipe.delete.call_args_list,
+                        )
+                        delete_pipe.execute.assert_called_once()
+                        self.mock_redis.pipeline.assert_called_with(transaction=False)
+
+                self.assertEqual(case["expect_set"], write_pipe.set.called)
+                self.assertEqual(case["expect_delete"], delete_pipe.delete.called)
+                self.mock_redis.delete.assert_not_called()
+
+        self.mock_repo.add_url.side_effect = None
+        self.mock_redis.pipeline.side_effect = None
+
+    def test_create_short_url_dedupe(self):
+        conflict = ClientError({"Error": {"Code": "TransactionCanceledException"}}, "TransactWriteItems")
+
+        cases = [
+            {
+                "name": "existing destination is returned without a write",
+                "dedupe": True,
+                "indexed": ["existing"],
+                "add_error": None,
+                "expect_existing": True,
+                "expect_written": False,
+            },
+            {
+                "name": "new destination is indexed on write",
+                "dedupe": True,
+                "indexed": [None],
+                "add_error": None,
+                "expect_existing": False,
+                "expect_written": True,
+            },
+            {
+                "name": "lost race returns the winner's code",
+                "dedupe": True,
+                "indexed": [None, "existing"],
+                "add_error": conflict,
+                "expect_existing": True,
+                "expect_written": True,
+            },
+            {
+                "name": "dedupe off skips the index",
+                "dedupe": False,
+                "indexed": [],
+                "add_error": None,
+                "expect_existing": False,
+                "expect_written": True,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.mock_repo.reset_mock()
+                self.mock_repo.get_counter.return_value = 11
+                self.mock_repo.get_short_url_by_hash.side_effect = case["indexed"]
+                self.mock_repo.add_url.side_effect = case["add_error"]
+
+                short_url = self.service.create_short_url("example.com", "user-id", Subscription.STANDARD,
+                                                          dedupe=case["dedupe"])
+
+                self.assertEqual(case["expect_existing"], short_url == "existing")
+                self.assertEqual(case["expect_written"], self.mock_repo.add_url.called)
+                self.assertEqual(len(case["indexed"]), self.mock_repo.get_short_url_by_hash.call_count)
+                if case["expect_written"]:
+                    url_hash = self.mock_repo.add_url.call_args.args[1]
+                    self.assertEqual(case["dedupe"], url_hash is not None)
+
+        self.mock_repo.add_url.side_effect = None
+
+    def test_create_short_urls(self):
+        cases = [
+            {
+                "name": "reserves one range and writes all urls",
+                "urls": ["a.com", "b.com", "c.com"],
+                "failed": set(),
+                "expect_errors": [False, False, False],
+            },
+            {
+                "name": "reports failed writes per url",
+                "urls": ["a.com", "b.com"],
+                "failed": "second",
+                "expect_errors": [False, True],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                code_filter = MagicMock()
+                service = ShortURLService(self.mock_repo, self.mock_redis, code_filter=code_filter)
+                self.mock_repo.get_counter_range.reset_mock()
+                self.mock_repo.get_counter_range.return_value = range(100, 100 + len(case["urls"]))
+                written = []
+
+                def _add_urls(short_urls):
+                    written.extend(short_urls)
+                    return {short_urls[1].short_url} if case["failed"] == "second" else set()
+
+                self.mock_repo.add_urls.side_effect = _add_urls
+
+                results = service.create_short_urls(case["urls"], "user-id", Subscription.PREMIUM)
+
+                self.mock_repo.get_counter_range.assert_called_once_with(len(case["urls"]))
+                self.assertEqual(case["urls"], [result["url"] for result in results])
+                self.assertEqual(case["expect_errors"], ["error" in result for result in results])
+                codes = [short_url.short_url for short_url in written]
+                code_filter.add_many.assert_called_once_with(codes)
+                for code, count in zip(codes, range(100, 200)):
+                    self.assertEqual([int(f"{Subscription.PREMIUM.to_number()}{count}")], list(self.encoder.decode(code)))
 
     def test_get_original_url(self):
         cases = [
@@ -69,7 +233,7 @@ class TestShortURLService(unittest.TestCase):
 
         for case in cases:
             with self.subTest(case["name"]):
-                self.mock_redis.get.return_value = case["cache_value"]
+                self.mock_pipe.execute.return_value = [case["cache_value"], 600_000]
                 self.mock_repo.get_url.return_value = case["db_value"]
                 self.mock_redis.set.reset_mock()
                 
@@ -80,25 +244,295 @@ class TestShortURLService(unittest.TestCase):
                     self.mock_repo.get_url.assert_not_called()
                 else:
                     self.mock_repo.get_url.assert_called_once()
-                    self.mock_redis.set.assert_called()
+                    self.mock_redis.set.assert_called_with(url_cache_key("stdabc"), "db.com", ex=URL_CACHE_TTL)
+
+    def test_get_original_url_not_found(self):
+        not_found = WebException(status_code=404, message="missing", error_code=ErrorCodes.SHORTURL_NOT_FOUND)
+
+        cases = [
+            {
+                "name": "db miss is cached negatively",
+                "cache_value": None,
+                "filter_result": True,
+                "expect_db_called": True,
+                "expect_negative_set": True,
+            },
+            {
+                "name": "negative cache hit skips db",
+                "cache_value": NEGATIVE_CACHE_MARKER,
+                "filter_result": True,
+                "expect_db_called": False,
+                "expect_negative_set": False,
+            },
+            {
+                "name": "filter rejects unknown code without db read",
+                "cache_value": None,
+                "filter_result": False,
+                "expect_db_called": False,
+                "expect_negative_set": False,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                code_filter = MagicMock()
+                code_filter.might_contain.return_value = case["filter_result"]
+                service = ShortURLService(self.mock_repo, self.mock_redis, code_filter=code_filter)
+                self.mock_pipe.execute.return_value = [case["cache_value"], 30_000]
+                self.mock_redis.set.reset_mock()
+                self.mock_repo.get_url.reset_mock()
+                self.mock_repo.get_url.side_effect = not_found
+
+                with self.assertRaises(WebException) as ctx:
+                    service.get_original_url("stdabc")
+
+                self.assertEqual(ErrorCodes.SHORTURL_NOT_FOUND, ctx.exception.error_code)
+                self.assertEqual(case["expect_db_called"], self.mock_repo.get_url.called)
+                negative_set = call(url_cache_key("stdabc"), NEGATIVE_CACHE_MARKER, ex=NEGATIVE_CACHE_TTL, nx=True)
+                self.assertEqual(case["expect_negative_set"], negative_set in self.mock_redis.set.call_args_list)
+
+        self.mock_repo.get_url.side_effect = None
+
+    def test_get_original_url_local_cache(self):
+        cases = [
+            {
+                "name": "local hit skips redis",
+                "local_value": "local.com",
+                "cache_value": "hit.com",
+                "expect_result": "local.com",
+                "expect_redis_called": False,
+            },
+            {
+                "name": "local miss populates from redis",
+                "local_value": None,
+                "cache_value": "hit.com",
+                "expect_result": "hit.com",
+                "expect_redis_called": True,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                local_cache = LocalCache(max_bytes=10_000, ttl=60)
+                if case["local_value"]:
+                    local_cache.set("stdabc", case["local_value"])
+                service = ShortURLService(self.mock_repo, self.mock_redis, local_cache)
+                self.mock_redis.pipeline.reset_mock()
+                self.mock_pipe.execute.return_value = [case["cache_value"], 600_000]
+
+                result = service.get_original_url("stdabc")
+
+                self.assertEqual(case["expect_result"], result)
+                self.assertEqual(case["expect_redis_called"], self.mock_redis.pipeline.called)
+                self.assertEqual(case["expect_result"], local_cache.get("stdabc"))
+
+    def test_get_original_url_stampede(self):
+        cases = [
+            {
+                "name": "lock holder reads db",
+                "cache_value": None,
+                "lock_taken": True,
+                "polled": [],
+                "early_refresh": False,
+                "expect_result": "db.com",
+                "expect_db_called": True,
+            },
+            {
+                "name": "waiter picks up the loader's result",
+                "cache_value": None,
+                "lock_taken": None,
+                "polled": [None, "loaded.com"],
+                "early_refresh": False,
+                "expect_result": "loaded.com",
+                "expect_db_called": False,
+            },
+            {
+                "name": "waiter falls back to db after the wait",
+                "cache_value": None,
+                "lock_taken": None,
+                "polled": lambda key: None,
+                "early_refresh": False,
+                "expect_result": "db.com",
+                "expect_db_called": True,
+            },
+            {
+                "name": "early refresh reloads a live key",
+                "cache_value": "hit.com",
+                "lock_taken": True,
+                "polled": [],
+                "early_refresh": True,
+                "expect_result": "db.com",
+                "expect_db_called": True,
+            },
+            {
+                "name": "early refresh serves stale while another container loads",
+                "cache_value": "hit.com",
+                "lock_taken": None,
+                "polled": [],
+                "early_refresh": True,
+                "expect_result": "hit.com",
+                "expect_db_called": False,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.mock_pipe.execute.return_value = [case["cache_value"], 1_000]
+                self.mock_redis.set.reset_mock()
+                self.mock_redis.set.return_value = case["lock_taken"]
+                self.mock_redis.get.side_effect = case["polled"]
+                self.mock_repo.get_url.reset_mock()
+                self.mock_repo.get_url.return_value = "db.com"
+
+                with patch.object(self.service, "should_refresh_early", return_value=case["early_refresh"]), \
+                        patch("app.service.url_service.time.sleep"):
+                    result = self.service.get_original_url("stdabc")
+
+                self.assertEqual(case["expect_result"], result)
+                self.assertEqual(case["expect_db_called"], self.mock_repo.get_url.called)
+                self.assertEqual(url_lock_key("stdabc"), self.mock_redis.set.call_args_list[0].args[0])
+
+        self.mock_redis.get.side_effect = None
+
+    def test_should_refresh_early(self):
+        cases = [
+            {"name": "no ttl", "ttl_ms": -2, "roll": 0.99, "expect": False},
+            {"name": "far from expiry", "ttl_ms": 600_000, "roll": 0.5, "expect": False},
+            {"name": "about to expire", "ttl_ms": 10, "roll": 0.5, "expect": True},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                with patch("app.service.url_service.random.random", return_value=case["roll"]):
+                    self.assertEqual(case["expect"], self.service.should_refresh_early(case["ttl_ms"]))
+
+    def test_accept_cached_url(self):
+        cases = [
+            {"name": "fresh url is cached locally", "early_refresh": False, "expect_local": "hit.com"},
+            {"name": "url due for refresh is reloaded on lookup", "early_refresh": True, "expect_local": None},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                local_cache = LocalCache(max_bytes=10_000, ttl=60)
+                service = ShortURLService(self.mock_repo, self.mock_redis, local_cache)
+                self.mock_redis.set.return_value = True
+                self.mock_repo.get_url.reset_mock()
+                self.mock_repo.get_url.return_value = "db.com"
+
+                with patch.object(service, "should_refresh_early", return_value=case["early_refresh"]):
+                    service.accept_cached_url("stdabc", "hit.com", 1_000)
+                self.assertEqual(case["expect_local"], local_cache.get("stdabc"))
+
+                service.get_original_url("stdabc")
+                self.assertEqual(case["early_refresh"], self.mock_repo.get_url.called)
+
+    def test_cache_ttl_for(self):
+        cases = [
+            {"name": "no tracker", "hot_codes": None, "expect": URL_CACHE_TTL},
+            {"name": "cold code", "hot_codes": {"other"}, "expect": URL_CACHE_TTL},
+            {"name": "hot code", "hot_codes": {"stdabc"}, "expect": HOT_URL_CACHE_TTL},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                hot_keys = None
+                if case["hot_codes"] is not None:
+                    hot_keys = MagicMock()
+                    hot_keys.is_hot.side_effect = lambda code: code in case["hot_codes"]
+                service = ShortURLService(self.mock_repo, self.mock_redis, hot_keys=hot_keys)
+
+                self.assertEqual(case["expect"], service.cache_ttl_for("stdabc"))
 
     def test_get_urls_by_user(self):
+        # what the OWNER_CREATED_INDEX query hands back as LastEvaluatedKey
+        next_key = {"PK": "USER#u1", "SK": "SHORTURL#b", "ListedBy": "u1", "CreatedAt": Decimal(1700000000)}
+        url_a = ShortUrl(ShortURL="a", ID="1", URL="a.com", CreatedAt=2, OwnerID="u1")
+        url_b = ShortUrl(ShortURL="b", ID="2", URL="b.com", CreatedAt=1, OwnerID="u1")
+
         cases = [
             {
-                "name": "returns user urls",
-                "user_id": "u1",
-                "repo_return": ["a", "b"],
-                "expect": ["a", "b"],
+                "name": "first page from the table",
+                "cursor": None,
+                "cached": None,
+                "repo_return": ([url_a, url_b], next_key),
+                "expect": {"shortUrls": [url_a.model_dump(mode='json'), url_b.model_dump(mode='json')],
+                           "nextCursor": encode_cursor(next_key)},
+                "expect_start_key": None,
+                "expect_repo_called": True,
+            },
+            {
+                "name": "next page continues from the cursor",
+                "cursor": encode_cursor(next_key),
+                "cached": None,
+                "repo_return": ([url_a], None),
+                "expect": {"shortUrls": [url_a.model_dump(mode='json')], "nextCursor": None},
+                "expect_start_key": next_key,
+                "expect_repo_called": True,
+            },
+            {
+                "name": "cached page skips the table",
+                "cursor": None,
+                "cached": '{"shortUrls": ["a"], "nextCursor": null}',
+                "repo_return": None,
+                "expect": {"shortUrls": ["a"], "nextCursor": None},
+                "expect_repo_called": False,
+            },
+            {
+                "name": "another user's cursor is rejected",
+                "cursor": encode_cursor({**next_key, "PK": "USER#u2", "ListedBy": "u2"}),
+                "cached": None,
+                "repo_return": None,
+                "expect_error": ErrorCodes.INVALID_CURSOR,
+                "expect_repo_called": False,
+            },
+            *[
+                {
+                    "name": f"tampered cursor is rejected: {name}",
+                    "cursor": encode_cursor(key),
+                    "cached": None,
+                    "repo_return": None,
+                    "expect_error": ErrorCodes.INVALID_CURSOR,
+                    "expect_repo_called": False,
+                }
+                for name, key in [
+                    ("listed by", {**next_key, "ListedBy": "u2"}),
+                    ("created at text", {**next_key, "CreatedAt": "yesterday"}),
+                    ("fractional created at", {**next_key, "CreatedAt": Decimal("1.5")}),
+                    ("sort key", {**next_key, "SK": "DETAILS"}),
+                    ("missing attribute", {"PK": "USER#u1", "SK": "SHORTURL#b"}),
+                    ("extra attribute", {**next_key, "Other": "x"}),
+                ]
+            ],
+            {
+                "name": "malformed cursor is rejected",
+                "cursor": "not-a-cursor",
+                "cached": None,
+                "repo_return": None,
+                "expect_error": ErrorCodes.INVALID_CURSOR,
+                "expect_repo_called": False,
             },
         ]
 
         for case in cases:
             with self.subTest(case["name"]):
+                self.mock_repo.get_urls_by_user_id.reset_mock()
                 self.mock_repo.get_urls_by_user_id.return_value = case["repo_return"]
-                
-                result = self.service.get_urls_by_user(case["user_id"])
-                
-                self.assertEqual(case["expect"], result)
+                self.mock_redis.hget.return_value = case["cached"]
+                self.mock_pipe.hset.reset_mock()
+
+                if "expect_error" in case:
+                    with self.assertRaises(WebException) as ctx:
+                        self.service.get_urls_by_user("u1", 2, case["cursor"])
+                    self.assertEqual(case["expect_error"], ctx.exception.error_code)
+                else:
+                    self.assertEqual(case["expect"], self.service.get_urls_by_user("u1", 2, case["cursor"]))
+
+                self.assertEqual(case["expect_repo_called"], self.mock_repo.get_urls_by_user_id.called)
+                if case["expect_repo_called"]:
+                    self.mock_repo.get_urls_by_user_id.assert_called_once_with("u1", 2, case["expect_start_key"], True)
+                    self.mock_pipe.hset.assert_called_once_with(user_urls_key("u1"), f"desc:2:{case['cursor'] or ''}",
+                                                                 json.dumps(case["expect"]))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+import threading
+import unittest
+
+from app.utils.batch_buffer import BatchBuffer
+
+
+class TestBatchBuffer(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+
+    def tearDown(self):
+        pass
+
+    def _send(self, batch):
+        self.batches.append(list(batch))
+        return 0
+
+    def test_flush(self):
+        cases = [
+            {
+                "name": "splits into batches of max size",
+                "items": 25,
+                "max_age": 60,
+                "expect_sizes": [10, 10, 5],
+            },
+            {
+                "name": "single item is sent on flush",
+                "items": 1,
+                "max_age": 60,
+                "expect_sizes": [1],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.batches = []
+                gate = threading.Event()
+
+                def send(batch):
+                    gate.wait(5)
+                    return self._send(batch)
+
+                buffer = BatchBuffer(send, max_batch=10, max_age=case["max_age"], max_pending=100)
+                for i in range(case["items"]):
+                    buffer.add(str(i))
+                gate.set()
+
+                self.assertTrue(buffer.flush(timeout=5))
+                self.assertEqual(case["expect_sizes"], [len(b) for b in self.batches])
+                self.assertEqual([str(i) for i in range(case["items"])], [i for b in self.batches for i in b])
+                stats = buffer.stats()
+                self.assertEqual(0, stats["depth"])
+                self.assertEqual(case["items"], stats["sent"])
+
+    def test_dropped(self):
+        cases = [
+            {
+                "name": "failed entries are counted",
+                "send": lambda batch: 1,
+                "max_pending": 100,
+                "items": 3,
+                "expect_sent": 2,
+                "expect_dropped": 1,
+            },
+            {
+                "name": "send errors drop the batch",
+                "send": lambda batch: 1 / 0,
+                "max_pending": 100,
+                "items": 3,
+                "expect_sent": 0,
+                "expect_dropped": 3,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                gate = threading.Event()
+
+                def send(batch, inner=case["send"]):
+                    gate.wait(5)
+                    return inner(batch)
+
+                buffer = BatchBuffer(send, max_batch=10, max_age=60, max_pending=case["max_pending"])
+                for i in range(case["items"]):
+                    buffer.add(str(i))
+                gate.set()
+
+                self.assertTrue(buffer.flush(timeout=5))
+                stats = buffer.stats()
+                self.assertEqual(case["expect_sent"], stats["sent"])
+                self.assertEqual(case["expect_dropped"], stats["dropped"])
+
+    def test_max_pending(self):
+        gate = threading.Event()
+
+        def send(batch):
+            gate.wait(5)
+            return self._send(batch)
+
+        buffer = BatchBuffer(send, max_batch=1, max_age=0, max_pending=2)
+        for i in range(10):
+            buffer.add(str(i))
+        gate.set()
+
+        self.assertTrue(buffer.flush(timeout=5))
+        stats = buffer.stats()
+        self.assertGreater(stats["dropped"], 0)
+        self.assertEqual(10, stats["sent"] + stats["dropped"])
+
+
+if __name__ == "__main__":
+    unittest.main()
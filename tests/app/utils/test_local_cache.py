@@ -0,0 +1,88 @@
+import sys
+import unittest
+from unittest.mock import patch
+
+from app.utils.local_cache import LocalCache
+
+
+def _entry_size(key: str, value: str) -> int:
+    return sys.getsizeof(key) + sys.getsizeof(value)
+
+
+class TestLocalCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.time_patcher = patch("app.utils.local_cache.time.monotonic", side_effect=lambda: self.now)
+        self.time_patcher.start()
+
+    def tearDown(self):
+        self.time_patcher.stop()
+
+    def test_get(self):
+        cases = [
+            {
+                "name": "hit",
+                "advance": 0,
+                "expect": "example.com",
+                "expect_stats": {"hits": 1, "misses": 0, "expirations": 0},
+            },
+            {
+                "name": "expired entry is a miss",
+                "advance": 61,
+                "expect": None,
+                "expect_stats": {"hits": 0, "misses": 1, "expirations": 1},
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                cache = LocalCache(max_bytes=10_000, ttl=60)
+                cache.set("abc", "example.com")
+                self.now += case["advance"]
+
+                self.assertEqual(case["expect"], cache.get("abc"))
+                stats = cache.stats()
+                for key, val in case["expect_stats"].items():
+                    self.assertEqual(val, stats[key])
+
+    def test_set(self):
+        one_entry = _entry_size("aaa", "x" * 100)
+
+        cases = [
+            {
+                "name": "evicts least recently used when over budget",
+                "max_bytes": one_entry * 2,
+                "touch": "aaa",
+                "expect_present": ["aaa", "ccc"],
+                "expect_absent": ["bbb"],
+                "expect_evictions": 1,
+            },
+            {
+                "name": "oversized entry is not cached",
+                "max_bytes": one_entry - 1,
+                "touch": None,
+                "expect_present": [],
+                "expect_absent": ["aaa", "bbb", "ccc"],
+                "expect_evictions": 0,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                cache = LocalCache(max_bytes=case["max_bytes"], ttl=60)
+                cache.set("aaa", "x" * 100)
+                cache.set("bbb", "x" * 100)
+                if case["touch"]:
+                    cache.get(case["touch"])
+                cache.set("ccc", "x" * 100)
+
+                for key in case["expect_present"]:
+                    self.assertIsNotNone(cache.get(key))
+                for key in case["expect_absent"]:
+                    self.assertIsNone(cache.get(key))
+                self.assertEqual(case["expect_evictions"], cache.stats()["evictions"])
+                self.assertLessEqual(cache.size, case["max_bytes"])
+
+
+if __name__ == "__main__":
+    unittest.main()
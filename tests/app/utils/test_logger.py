@@ -0,0 +1,146 @@
+import io
+import json
+import logging
+import unittest
+from unittest.mock import MagicMock, patch
+
+from app.utils import logger as logger_module
+from app.utils.logger import JsonFormatter, StructuredLogger
+
+
+class TestStructuredLogger(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def _logger(self, name: str, level: int) -> tuple[StructuredLogger, io.StringIO]:
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(JsonFormatter())
+        std_logger = logging.getLogger(name)
+        std_logger.handlers = [handler]
+        std_logger.propagate = False
+        std_logger.setLevel(level)
+        return StructuredLogger(std_logger), stream
+
+    @staticmethod
+    def _records(stream: io.StringIO) -> list[dict]:
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    def test_level_gating(self):
+        cases = [
+            {
+                "name": "debug is dropped at info",
+                "level": logging.INFO,
+                "call": "debug",
+                "expect_records": 0,
+            },
+            {
+                "name": "debug is emitted at debug",
+                "level": logging.DEBUG,
+                "call": "debug",
+                "expect_records": 1,
+            },
+            {
+                "name": "warning is emitted at info",
+                "level": logging.INFO,
+                "call": "warning",
+                "expect_records": 1,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                log, stream = self._logger(f"test.gating.{case['call']}.{case['level']}", case["level"])
+                headers = MagicMock(return_value={"host": "example.com"})
+
+                getattr(log, case["call"])("headers", headers=headers)
+
+                self.assertEqual(case["expect_records"], len(self._records(stream)))
+                self.assertEqual(case["expect_records"], headers.call_count)
+
+    def test_sampling(self):
+        cases = [
+            {
+                "name": "every call without sampling",
+                "sample": 1,
+                "calls": 5,
+                "expect_records": 5,
+            },
+            {
+                "name": "one in n calls",
+                "sample": 4,
+                "calls": 9,
+                "expect_records": 3,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                log, stream = self._logger(f"test.sampling.{case['sample']}", logging.DEBUG)
+
+                for i in range(case["calls"]):
+                    log.debug("hit", sample=case["sample"], i=i)
+
+                records = self._records(stream)
+                self.assertEqual(case["expect_records"], len(records))
+                self.assertEqual(list(range(0, case["calls"], case["sample"])), [r["i"] for r in records])
+
+    def test_json_format(self):
+        log, stream = self._logger("test.format", logging.INFO)
+
+        log.info("imported", count=3, elapsed=lambda: 1.5)
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            log.exception("failed")
+
+        first, second = self._records(stream)
+        self.assertEqual("INFO", first["level"])
+        self.assertEqual("test.format", first["logger"])
+        self.assertEqual("imported", first["msg"])
+        self.assertEqual(3, first["count"])
+        self.assertEqual(1.5, first["elapsed"])
+        self.assertEqual("ERROR", second["level"])
+        self.assertIn("ValueError: boom", second["exc"])
+
+    def test_configure_levels(self):
+        cases = [
+            {
+                "name": "default level",
+                "env": {},
+                "expect": {"app": logging.INFO},
+            },
+            {
+                "name": "level from env",
+                "env": {"LOG_LEVEL": "warning"},
+                "expect": {"app": logging.WARNING},
+            },
+            {
+                "name": "per module overrides",
+                "env": {"LOG_LEVELS": "app.test_a=DEBUG, app.test_b=ERROR"},
+                "expect": {"app": logging.INFO, "app.test_a": logging.DEBUG, "app.test_b": logging.ERROR},
+            },
+        ]
+
+        app_logger = logging.getLogger("app")
+        saved = (app_logger.handlers, app_logger.propagate, app_logger.level)
+        for case in cases:
+            with self.subTest(case["name"]):
+                with patch.dict("os.environ", case["env"], clear=True), \
+                        patch.object(logger_module, "_configured", False):
+                    logger_module.configure()
+
+                for name, level in case["expect"].items():
+                    self.assertEqual(level, logging.getLogger(name).level)
+
+                for name in ("app.test_a", "app.test_b"):
+                    logging.getLogger(name).setLevel(logging.NOTSET)
+
+        app_logger.handlers, app_logger.propagate, app_logger.level = saved
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+from decimal import Decimal
+
+import hashids
+
+from app.constants import HASHID_SALT, SHORT_CODE_MIN_LENGTH
+from app.models.subscriptions import Subscription
+from app.utils.short_code import ShortCodeCodec, short_code_codec
+
+
+class TestShortCodeCodec(unittest.TestCase):
+    def setUp(self):
+        self.encoder = hashids.Hashids(salt=HASHID_SALT, min_length=SHORT_CODE_MIN_LENGTH)
+
+    def tearDown(self):
+        pass
+
+    def test_encode(self):
+        cases = [
+            {"name": "small values are padded", "values": list(range(0, 500))},
+            {"name": "standard tier codes", "values": [int(f"{Subscription.STANDARD.to_number()}{n}") for n in range(0, 5000, 7)]},
+            {"name": "premium tier codes", "values": [int(f"{Subscription.PREMIUM.to_number()}{n}") for n in range(0, 5000, 7)]},
+            {"name": "large values", "values": [10 ** 12 + n * 7919 for n in range(500)]},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                expected = [self.encoder.encode(value) for value in case["values"]]
+                self.assertEqual(expected, short_code_codec.encode_many(case["values"]))
+
+    def test_encode_other_lengths(self):
+        cases = [
+            {"name": "no padding", "min_length": 0},
+            {"name": "multiple padding rounds", "min_length": 20},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                codec = ShortCodeCodec(salt=HASHID_SALT, min_length=case["min_length"])
+                encoder = hashids.Hashids(salt=HASHID_SALT, min_length=case["min_length"])
+                for value in range(0, 3000, 3):
+                    self.assertEqual(encoder.encode(value), codec.encode(value))
+
+    def test_decode(self):
+        cases = [
+            {"name": "issued code", "code": self.encoder.encode(1123), "expect": 1123},
+            {"name": "empty", "code": "", "expect": None},
+            {"name": "invalid code", "code": "bad123", "expect": None},
+            {"name": "multi value hashid", "code": self.encoder.encode(1, 2), "expect": None},
+            {"name": "unknown characters", "code": "!!!!!!!", "expect": None},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.assertEqual(case["expect"], short_code_codec.decode(case["code"]))
+
+        codes = [self.encoder.encode(value) for value in range(0, 2000)]
+        self.assertEqual(list(range(0, 2000)), short_code_codec.decode_many(codes))
+
+    def test_tiers(self):
+        cases = [
+            {"name": "standard", "tier": Subscription.STANDARD.to_number(), "counter": 123},
+            {"name": "premium", "tier": Subscription.PREMIUM.to_number(), "counter": 99},
+            {"name": "zero counter", "tier": Subscription.STANDARD.to_number(), "counter": 0},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                value = short_code_codec.compose(case["tier"], case["counter"])
+                self.assertEqual(int(f"{case['tier']}{case['counter']}"), value)
+                self.assertEqual(case["tier"], short_code_codec.tier_of(value))
+                self.assertEqual(case["counter"], short_code_codec.counter_of(value))
+                self.assertEqual([case["tier"]], short_code_codec.tier_of_many([value]))
+
+    def test_decimal_counter(self):
+        cases = [
+            {"name": "standard", "tier": Subscription.STANDARD.to_number(), "counter": Decimal(123)},
+            {"name": "premium", "tier": Subscription.PREMIUM.to_number(), "counter": Decimal(10 ** 9)},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                value = short_code_codec.compose(case["tier"], case["counter"])
+                self.assertIs(int, type(value))
+                expected = self.encoder.encode(int(f"{case['tier']}{case['counter']}"))
+                self.assertEqual(expected, short_code_codec.encode(value))
+                self.assertEqual(expected, short_code_codec.encode(Decimal(value)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import threading
+import unittest
+
+from app.utils.single_flight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.flight = SingleFlight()
+
+    def tearDown(self):
+        pass
+
+    def test_do(self):
+        cases = [
+            {
+                "name": "concurrent callers share one call",
+                "callers": 5,
+                "error": None,
+                "expect_calls": 1,
+            },
+            {
+                "name": "error is raised to every caller",
+                "callers": 3,
+                "error": ValueError("boom"),
+                "expect_calls": 1,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                release = threading.Event()
+                calls = []
+                results = []
+
+                def load():
+                    calls.append(1)
+                    release.wait(2)
+                    if case["error"] is not None:
+                        raise case["error"]
+                    return "value"
+
+                def caller():
+                    try:
+                        results.append(self.flight.do("key", load))
+                    except ValueError as e:
+                        results.append(e)
+
+                threads = [threading.Thread(target=caller) for _ in range(case["callers"])]
+                threads[0].start()
+                while not calls:
+                    pass
+                for thread in threads[1:]:
+                    thread.start()
+                while self.flight.shared < case["callers"] - 1:
+                    pass
+                release.set()
+                for thread in threads:
+                    thread.join(2)
+
+                self.assertEqual(case["expect_calls"], len(calls))
+                self.assertEqual([case["error"] or "value"] * case["callers"], results)
+                self.flight.shared = 0
+
+    def test_do_sequential(self):
+        cases = [
+            {"name": "finished calls are not reused", "keys": ["a", "a", "b"], "expect_calls": 3},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                calls = []
+                for key in case["keys"]:
+                    self.flight.do(key, lambda: calls.append(key))
+                self.assertEqual(case["expect_calls"], len(calls))
+
+
+if __name__ == "__main__":
+    unittest.main()
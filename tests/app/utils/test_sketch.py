@@ -0,0 +1,279 @@
+import random
+import unittest
+
+from app.utils.sketch import CountMinSketch, HotKeySketch, HyperLogLog, TopK, misra_gries_trim
+
+
+class TestCountMinSketch(unittest.TestCase):
+    def setUp(self):
+        self.sketch = CountMinSketch(width=256, depth=4)
+
+    def tearDown(self):
+        pass
+
+    def test_estimate(self):
+        cases = [
+            {"name": "single key", "adds": {"a": 5}, "key": "a", "expect_min": 5, "expect_max": 5},
+            {"name": "unseen key", "adds": {"a": 5}, "key": "b", "expect_min": 0, "expect_max": 5},
+            {
+                "name": "never undercounts among many keys",
+                "adds": {f"code{i}": 1 for i in range(500)} | {"hot": 300},
+                "key": "hot",
+                "expect_min": 300,
+                "expect_max": 320,
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.sketch.clear()
+                for key, count in case["adds"].items():
+                    self.sketch.add(key, count)
+
+                estimate = self.sketch.estimate(case["key"])
+                self.assertGreaterEqual(estimate, case["expect_min"])
+                self.assertLessEqual(estimate, case["expect_max"])
+
+
+class TestTopK(unittest.TestCase):
+    def setUp(self):
+        self.top = TopK(k=2)
+
+    def tearDown(self):
+        pass
+
+    def test_offer(self):
+        cases = [
+            {
+                "name": "keeps the highest keys",
+                "offers": [("a", 1), ("b", 2), ("c", 3)],
+                "expect": [("c", 3), ("b", 2)],
+            },
+            {
+                "name": "updated estimate is not evicted by a stale entry",
+                "offers": [("a", 1), ("b", 2), ("a", 5), ("c", 3)],
+                "expect": [("a", 5), ("c", 3)],
+            },
+            {
+                "name": "smaller key is ignored when full",
+                "offers": [("a", 4), ("b", 5), ("c", 1)],
+                "expect": [("b", 5), ("a", 4)],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.top.clear()
+                for key, estimate in case["offers"]:
+                    self.top.offer(key, estimate)
+
+                self.assertEqual(case["expect"], self.top.items())
+
+
+class TestHotKeySketch(unittest.TestCase):
+    def setUp(self):
+        self.sketch = HotKeySketch(width=512, depth=4, k=3)
+
+    def tearDown(self):
+        pass
+
+    def test_top_keys(self):
+        cases = [
+            {
+                "name": "hot codes surface among a long tail",
+                "hits": {"hot1": 200, "hot2": 150, "hot3": 100} | {f"tail{i}": 1 for i in range(2000)},
+                "expect_keys": ["hot1", "hot2", "hot3"],
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.sketch.clear()
+                for key, hits in case["hits"].items():
+                    for _ in range(hits):
+                        self.sketch.add(key)
+
+                self.assertEqual(case["expect_keys"], [key for key, _ in self.sketch.top_keys()])
+
+
+
+class TestMisraGriesTrim(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_trim(self):
+        cases = [
+            {
+                "name": "at most k keys are left alone",
+                "counts": {"a": 3, "b": 1},
+                "k": 2,
+                "expect": ({"a": 3, "b": 1}, 0, 0),
+            },
+            {
+                "name": "k+1th largest is taken off every key",
+                "counts": {"a": 10, "b": 6, "c": 2, "d": 1},
+                "k": 2,
+                "expect": ({"a": 8, "b": 4}, 7, 2),
+            },
+            {
+                "name": "ties at the threshold are dropped",
+                "counts": {"a": 5, "b": 2, "c": 2, "d": 2},
+                "k": 2,
+                "expect": ({"a": 3}, 8, 2),
+            },
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.assertEqual(case["expect"], misra_gries_trim(dict(case["counts"]), case["k"]))
+
+    def test_error_bound(self):
+        rng = random.Random(3)
+        k = 10
+        truth: dict[str, int] = {}
+        counts: dict[str, int] = {}
+        removed = error = 0
+        for _ in range(5000):
+            # a few heavy referrers over a long tail
+            key = f"heavy{rng.randrange(5)}" if rng.random() < 0.5 else f"tail{rng.randrange(2000)}"
+            truth[key] = truth.get(key, 0) + 1
+            counts[key] = counts.get(key, 0) + 1
+            if len(counts) > 2 * k:
+                counts, trimmed, threshold = misra_gries_trim(counts, k)
+                removed += trimmed
+                error += threshold
+
+        self.assertLessEqual(len(counts), 2 * k)
+        self.assertEqual(5000, sum(counts.values()) + removed)
+        self.assertLessEqual(error, 5000 // (k + 1))
+        for key, count in truth.items():
+            self.assertLessEqual(counts.get(key, 0), count)
+            self.assertLessEqual(count - counts.get(key, 0), error)
+        for i in range(5):
+            self.assertIn(f"heavy{i}", counts)
+
+
+class TestHyperLogLog(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_count(self):
+        cases = [
+            {"name": "empty", "distinct": 0, "precision": 11, "tolerance": 0},
+            {"name": "small counts are exact enough", "distinct": 50, "precision": 11, "tolerance": 0.02},
+            {"name": "linear counting range", "distinct": 2_000, "precision": 11, "tolerance": 0.05},
+            {"name": "harmonic mean range", "distinct": 50_000, "precision": 11, "tolerance": 0.07},
+            {"name": "higher precision", "distinct": 50_000, "precision": 14, "tolerance": 0.025},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                sketch = HyperLogLog(case["precision"])
+                for i in range(case["distinct"]):
+                    # every visitor shows up twice
+                    sketch.add(f"10.0.{i}")
+                    sketch.add(f"10.0.{i}")
+
+                self.assertLessEqual(abs(sketch.count() - case["distinct"]), case["distinct"] * case["tolerance"])
+
+    def test_merge(self):
+        first = HyperLogLog.of_hashes(11, map(HyperLogLog.hash, (f"a{i}" for i in range(3000))))
+        second = HyperLogLog.of_hashes(11, map(HyperLogLog.hash, (f"a{i}" for i in range(2000, 5000))))
+        both = HyperLogLog.of_hashes(11, map(HyperLogLog.hash, (f"a{i}" for i in range(5000))))
+
+        union = HyperLogLog.union([first, second])
+        self.assertEqual(both.registers, union.registers)
+        # the inputs are left alone
+        self.assertNotEqual(both.registers, first.registers)
+
+        self.assertFalse(union.merge(first))
+        self.assertFalse(union.merge(union))
+        self.assertTrue(first.merge(second))
+        self.assertEqual(both.count(), first.count())
+
+        self.assertIsNone(HyperLogLog.union([]))
+        with self.assertRaises(ValueError):
+            first.merge(HyperLogLog(12))
+
+    def test_registers(self):
+        cases = [
+            {"name": "typical hash", "precision": 11, "hash": HyperLogLog.hash("visitor")},
+            {"name": "longest run of zeros", "precision": 11, "hash": 5 << 53},
+            {"name": "smallest precision", "precision": 4, "hash": HyperLogLog.hash("visitor")},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                index, rank = HyperLogLog.register_of(case["precision"], case["hash"])
+                direct = HyperLogLog(case["precision"])
+                direct.add_hash(case["hash"])
+                rebuilt = HyperLogLog(case["precision"])
+                rebuilt.add_hash(HyperLogLog.hash_of_register(case["precision"], index, rank))
+
+                self.assertEqual(rank, direct.registers[index])
+                self.assertEqual(direct.registers, rebuilt.registers)
+
+    def test_bytes(self):
+        cases = [
+            {"name": "empty", "distinct": 0, "max_size": 2},
+            {"name": "sparse", "distinct": 100, "max_size": 302},
+            {"name": "dense", "distinct": 100_000, "max_size": 1024},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                sketch = HyperLogLog.of_hashes(11, map(HyperLogLog.hash, (str(i) for i in range(case["distinct"]))))
+
+                data = sketch.to_bytes()
+                decoded = HyperLogLog.from_bytes(data)
+
+                self.assertLessEqual(len(data), case["max_size"])
+                self.assertEqual(11, decoded.precision)
+                self.assertEqual(sketch.registers, decoded.registers)
+
+    def test_of_registers(self):
+        cases = [
+            {"name": "empty", "distinct": 0},
+            {"name": "sparse", "distinct": 100},
+            {"name": "harmonic mean range", "distinct": 50_000},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                hashes = [HyperLogLog.hash(str(i)) for i in range(case["distinct"])]
+                sketch = HyperLogLog.of_hashes(11, hashes)
+                registers = {}
+                for value_hash in hashes:
+                    index, rank = HyperLogLog.register_of(11, value_hash)
+                    registers[index] = max(rank, registers.get(index, 0))
+
+                self.assertEqual(sketch.registers, HyperLogLog.of_registers(11, registers).registers)
+                self.assertEqual(sketch.count(), HyperLogLog.count_of_registers(11, registers))
+                self.assertEqual(sketch.to_bytes(), HyperLogLog.bytes_of_registers(11, registers))
+
+    def test_from_bytes_invalid(self):
+        dense = HyperLogLog.of_hashes(4, map(HyperLogLog.hash, (str(i) for i in range(100)))).to_bytes()
+        sparse = HyperLogLog.of_hashes(11, [HyperLogLog.hash("a")]).to_bytes()
+        cases = [
+            {"name": "empty", "data": b""},
+            {"name": "unknown encoding", "data": b"\x03" + dense[1:]},
+            {"name": "corrupt registers", "data": dense[:2] + b"garbage"},
+            {"name": "registers of another precision", "data": dense[:1] + b"\x05" + dense[2:]},
+            {"name": "truncated sparse register", "data": sparse[:-1]},
+            {"name": "sparse register out of range", "data": sparse[:1] + b"\x04" + sparse[2:]},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                with self.assertRaises(ValueError):
+                    HyperLogLog.from_bytes(case["data"])
+
+
+if __name__ == "__main__":
+    unittest.main()
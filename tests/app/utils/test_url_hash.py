@@ -0,0 +1,46 @@
+import unittest
+
+from app.utils.url_hash import normalize_url, url_hash
+
+
+class TestUrlHash(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_normalize_url(self):
+        cases = [
+            {"name": "adds default scheme", "url": "example.com", "expect": "https://example.com/"},
+            {"name": "lowercases scheme and host", "url": "HTTPS://Example.COM/Path", "expect": "https://example.com/Path"},
+            {"name": "drops default port", "url": "http://example.com:80/a", "expect": "http://example.com/a"},
+            {"name": "keeps other ports", "url": "https://example.com:8443/a", "expect": "https://example.com:8443/a"},
+            {"name": "keeps query and fragment", "url": "example.com/a?b=1#top", "expect": "https://example.com/a?b=1#top"},
+            {"name": "trims whitespace", "url": "  example.com/a ", "expect": "https://example.com/a"},
+            {"name": "no scheme with a url in the query", "url": "Example.com/a?next=http://b.com",
+             "expect": "https://example.com/a?next=http://b.com"},
+            {"name": "no scheme with a port", "url": "example.com:8080/a", "expect": "https://example.com:8080/a"},
+            {"name": "port out of range is kept as given", "url": " http://a.com:99999/x ", "expect": "http://a.com:99999/x"},
+            {"name": "non numeric port is kept as given", "url": "http://a.com:x", "expect": "http://a.com:x"},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.assertEqual(case["expect"], normalize_url(case["url"]))
+
+    def test_url_hash(self):
+        cases = [
+            {"name": "equivalent urls match", "a": "Example.com", "b": "https://example.com:443/", "expect_equal": True},
+            {"name": "different paths differ", "a": "example.com/a", "b": "example.com/b", "expect_equal": False},
+            {"name": "urls differing only in fragment differ", "a": "https://a.com/app#/users/1",
+             "b": "https://a.com/app#/users/2", "expect_equal": False},
+        ]
+
+        for case in cases:
+            with self.subTest(case["name"]):
+                self.assertEqual(case["expect_equal"], url_hash(case["a"]) == url_hash(case["b"]))
+
+
+if __name__ == "__main__":
+    unittest.main()